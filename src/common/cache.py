@@ -0,0 +1,232 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import threading
+import time
+import thiscovery_lib.utilities as utils
+from collections import OrderedDict
+
+import common.constants as const
+from common.clients import thiscovery_clients
+
+
+class LruCache:
+    """
+    Thread-safe in-memory LRU cache. Module-level instances live for as long
+    as the Lambda container is warm.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+        Args:
+            maxsize (int): Maximum number of entries; least recently used entries are evicted first
+            ttl (int): Optional time to live of entries, in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, stored_at = self._data[key]
+            except KeyError:
+                return default
+            if self.ttl is not None and (time.monotonic() - stored_at) > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[0]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DdbCache:
+    """
+    Second-tier cache shared by all containers, backed by the Cache ddb table.
+    Items carry an epoch expires_at attribute used by Dynamodb TTL; because TTL
+    deletion is lazy, expiry is also checked on read.
+    """
+
+    def __init__(self, item_type, ttl=None, ddb_client=None, correlation_id=None):
+        """
+        Args:
+            item_type (str): Type of cached items; also used to namespace cache keys
+            ttl (int): Optional time to live of cached items, in seconds
+            ddb_client: Optional Dynamodb client to use
+            correlation_id:
+        """
+        self.item_type = item_type
+        self.ttl = ttl
+        self._ddb_client = ddb_client
+        self._correlation_id = correlation_id
+
+    @property
+    def ddb_client(self):
+        if self._ddb_client is None:
+            self._ddb_client = thiscovery_clients.get_ddb_client()
+        return self._ddb_client
+
+    def _key(self, key):
+        return f"{self.item_type}_{key}"
+
+    def get(self, key):
+        item = self.ddb_client.get_item(
+            table_name=const.CACHE_TABLE["name"],
+            key=self._key(key),
+            key_name=const.CACHE_TABLE["partition_key"],
+            correlation_id=self._correlation_id,
+        )
+        if item is None:
+            return None
+        expires_at = item.get(const.CACHE_TABLE["ttl_attribute"])
+        if expires_at is not None and int(expires_at) < time.time():
+            return None
+        return item["value"]
+
+    def put(self, key, value):
+        item = {"value": value}
+        if self.ttl is not None:
+            item[const.CACHE_TABLE["ttl_attribute"]] = int(time.time() + self.ttl)
+        return self.ddb_client.put_item(
+            table_name=const.CACHE_TABLE["name"],
+            key=self._key(key),
+            key_name=const.CACHE_TABLE["partition_key"],
+            item_type=self.item_type,
+            item_details=None,
+            item=item,
+            update_allowed=True,
+            correlation_id=self._correlation_id,
+        )
+
+    def delete(self, key):
+        return self.ddb_client.delete_item(
+            table_name=const.CACHE_TABLE["name"],
+            key=self._key(key),
+            key_name=const.CACHE_TABLE["partition_key"],
+            correlation_id=self._correlation_id,
+        )
+
+    def safe_get(self, key):
+        """
+        Same as get, but logs and swallows errors so that an unavailable cache
+        never fails the calling request
+        """
+        try:
+            return self.get(key)
+        except Exception:
+            utils.get_logger().warning(
+                "Failed to read from ddb cache",
+                extra={
+                    "key": self._key(key),
+                    "correlation_id": self._correlation_id,
+                },
+                exc_info=True,
+            )
+
+    def safe_put(self, key, value):
+        try:
+            return self.put(key, value)
+        except Exception:
+            utils.get_logger().warning(
+                "Failed to write to ddb cache",
+                extra={
+                    "key": self._key(key),
+                    "correlation_id": self._correlation_id,
+                },
+                exc_info=True,
+            )
+
+
+class TieredCache:
+    """
+    Read-through cache with two tiers: an LruCache held in the container, in
+    front of an optional DdbCache shared by all containers. Values found in the
+    Cache table are copied into the LRU, so a key costs at most one ddb read per
+    container; values written are stored in both tiers. Errors of the ddb tier
+    are logged and otherwise ignored.
+
+    Values are served for up to ttl seconds from each tier; users whose entries
+    can be invalid for a given lookup pass an is_valid callable to get, and
+    entries failing it are treated as misses.
+    """
+
+    def __init__(self, item_type, maxsize=1024, ttl=None, persist=True):
+        """
+        Args:
+            item_type (str): Namespace of the cache's items in the Cache table
+            maxsize (int): Maximum number of entries held in the container
+            ttl (int): Optional time to live of entries, in seconds
+            persist (bool): If False, the Cache table tier is not used
+        """
+        self.item_type = item_type
+        self.ttl = ttl
+        self.persist = persist
+        self.lru = LruCache(maxsize=maxsize, ttl=ttl)
+
+    def clear(self):
+        self.lru.clear()
+
+    def _ddb_cache(self, ddb_client=None, correlation_id=None):
+        return DdbCache(
+            item_type=self.item_type,
+            ttl=self.ttl,
+            ddb_client=ddb_client,
+            correlation_id=correlation_id,
+        )
+
+    def get(self, key: str, is_valid=None, ddb_client=None, correlation_id=None):
+        """
+        Returns:
+            The cached value of key, or None if neither tier holds a valid value
+        """
+        value = self.lru.get(key)
+        if value is None and self.persist:
+            value = self._ddb_cache(ddb_client, correlation_id).safe_get(key)
+            if value is not None and (is_valid is None or is_valid(value)):
+                self.lru.put(key, value)
+        if value is None or (is_valid is not None and not is_valid(value)):
+            return None
+        return value
+
+    def put(self, key: str, value, ddb_client=None, correlation_id=None) -> None:
+        self.lru.put(key, value)
+        if self.persist:
+            self._ddb_cache(ddb_client, correlation_id).safe_put(key, value)
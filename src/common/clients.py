@@ -0,0 +1,247 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Registries of API clients that are created once per Lambda container and reused
+across warm invocations
+"""
+
+import boto3
+import collections
+import json
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from thiscovery_lib.dynamodb_utilities import Dynamodb
+
+import common.constants as const
+
+
+class PooledSessionMixin:
+    """
+    Sends the requests of a thiscovery-lib Qualtrics client through the keep-alive
+    session that QualtricsClientRegistry holds for the client's account, instead of
+    opening a new connection per call
+    """
+
+    registry = None
+    session_account_name = None
+
+    @property
+    def session(self):
+        registry = self.registry or qualtrics_clients
+        return registry.get_session(self.session_account_name)
+
+    def qualtrics_request(
+        self, method, endpoint_url, api_key=None, params=None, data=None
+    ):
+        if api_key is None:
+            api_key = self.api_key
+        headers = {"Content-Type": "application/json", "X-API-TOKEN": api_key}
+        if data is not None:
+            data = json.dumps(data)
+        r = self.session.request(
+            method, endpoint_url, headers=headers, params=params, data=data
+        )
+        return r.json()
+
+
+class QualtricsClientRegistry:
+    """
+    Holds one instance of each thiscovery-lib Qualtrics client per account (and survey),
+    together with a keep-alive requests.Session per account that those clients send
+    their requests through.
+
+    Reusing clients avoids fetching Qualtrics credentials from Secrets Manager on
+    every invocation; reusing sessions keeps TLS connections to Qualtrics open
+    between invocations. Survey-bound clients are evicted least recently used
+    first once max_clients is reached.
+    """
+
+    def __init__(
+        self,
+        pool_maxsize=const.QUALTRICS_POOL_MAXSIZE,
+        max_clients=const.QUALTRICS_CLIENTS_MAX_SIZE,
+    ):
+        self.pool_maxsize = pool_maxsize
+        self.max_clients = max_clients
+        self._clients = collections.OrderedDict()
+        self._sessions = dict()
+        self._pooled_classes = dict()
+        self._lock = threading.Lock()
+        self.client_hits = 0
+        self.client_misses = 0
+        self.session_hits = 0
+        self.session_misses = 0
+
+    def stats(self):
+        return {
+            "client_hits": self.client_hits,
+            "client_misses": self.client_misses,
+            "clients": len(self._clients),
+            "session_hits": self.session_hits,
+            "session_misses": self.session_misses,
+            "sessions": len(self._sessions),
+        }
+
+    def clear(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._clients.clear()
+            self._sessions.clear()
+            self.client_hits = 0
+            self.client_misses = 0
+            self.session_hits = 0
+            self.session_misses = 0
+
+    def _pooled_class(self, client_class):
+        pooled_class = self._pooled_classes.get(client_class)
+        if pooled_class is None:
+            bases = (client_class,)
+            if not issubclass(client_class, PooledSessionMixin):
+                bases = (PooledSessionMixin, client_class)
+            pooled_class = type(
+                f"Pooled{client_class.__name__}", bases, {"registry": self}
+            )
+            self._pooled_classes[client_class] = pooled_class
+        return pooled_class
+
+    def _store_client(self, key, client):
+        self._clients[key] = client
+        self._clients.move_to_end(key)
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+
+    def get_client(self, client_class, qualtrics_account_name=None, survey_id=None):
+        """
+        Clients are shared by every request served by the container, so they are
+        created without a correlation id; pass one to individual calls instead.
+
+        Args:
+            client_class: thiscovery-lib Qualtrics client class (e.g. SurveyDefinitionsClient)
+            qualtrics_account_name (str): If None, the client's default account is used
+            survey_id (str): Survey the client is bound to, if any
+
+        Returns:
+            A client_class instance, shared with previous callers using the same arguments
+        """
+        key = (client_class, qualtrics_account_name, survey_id)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                self.client_misses += 1
+                kwargs = dict()
+                if qualtrics_account_name is not None:
+                    kwargs["qualtrics_account_name"] = qualtrics_account_name
+                if survey_id is not None:
+                    kwargs["survey_id"] = survey_id
+                client = self._pooled_class(client_class)(**kwargs)
+                client.session_account_name = qualtrics_account_name
+            else:
+                self.client_hits += 1
+            self._store_client(key, client)
+        return client
+
+    def set_client(
+        self, client_class, client, qualtrics_account_name=None, survey_id=None
+    ):
+        """
+        Registers client as the instance of client_class to hand out for this
+        account (and survey); e.g. to use a fake client in load tests
+        """
+        with self._lock:
+            self._store_client(
+                (client_class, qualtrics_account_name, survey_id), client
+            )
+
+    def get_session(self, qualtrics_account_name=None):
+        """
+        Args:
+            qualtrics_account_name (str): None stands for the default account of
+                thiscovery-lib clients
+
+        Returns:
+            A requests.Session with a connection pool dedicated to this account
+        """
+        with self._lock:
+            session = self._sessions.get(qualtrics_account_name)
+            if session is None:
+                self.session_misses += 1
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_maxsize
+                )
+                session.mount("https://", adapter)
+                self._sessions[qualtrics_account_name] = session
+            else:
+                self.session_hits += 1
+            return session
+
+
+qualtrics_clients = QualtricsClientRegistry()
+
+
+class ThiscoveryClientProvider:
+    """
+    Holds the Dynamodb and boto3 S3 client instances shared by all objects created
+    in a Lambda container, so that table names and boto3 resources are resolved once
+    rather than every time an item class is instantiated.
+
+    Shared clients never carry a correlation id; callers pass correlation_id to each
+    Dynamodb call. CoreApiClient keeps its correlation id as instance state, so it is
+    created per request rather than held here.
+    """
+
+    def __init__(self):
+        self._ddb_clients = dict()
+        self._s3_client = None
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._ddb_clients.clear()
+            self._s3_client = None
+
+    def get_ddb_client(self, stack_name=const.STACK_NAME):
+        with self._lock:
+            ddb_client = self._ddb_clients.get(stack_name)
+            if ddb_client is None:
+                ddb_client = Dynamodb(stack_name=stack_name)
+                self._ddb_clients[stack_name] = ddb_client
+            return ddb_client
+
+    def set_ddb_client(self, ddb_client, stack_name=const.STACK_NAME):
+        """
+        Registers ddb_client as the client to hand out for stack_name; e.g. to use
+        an in-memory fake in load tests
+        """
+        with self._lock:
+            self._ddb_clients[stack_name] = ddb_client
+
+    def get_s3_client(self):
+        with self._lock:
+            if self._s3_client is None:
+                self._s3_client = boto3.client("s3")
+        return self._s3_client
+
+    def set_s3_client(self, s3_client):
+        with self._lock:
+            self._s3_client = s3_client
+
+
+thiscovery_clients = ThiscoveryClientProvider()
@@ -19,7 +19,80 @@ class PersonalLinksTable:
     NAME = "PersonalLinks"
     PARTITION = "account_survey_id"
     SORT = "url"
+    # epoch expiry of unassigned links, used by ddb TTL
+    TTL_ATTRIBUTE = "expires_at"
     BUFFER = 20
+    # number of soonest-expiring links that concurrent assignments are spread over
+    ASSIGNMENT_WINDOW = 10
+    MAX_ASSIGNMENT_ATTEMPTS = 10
+    # times links may be created (or awaited from a concurrent generator) while
+    # assigning one link before giving up
+    MAX_CREATION_ROUNDS = 5
+    # lease held while a link is assigned to a user, so that concurrent requests by
+    # the same user wait for that link instead of being assigned another one
+    USER_ASSIGNMENT_LEASE_SECONDS = 60
+    CANDIDATES_PAGE_SIZE = max(BUFFER, ASSIGNMENT_WINDOW)
+
+
+class PersonalLinkCountersTable:
+    NAME = "PersonalLinkCounters"
+    PARTITION = "account_survey_id"
+    UNASSIGNED = "unassigned"
+    # running total of links found to be already taken when assigning
+    ASSIGNMENT_CONFLICTS = "assignment_conflicts"
+    # prefix of per-minute assignment counts (e.g. assigned_1621512000)
+    ASSIGNED_BUCKET_PREFIX = "assigned_"
+    ASSIGNED_BUCKET_SECONDS = 60
+
+
+class PersonalLinksBuffer:
+    """
+    Settings of the adaptive buffer of unassigned personal links of each survey
+    """
+
+    # sliding window over which the assignment rate of a survey is measured
+    RATE_WINDOW_MINUTES = 15
+    # a refill is triggered when the pool would run out within this many minutes
+    TRIGGER_COVERAGE_MINUTES = 5
+    # refills top the pool up to cover this many minutes of demand
+    TARGET_COVERAGE_MINUTES = 30
+    FLOOR = PersonalLinksTable.BUFFER
+    CEILING = 2000
+    MAX_REFILL_ROUNDS = 20
+
+
+class PersonalLinksGeneration:
+    """
+    Settings of the single-flight lease that serialises link generation for
+    each survey
+    """
+
+    # generators renew the lease after each distribution they create
+    LEASE_SECONDS = 60
+    # how long API callers wait for links generated by someone else; must stay
+    # below the API Gateway integration timeout
+    WAIT_TIMEOUT = 20  # seconds
+    POLL_INTERVAL = 0.5  # seconds
+    # minimum interval between create_personal_links events of a survey
+    EVENT_DEBOUNCE_SECONDS = 60
+    # maximum number of distributions created by a single pre-assignment
+    MAX_PREASSIGNMENT_ROUNDS = 100
+
+
+class ConsentIngestion:
+    """
+    Settings of bulk consent ingestion (see consent_ingestion.py)
+    """
+
+    # environment variable holding the name of the bucket consent exports are uploaded to
+    BUCKET_ENV_VAR = "CONSENT_IMPORTS_BUCKET"
+    # rows resolved and written to ddb together
+    CHUNK_SIZE = 250
+    # an invocation hands the rest of the file over to a continuation event once
+    # less than this is left before its Lambda timeout
+    TIME_MARGIN_SECONDS = 60
+    # maximum number of entries of an EventBridge PutEvents call
+    EVENTS_PER_PUT = 10
 
 
 DISTRIBUTION_LISTS = {
@@ -32,9 +105,42 @@ DISTRIBUTION_LISTS = {
 
 
 STACK_NAME = "thiscovery-surveys"
+PROJECT_TASK_INDEX_TTL = 300  # seconds
+# minimum age of the index before a lookup of an unknown id refreshes it
+PROJECT_TASK_INDEX_MIN_REFRESH_INTERVAL = 30  # seconds
+SURVEY_SCHEMA_CACHE_TTL = 300  # seconds
+INTERVIEW_QUESTIONS_CACHE_TTL = 60  # seconds
+ASSIGNED_LINKS_CACHE_SIZE = 10000
+ASSIGNED_LINKS_CACHE_TTL = 24 * 60 * 60  # seconds
+# if True, cold containers can find links assigned by other containers in the Cache table
+ASSIGNED_LINKS_DDB_CACHE = True
+# anon_user_task_id -> project_task_id -> project mappings
+PROJECT_RESOLVER_CACHE_SIZE = 10000
+PROJECT_RESOLVER_CACHE_TTL = 24 * 60 * 60  # seconds
+# if True, project lookups made by any container are stored in the Cache table
+PROJECT_RESOLVER_DDB_CACHE = True
+RESPONSE_BATCH_MAX_SIZE = 100
+RESPONSE_BATCH_MAX_WORKERS = 10
+QUALTRICS_POOL_MAXSIZE = RESPONSE_BATCH_MAX_WORKERS
+QUALTRICS_CLIENTS_MAX_SIZE = 128
+RESPONSE_EXPORT_POLL_INTERVAL = 2  # seconds
+RESPONSE_EXPORT_TIMEOUT = 600  # seconds
+# size (in bytes) above which downloaded response exports are spilled to /tmp
+RESPONSE_EXPORT_SPOOL_SIZE = 50 * 1024 * 1024
+DDB_BATCH_WRITE_MAX_ATTEMPTS = 8
+DDB_BATCH_WRITE_BASE_DELAY = 0.05  # seconds
 CONSENT_DATA_TABLE = "ConsentData"
 DEFAULT_CONSENT_EMAIL_TEMPLATE = "participant_consent"
 CONSENT_ROWS_IN_TEMPLATE = 20
+# if True, send_consent_email_api stores the consent and queues the participant's
+# e-mail (sent by send_queued_consent_emails) instead of sending it in-request;
+# requests can override this with an async_notification attribute
+CONSENT_EMAIL_ASYNC = False
+CONSENT_EMAIL_EVENT = "consent_email_requested"
+# age after which a claim to send a queued consent e-mail can be taken over by
+# another delivery; longer than the maximum Lambda timeout (900 s), so that the
+# invocation holding the claim has ended by then
+CONSENT_EMAIL_CLAIM_TIMEOUT_SECONDS = 960
 INTERVIEW_TASKS_TABLE = {
     "name": "InterviewTasks",
     "partition_key": "project_task_id",
@@ -50,3 +156,8 @@ INTERVIEW_QUESTIONS_TABLE = {
     "partition_key": "survey_id",
     "sort_key": "question_id",
 }
+CACHE_TABLE = {
+    "name": "Cache",
+    "partition_key": "id",
+    "ttl_attribute": "expires_at",
+}
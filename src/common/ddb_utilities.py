@@ -0,0 +1,101 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import time
+import thiscovery_lib.utilities as utils
+
+import common.constants as const
+
+DDB_BATCH_WRITE_LIMIT = 25  # maximum number of requests per BatchWriteItem call
+DDB_BATCH_GET_LIMIT = 100  # maximum number of keys per BatchGetItem call
+
+
+def batch_write_items(table, items=(), delete_keys=()) -> int:
+    """
+    Writes items to (and/or deletes keys from) a ddb table in BatchWriteItem calls
+    of up to 25 requests, resending unprocessed items with exponential backoff
+
+    Args:
+        table: boto3 Table resource (e.g. as returned by Dynamodb.get_table)
+        items: Items to put
+        delete_keys: Keys of items to delete
+
+    Returns:
+        Number of requests processed
+    """
+    requests = [{"PutRequest": {"Item": i}} for i in items] + [
+        {"DeleteRequest": {"Key": k}} for k in delete_keys
+    ]
+    client = table.meta.client
+    for i in range(0, len(requests), DDB_BATCH_WRITE_LIMIT):
+        pending = {table.name: requests[i : i + DDB_BATCH_WRITE_LIMIT]}
+        for attempt in range(const.DDB_BATCH_WRITE_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(const.DDB_BATCH_WRITE_BASE_DELAY * 2 ** (attempt - 1))
+            response = client.batch_write_item(RequestItems=pending)
+            pending = response.get("UnprocessedItems")
+            if not pending:
+                break
+        else:
+            raise utils.DetailedValueError(
+                "Failed to write all items to ddb",
+                details={
+                    "table": table.name,
+                    "unprocessed": len(pending.get(table.name, [])),
+                },
+            )
+    return len(requests)
+
+
+def batch_get_items(table, keys, projection=None) -> list:
+    """
+    Reads items from a ddb table in BatchGetItem calls of up to 100 keys, resending
+    unprocessed keys with exponential backoff (as batch_write_items does)
+
+    Args:
+        table: boto3 Table resource (e.g. as returned by Dynamodb.get_table)
+        keys: Keys of the items to read
+        projection (str): ProjectionExpression of the attributes to read; all if None
+
+    Returns:
+        Items found, in no particular order
+    """
+    keys = list(keys)
+    client = table.meta.client
+    items = list()
+    for i in range(0, len(keys), DDB_BATCH_GET_LIMIT):
+        request = {"Keys": keys[i : i + DDB_BATCH_GET_LIMIT]}
+        if projection is not None:
+            request["ProjectionExpression"] = projection
+        pending = {table.name: request}
+        for attempt in range(const.DDB_BATCH_WRITE_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(const.DDB_BATCH_WRITE_BASE_DELAY * 2 ** (attempt - 1))
+            response = client.batch_get_item(RequestItems=pending)
+            items.extend(response["Responses"].get(table.name, []))
+            pending = response.get("UnprocessedKeys")
+            if not pending:
+                break
+        else:
+            raise utils.DetailedValueError(
+                "Failed to read all items from ddb",
+                details={
+                    "table": table.name,
+                    "unprocessed": len(pending.get(table.name, {}).get("Keys", [])),
+                },
+            )
+    return items
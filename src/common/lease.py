@@ -0,0 +1,133 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import time
+import uuid
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+import common.constants as const
+from common.clients import thiscovery_clients
+
+
+class DdbLease:
+    """
+    Time-limited lock shared by all Lambda containers, held as an item in the
+    Cache ddb table. A lease can be acquired if no one holds it or if the
+    previous holder let it expire (e.g. because its Lambda crashed or timed out),
+    so a failed holder never blocks others for longer than the lease duration.
+    """
+
+    item_type = "lease"
+
+    def __init__(self, name, duration, ddb_client=None, correlation_id=None):
+        """
+        Args:
+            name (str): Name of the lease; callers using the same name compete for it
+            duration (int): Number of seconds the lease is held for unless renewed
+            ddb_client: Optional Dynamodb client to use
+            correlation_id:
+        """
+        self.name = name
+        self.duration = duration
+        self.correlation_id = correlation_id
+        self.owner = str(uuid.uuid4())
+        self.held = False
+        self.ddb_client = ddb_client
+        if ddb_client is None:
+            self.ddb_client = thiscovery_clients.get_ddb_client()
+
+    @property
+    def table(self):
+        return self.ddb_client.get_table(table_name=const.CACHE_TABLE["name"])
+
+    def _key(self):
+        return {const.CACHE_TABLE["partition_key"]: f"{self.item_type}_{self.name}"}
+
+    def _expires_at(self):
+        return int(time.time() + self.duration)
+
+    def _is_owner_condition(self):
+        return Attr("owner").eq(self.owner)
+
+    def acquire(self) -> bool:
+        """
+        Returns:
+            True if the lease was acquired, False if someone else holds it
+        """
+        ttl_attribute = const.CACHE_TABLE["ttl_attribute"]
+        try:
+            self.table.put_item(
+                Item={
+                    **self._key(),
+                    "type": self.item_type,
+                    "owner": self.owner,
+                    "correlation_id": self.correlation_id,
+                    ttl_attribute: self._expires_at(),
+                },
+                ConditionExpression=Attr(
+                    const.CACHE_TABLE["partition_key"]
+                ).not_exists()
+                | Attr(ttl_attribute).lt(int(time.time())),
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        self.held = True
+        return True
+
+    def renew(self) -> bool:
+        """
+        Extends a lease held by this instance by its duration
+
+        Returns:
+            False if the lease has been lost (i.e. it expired and was acquired by someone else)
+        """
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression="SET #expires_at = :expires_at",
+                ConditionExpression=self._is_owner_condition(),
+                ExpressionAttributeNames={
+                    "#expires_at": const.CACHE_TABLE["ttl_attribute"]
+                },
+                ExpressionAttributeValues={":expires_at": self._expires_at()},
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            self.held = False
+            return False
+        return True
+
+    def release(self) -> None:
+        """
+        Releases a lease held by this instance; a lease that has since been
+        acquired by someone else is left alone
+        """
+        if not self.held:
+            return
+        try:
+            self.table.delete_item(
+                Key=self._key(),
+                ConditionExpression=self._is_owner_condition(),
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        self.held = False
@@ -0,0 +1,123 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+from thiscovery_lib.core_api_utilities import CoreApiClient
+
+import common.constants as const
+from common.cache import TieredCache
+
+
+class ProjectResolver:
+    """
+    Resolves anon_user_task_ids to project_task_ids, and project_task_ids to
+    projects, on behalf of Consent, TaskResponse and UserInterviewTask, which
+    previously asked the core API for every event they processed.
+
+    A user task never moves to another project task, and a project task never
+    moves to another project, so resolved values need no invalidation; they
+    expire after ttl seconds only so that renamed projects are eventually
+    picked up. Only the id and name of projects are kept.
+    """
+
+    user_task_item_type = "user_task_project_task_id"
+    project_item_type = "project_task_project"
+
+    def __init__(
+        self,
+        maxsize=const.PROJECT_RESOLVER_CACHE_SIZE,
+        ttl=const.PROJECT_RESOLVER_CACHE_TTL,
+        persist=const.PROJECT_RESOLVER_DDB_CACHE,
+    ):
+        self._project_task_ids = TieredCache(
+            item_type=self.user_task_item_type,
+            maxsize=maxsize,
+            ttl=ttl,
+            persist=persist,
+        )
+        self._projects = TieredCache(
+            item_type=self.project_item_type,
+            maxsize=maxsize,
+            ttl=ttl,
+            persist=persist,
+        )
+
+    def clear(self):
+        self._project_task_ids.clear()
+        self._projects.clear()
+
+    @staticmethod
+    def _resolve(cache, key, fetch, correlation_id=None):
+        value = cache.get(key, correlation_id=correlation_id)
+        if value is None:
+            value = fetch()
+            cache.put(key, value, correlation_id=correlation_id)
+        return value
+
+    def get_project_task_id(
+        self, anon_user_task_id, core_api_client=None, correlation_id=None
+    ):
+        """
+        Args:
+            anon_user_task_id:
+            core_api_client: Optional CoreApiClient used on cache misses
+            correlation_id:
+
+        Returns:
+            project_task_id of the user task
+        """
+
+        def fetch():
+            client = core_api_client or CoreApiClient(correlation_id=correlation_id)
+            user_task = client.get_user_task_from_anon_user_task_id(
+                anon_user_task_id=anon_user_task_id
+            )
+            return user_task["project_task_id"]
+
+        return self._resolve(
+            cache=self._project_task_ids,
+            key=anon_user_task_id,
+            fetch=fetch,
+            correlation_id=correlation_id,
+        )
+
+    def get_project(self, project_task_id, core_api_client=None, correlation_id=None):
+        """
+        Args:
+            project_task_id:
+            core_api_client: Optional CoreApiClient used on cache misses
+            correlation_id:
+
+        Returns:
+            Dictionary containing the id and name of the project the task belongs to
+        """
+
+        def fetch():
+            client = core_api_client or CoreApiClient(correlation_id=correlation_id)
+            project = client.get_project_from_project_task_id(
+                project_task_id=project_task_id
+            )
+            return {"id": project["id"], "name": project["name"]}
+
+        return self._resolve(
+            cache=self._projects,
+            key=project_task_id,
+            fetch=fetch,
+            correlation_id=correlation_id,
+        )
+
+
+project_resolver = ProjectResolver()
@@ -15,17 +15,26 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import hashlib
+import json
 import re
+import zlib
 import thiscovery_lib.utilities as utils
-from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.qualtrics import SurveyDefinitionsClient
 
 import common.constants as const
+from common.cache import DdbCache, LruCache
+from common.clients import qualtrics_clients, thiscovery_clients
 
 
 PROMPT_RE = re.compile('<div class="prompt">(.+)</div>')
 DESCRIPTION_RE = re.compile('<div class="description">(.+)</div>')
 SYSTEM_RE = re.compile('<div class="system">(.+)</div>')
+INTERVIEW_QUESTIONS_DOCUMENT_ITEM_TYPE = "interview_questions_document"
+
+interview_questions_cache = LruCache(
+    maxsize=128, ttl=const.INTERVIEW_QUESTIONS_CACHE_TTL
+)
 
 
 class InterviewQuestion:
@@ -55,27 +64,56 @@ class InterviewQuestion:
     def __repr__(self):
         return str(self.as_dict())
 
+    @property
+    def content_hash(self):
+        """
+        Hash of the question's content, used to detect questions that need to be rewritten
+        to Dynamodb. survey_modified is deliberately excluded, as it changes whenever
+        any part of the survey is edited
+        """
+        content = {
+            "question_id": self._question_id,
+            **{k: v for k, v in self.as_dict().items() if k != "survey_modified"},
+        }
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def as_ddb_item(self):
+        return {
+            const.INTERVIEW_QUESTIONS_TABLE["partition_key"]: self._survey_id,
+            const.INTERVIEW_QUESTIONS_TABLE["sort_key"]: self._question_id,
+            **self.as_dict(),
+            "content_hash": self.content_hash,
+        }
+
 
 class SurveyDefinition:
     def __init__(
         self, qualtrics_account_name="cambridge", survey_id=None, correlation_id=None
     ):
-        client = SurveyDefinitionsClient(
+        client = qualtrics_clients.get_client(
+            SurveyDefinitionsClient,
             qualtrics_account_name=qualtrics_account_name,
             survey_id=survey_id,
-            correlation_id=correlation_id,
         )
         response = client.get_survey()
         assert (
             response["meta"]["httpStatus"] == "200 - OK"
         ), f"Call to Qualtrics API failed with response {response}"
         self.survey_id = survey_id
+        self.correlation_id = correlation_id
         self.definition = response["result"]
         self.flow = self.definition["SurveyFlow"]["Flow"]
         self.blocks = self.definition["Blocks"]
         self.questions = self.definition["Questions"]
         self.modified = self.definition["LastModified"]
-        self.ddb_client = Dynamodb(stack_name=const.STACK_NAME)
+        self.ddb_client = thiscovery_clients.get_ddb_client()
+        self.sync_state = DdbCache(
+            item_type="interview_questions_sync",
+            ddb_client=self.ddb_client,
+            correlation_id=correlation_id,
+        )
         self.logger = utils.get_logger()
         self.logger.debug(
             "Initialised SurveyDefinition",
@@ -111,6 +149,20 @@ class SurveyDefinition:
             correlation_id=event["id"],
         )
 
+    def is_synced(self):
+        """
+        Returns:
+            True if this version of the survey (as identified by its LastModified value)
+            has already been synced to the InterviewQuestions table
+        """
+        state = self.sync_state.safe_get(self.survey_id)
+        return bool(state) and state.get("survey_modified") == self.modified
+
+    def record_sync(self):
+        return self.sync_state.safe_put(
+            self.survey_id, {"survey_modified": self.modified}
+        )
+
     def get_interview_question_list_from_Qualtrics(self):
         def parse_question_html(s):
             text_m = PROMPT_RE.search(s)
@@ -168,49 +220,117 @@ class SurveyDefinition:
                 question_counter += 1
         return interview_question_list
 
+    @staticmethod
+    def diff_interview_questions(survey_question_list, ddb_question_list):
+        """
+        Compares interview questions parsed from a survey definition with those stored in Dynamodb
+
+        Args:
+            survey_question_list (list): InterviewQuestion instances
+            ddb_question_list (list): InterviewQuestions items loaded from Dynamodb
+
+        Returns:
+            Dictionary of added, updated and unchanged InterviewQuestion instances, and of
+            deleted Dynamodb items
+        """
+        ddb_hashes = {
+            q["question_id"]: q.get("content_hash") for q in ddb_question_list
+        }
+        diff = {
+            "added": list(),
+            "updated": list(),
+            "unchanged": list(),
+            "deleted": list(),
+        }
+        survey_question_ids = set()
+        for q in survey_question_list:
+            survey_question_ids.add(q._question_id)
+            try:
+                ddb_hash = ddb_hashes[q._question_id]
+            except KeyError:
+                diff["added"].append(q)
+                continue
+            if ddb_hash == q.content_hash:
+                diff["unchanged"].append(q)
+            else:
+                diff["updated"].append(q)
+        diff["deleted"] = [
+            q for q in ddb_question_list if q["question_id"] not in survey_question_ids
+        ]
+        return diff
+
     def ddb_update_interview_questions(self):
         """
         Updates the list of interview questions held in Dynamodb for a particular survey.
         This includes not only adding and updating questions, but also deleting questions that are no longer
-        present in the survey
+        present in the survey. Only questions whose content has changed are written.
+
+        Returns:
+            Dictionary of added, updated, unchanged and deleted question ids
         """
         ddb_question_list = self.ddb_load_interview_questions(self.survey_id)
         survey_question_list = self.get_interview_question_list_from_Qualtrics()
-        updated_question_ids = list()
-        deleted_question_ids = list()
-        for q in survey_question_list:
-            self.ddb_client.put_item(
+        diff = self.diff_interview_questions(survey_question_list, ddb_question_list)
+
+        items_to_put = [q.as_ddb_item() for q in diff["added"] + diff["updated"]]
+        if items_to_put:
+            self.ddb_client.batch_put_items(
                 table_name=const.INTERVIEW_QUESTIONS_TABLE["name"],
-                key=q._survey_id,
-                key_name=const.INTERVIEW_QUESTIONS_TABLE["partition_key"],
+                items=items_to_put,
+                partition_key_name=const.INTERVIEW_QUESTIONS_TABLE["partition_key"],
                 item_type="interview_question",
-                item_details=None,
-                item=q.as_dict(),
-                update_allowed=True,
-                sort_key={
-                    const.INTERVIEW_QUESTIONS_TABLE["sort_key"]: q._question_id,
-                },
             )
-            updated_question_ids.append(q._question_id)
-
-        for q in ddb_question_list:
-            question_id = q["question_id"]
-            if question_id not in updated_question_ids:
-                self.ddb_client.delete_item(
-                    table_name=const.INTERVIEW_QUESTIONS_TABLE["name"],
-                    key=q["survey_id"],
-                    key_name=const.INTERVIEW_QUESTIONS_TABLE["partition_key"],
-                    sort_key={
-                        const.INTERVIEW_QUESTIONS_TABLE["sort_key"]: question_id,
-                    },
-                )
-                deleted_question_ids.append(question_id)
 
-        return updated_question_ids, deleted_question_ids
+        if diff["deleted"]:
+            table = self.ddb_client.get_table(
+                table_name=const.INTERVIEW_QUESTIONS_TABLE["name"]
+            )
+            with table.batch_writer() as batch:
+                for q in diff["deleted"]:
+                    batch.delete_item(
+                        Key={
+                            const.INTERVIEW_QUESTIONS_TABLE["partition_key"]: q[
+                                "survey_id"
+                            ],
+                            const.INTERVIEW_QUESTIONS_TABLE["sort_key"]: q[
+                                "question_id"
+                            ],
+                        }
+                    )
+
+        if survey_question_list:
+            body = self.build_interview_questions_document(
+                self.survey_id, [q.as_ddb_item() for q in survey_question_list]
+            )
+            self.ddb_dump_interview_questions_document(
+                body, correlation_id=self.correlation_id
+            )
+        else:
+            # survey no longer has interview questions; GET requests should now 404
+            self.ddb_delete_interview_questions_document(
+                self.survey_id, correlation_id=self.correlation_id
+            )
+        interview_questions_cache.pop(self.survey_id)
+
+        summary = {
+            "survey_id": self.survey_id,
+            "survey_modified": self.modified,
+            "added": [q._question_id for q in diff["added"]],
+            "updated": [q._question_id for q in diff["updated"]],
+            "unchanged": [q._question_id for q in diff["unchanged"]],
+            "deleted": [q["question_id"] for q in diff["deleted"]],
+        }
+        self.logger.info(
+            "Interview questions synced",
+            extra={
+                "summary": summary,
+            },
+        )
+        return summary
 
     @staticmethod
     def ddb_load_interview_questions(survey_id):
-        ddb_client = Dynamodb(stack_name=const.STACK_NAME)
+        ddb_client = thiscovery_clients.get_ddb_client()
         return ddb_client.query(
             table_name=const.INTERVIEW_QUESTIONS_TABLE["name"],
             KeyConditionExpression="survey_id = :survey_id",
@@ -220,18 +340,27 @@ class SurveyDefinition:
         )
 
     @staticmethod
-    def get_interview_questions(survey_id):
-        interview_questions = SurveyDefinition.ddb_load_interview_questions(survey_id)
+    def build_interview_questions_document(survey_id, interview_questions):
+        """
+        Groups interview questions into blocks, in the order defined by their sequence_no
+
+        Args:
+            survey_id:
+            interview_questions (list): InterviewQuestions items
 
+        Returns:
+            Body of GET /v1/interview-questions/{id} responses
+        """
         try:
-            survey_modified = interview_questions[0]["survey_modified"]
-        except IndexError:
+            # questions whose content did not change keep the survey_modified of their last sync
+            survey_modified = max(iq["survey_modified"] for iq in interview_questions)
+        except ValueError:
             raise utils.ObjectDoesNotExistError(
                 f"No interview questions found for survey {survey_id}", details={}
             )
 
         block_dict = dict()
-        for iq in interview_questions:
+        for iq in sorted(interview_questions, key=lambda x: int(x["sequence_no"])):
             block_id = iq["block_id"]
 
             try:
@@ -262,3 +391,67 @@ class SurveyDefinition:
         }
 
         return body
+
+    @staticmethod
+    def ddb_dump_interview_questions_document(body, correlation_id=None):
+        """
+        Stores a compressed copy of the interview questions document of a survey in the Cache table
+        """
+        return DdbCache(
+            item_type=INTERVIEW_QUESTIONS_DOCUMENT_ITEM_TYPE,
+            correlation_id=correlation_id,
+        ).safe_put(
+            body["survey_id"],
+            {
+                "survey_modified": body["modified"],
+                "document": zlib.compress(json.dumps(body).encode("utf-8")),
+            },
+        )
+
+    @staticmethod
+    def ddb_delete_interview_questions_document(survey_id, correlation_id=None):
+        return DdbCache(
+            item_type=INTERVIEW_QUESTIONS_DOCUMENT_ITEM_TYPE,
+            correlation_id=correlation_id,
+        ).delete(survey_id)
+
+    @staticmethod
+    def ddb_load_interview_questions_document(survey_id, correlation_id=None):
+        stored = DdbCache(
+            item_type=INTERVIEW_QUESTIONS_DOCUMENT_ITEM_TYPE,
+            correlation_id=correlation_id,
+        ).safe_get(survey_id)
+        if not stored:
+            return None
+        document = stored["document"]
+        document = getattr(document, "value", document)  # unwrap boto3 Binary
+        return json.loads(zlib.decompress(document).decode("utf-8"))
+
+    @staticmethod
+    def get_interview_questions(survey_id, correlation_id=None):
+        """
+        Returns the interview questions document of a survey. Documents are materialised
+        when surveys are synced and kept in memory for INTERVIEW_QUESTIONS_CACHE_TTL
+        seconds. If a survey has no stored document, one is built from the
+        InterviewQuestions table and stored.
+        """
+        body = interview_questions_cache.get(survey_id)
+        if body is not None:
+            return body
+
+        body = SurveyDefinition.ddb_load_interview_questions_document(
+            survey_id, correlation_id=correlation_id
+        )
+        if body is None:
+            interview_questions = SurveyDefinition.ddb_load_interview_questions(
+                survey_id
+            )
+            body = SurveyDefinition.build_interview_questions_document(
+                survey_id, interview_questions
+            )
+            SurveyDefinition.ddb_dump_interview_questions_document(
+                body, correlation_id=correlation_id
+            )
+
+        interview_questions_cache.put(survey_id, body)
+        return body
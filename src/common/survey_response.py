@@ -15,14 +15,106 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import io
 import json
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
 import thiscovery_lib.utilities as utils
 
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
-from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.qualtrics import ResponsesClient
 
 import common.constants as const
+from common.cache import DdbCache, LruCache
+from common.clients import (
+    PooledSessionMixin,
+    qualtrics_clients,
+    thiscovery_clients,
+)
+
+
+class ProjectTaskIndex:
+    """
+    Set of all project task ids known to the core API, kept for the lifetime of
+    a warm Lambda container.
+
+    Lookups are served from memory and the index is refreshed synchronously, by
+    the lookup that finds it older than ttl seconds. Refreshes happen in-request
+    rather than in a background thread because Lambda freezes containers between
+    invocations, so a background thread gives no freshness guarantee.
+
+    If an id is not found, the index is also refreshed once, so that tasks created
+    after the last refresh are still recognised; to stop requests with invalid ids
+    from downloading the index every time, such refreshes happen at most once
+    every min_refresh_interval seconds.
+    """
+
+    def __init__(
+        self,
+        ttl=const.PROJECT_TASK_INDEX_TTL,
+        min_refresh_interval=const.PROJECT_TASK_INDEX_MIN_REFRESH_INTERVAL,
+    ):
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._project_task_ids = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        if self._project_task_ids is None:
+            return 0
+        return len(self._project_task_ids)
+
+    @staticmethod
+    def _fetch_project_task_ids(correlation_id=None):
+        env_name = utils.get_environment_name()
+        if env_name == "prod":
+            core_api_url = "https://api.thiscovery.org/"
+        else:
+            core_api_url = f"https://{env_name}-api.thiscovery.org/"
+        result = utils.aws_get(
+            endpoint_url="v1/project",
+            base_url=core_api_url,
+        )
+        assert (
+            result["statusCode"] == HTTPStatus.OK
+        ), f"Call to core API returned error: {result}"
+        projects = json.loads(result["body"])
+        return frozenset(t["id"] for p in projects for t in p["tasks"])
+
+    def _age(self):
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def is_stale(self):
+        return self._loaded_at is None or self._age() > self.ttl
+
+    def refresh(self, correlation_id=None):
+        project_task_ids = self._fetch_project_task_ids(correlation_id=correlation_id)
+        with self._lock:
+            self._project_task_ids = project_task_ids
+            self._loaded_at = time.monotonic()
+
+    def contains(self, project_task_id, correlation_id=None):
+        if self.is_stale():
+            self.refresh(correlation_id=correlation_id)
+
+        if project_task_id in self._project_task_ids:
+            return True
+
+        # id might belong to a task created after the last refresh
+        if self._age() < self.min_refresh_interval:
+            return False
+        self.refresh(correlation_id=correlation_id)
+        return project_task_id in self._project_task_ids
+
+
+project_task_index = ProjectTaskIndex()
 
 
 class SurveyResponse:
@@ -55,36 +147,17 @@ class SurveyResponse:
                     },
                 )
         self.response_dict = response_dict
-        self.ddb_client = Dynamodb(
-            stack_name=const.STACK_NAME,
-            correlation_id=correlation_id,
-        )
+        self.ddb_client = thiscovery_clients.get_ddb_client()
         self.correlation_id = correlation_id
 
     def check_project_task_exists(self):
-        env_name = utils.get_environment_name()
-        if env_name == "prod":
-            core_api_url = "https://api.thiscovery.org/"
-        else:
-            core_api_url = f"https://{env_name}-api.thiscovery.org/"
-        result = utils.aws_get(
-            endpoint_url="v1/project",
-            base_url=core_api_url,
-        )
-        assert (
-            result["statusCode"] == HTTPStatus.OK
-        ), f"Call to core API returned error: {result}"
-        projects = json.loads(result["body"])
-        project_task_ids = list()
-        for p in projects:
-            tasks = p["tasks"]
-            for t in tasks:
-                project_task_ids.append(t["id"])
-        if self.project_task_id not in project_task_ids:
+        if not project_task_index.contains(
+            self.project_task_id, correlation_id=self.correlation_id
+        ):
             raise utils.ObjectDoesNotExistError(
                 f"Project tasks id {self.project_task_id} not found in Thiscovery database",
                 details={
-                    "project_task_ids": project_task_ids,
+                    "project_task_ids_count": len(project_task_index),
                     "correlation_id": self.correlation_id,
                 },
             )
@@ -104,24 +177,150 @@ class SurveyResponse:
                 "anon_user_task_id": self.anon_user_task_id,
             },
             update_allowed=True,
+            correlation_id=self.correlation_id,
         )
 
 
+class SurveySchemaCache:
+    """
+    Question id to export tag mappings of surveys, so that SurveyClient
+    instances do not download the survey response schema from Qualtrics every
+    time they are created.
+
+    Unlike user task or link mappings, a schema changes whenever its survey is
+    edited, so mappings are only kept for ttl seconds, after which the schema is
+    downloaded again. If persist is True, mappings are also shared with other
+    containers through the Cache table, where they expire after ttl seconds too.
+    """
+
+    item_type = "survey_response_schema"
+
+    def __init__(self, ttl=const.SURVEY_SCHEMA_CACHE_TTL, maxsize=128, persist=True):
+        self.ttl = ttl
+        self.persist = persist
+        self._entries = LruCache(maxsize=maxsize, ttl=ttl)
+
+    def clear(self):
+        self._entries.clear()
+
+    @staticmethod
+    def _parse_schema(responses_schema):
+        return {
+            k: v["exportTag"]
+            for k, v in responses_schema["result"]["properties"]["values"][
+                "properties"
+            ].items()
+        }
+
+    def get_question_ids_to_export_tags(
+        self, survey_id, responses_client, correlation_id=None
+    ):
+        """
+        Args:
+            survey_id:
+            responses_client (ResponsesClient): Client used to fetch the survey response schema on cache misses
+            correlation_id:
+
+        Returns:
+            Dictionary mapping Qualtrics question ids to export tags
+        """
+        question_ids_to_export_tags = self._entries.get(survey_id)
+        if question_ids_to_export_tags is not None:
+            return question_ids_to_export_tags
+
+        ddb_cache = None
+        if self.persist:
+            ddb_cache = DdbCache(
+                item_type=self.item_type, ttl=self.ttl, correlation_id=correlation_id
+            )
+            question_ids_to_export_tags = ddb_cache.safe_get(survey_id)
+
+        if question_ids_to_export_tags is None:
+            question_ids_to_export_tags = self._parse_schema(
+                responses_client.retrieve_survey_response_schema()
+            )
+            if ddb_cache is not None:
+                ddb_cache.safe_put(survey_id, question_ids_to_export_tags)
+
+        self._entries.put(survey_id, question_ids_to_export_tags)
+        return question_ids_to_export_tags
+
+
+survey_schema_cache = SurveySchemaCache()
+
+
+class ExportTagProjection:
+    """
+    Converts Qualtrics response values keyed by question id into values keyed by
+    export tag, in a single pass over the response.
+
+    The work that only depends on the survey schema and on the export_tags and
+    return_nulls arguments (filtering the schema down to the requested export tags
+    and building the dictionary of null values) is done once, when the projection
+    is created.
+    """
+
+    def __init__(
+        self, question_ids_to_export_tags, export_tags=None, return_nulls=True
+    ):
+        """
+        Args:
+            question_ids_to_export_tags (dict): Survey schema, as held by SurveyClient
+            export_tags (list): Export tags to include in output. If None, all are included
+            return_nulls (bool): If True, output includes export tags of null responses
+        """
+        if export_tags is None:
+            self.slots = dict(question_ids_to_export_tags)
+        else:
+            wanted = frozenset(export_tags)
+            self.slots = {
+                k: v for k, v in question_ids_to_export_tags.items() if v in wanted
+            }
+        self.nulls = None
+        if return_nulls is True:
+            self.nulls = dict.fromkeys(self.slots.values())
+
+    def __call__(self, values_dict_by_id):
+        if self.nulls is None:
+            values_dict_by_export_tag = dict()
+        else:
+            values_dict_by_export_tag = self.nulls.copy()
+        slots = self.slots
+        for k, v in values_dict_by_id.items():
+            export_tag = slots.get(k)
+            if export_tag is not None:
+                values_dict_by_export_tag[export_tag] = v
+        return values_dict_by_export_tag
+
+
 class SurveyClient:
     def __init__(self, survey_id, correlation_id=None):
         self.survey_id = survey_id
         self.correlation_id = correlation_id
-        self.responses_client = ResponsesClient(
-            survey_id=survey_id, correlation_id=correlation_id
+        self.responses_client = qualtrics_clients.get_client(
+            ResponsesClient, survey_id=survey_id
         )
-        self.responses_schema = self.responses_client.retrieve_survey_response_schema()
-        # self.export_tags_to_question_ids = {v['exportTag']: k for k, v in self.responses_schema['result']['properties']['values']['properties'].items()}
-        self.question_ids_to_export_tags = {
-            k: v["exportTag"]
-            for k, v in self.responses_schema["result"]["properties"]["values"][
-                "properties"
-            ].items()
-        }
+        self.question_ids_to_export_tags = (
+            survey_schema_cache.get_question_ids_to_export_tags(
+                survey_id=survey_id,
+                responses_client=self.responses_client,
+                correlation_id=correlation_id,
+            )
+        )
+        self._projections = dict()
+        self._responses_schema = None
+
+    @property
+    def responses_schema(self):
+        """
+        Survey response schema, retrieved from Qualtrics on first access (the
+        question id to export tag mapping itself comes from survey_schema_cache)
+        """
+        if self._responses_schema is None:
+            self._responses_schema = (
+                self.responses_client.retrieve_survey_response_schema()
+            )
+        return self._responses_schema
 
     def get_response(self, response_id, export_tags=None, return_nulls=True):
         """
@@ -136,18 +335,215 @@ class SurveyClient:
             Dictionary containing export_tag, response_value pairs for each survey question
         """
         r = self.responses_client.retrieve_response(response_id=response_id)
-        values_dict_by_id = r["result"]["values"]
-        values_dict_by_export_tag = {
-            self.question_ids_to_export_tags[k]: v for k, v in values_dict_by_id.items()
-        }
+        return self._to_export_tags(
+            values_dict_by_id=r["result"]["values"],
+            export_tags=export_tags,
+            return_nulls=return_nulls,
+        )
 
-        if return_nulls is True:
-            for _, v in self.question_ids_to_export_tags.items():
-                if v not in values_dict_by_export_tag.keys():
-                    values_dict_by_export_tag[v] = None
+    def get_projection(self, export_tags=None, return_nulls=True):
+        """
+        Returns the ExportTagProjection for this survey's schema and the given arguments,
+        compiling it on first use
+        """
+        key = (
+            None if export_tags is None else tuple(export_tags),
+            return_nulls is True,
+        )
+        try:
+            return self._projections[key]
+        except KeyError:
+            projection = ExportTagProjection(
+                question_ids_to_export_tags=self.question_ids_to_export_tags,
+                export_tags=export_tags,
+                return_nulls=return_nulls,
+            )
+            self._projections[key] = projection
+            return projection
 
-        if export_tags is not None:
-            values_dict_by_export_tag = {
-                k: v for k, v in values_dict_by_export_tag.items() if k in export_tags
-            }
-        return values_dict_by_export_tag
+    def _to_export_tags(self, values_dict_by_id, export_tags=None, return_nulls=True):
+        return self.get_projection(export_tags=export_tags, return_nulls=return_nulls)(
+            values_dict_by_id
+        )
+
+    def get_responses(
+        self,
+        response_ids,
+        export_tags=None,
+        return_nulls=True,
+        max_workers=const.RESPONSE_BATCH_MAX_WORKERS,
+    ):
+        """
+        Retrieves multiple responses concurrently. Failure to retrieve a response does not
+        affect the others; it is reported in the errors dictionary instead.
+
+        Args:
+            response_ids (list): Ids of responses to retrieve
+            export_tags (list): Same as get_response
+            return_nulls (bool): Same as get_response
+            max_workers (int): Maximum number of concurrent calls to Qualtrics
+
+        Returns:
+            Tuple (responses, errors) of dictionaries keyed by response_id. Values in
+            responses are the output of get_response; values in errors are error messages
+        """
+        logger = utils.get_logger()
+
+        def get_one(response_id):
+            try:
+                return (
+                    response_id,
+                    self.get_response(
+                        response_id=response_id,
+                        export_tags=export_tags,
+                        return_nulls=return_nulls,
+                    ),
+                    None,
+                )
+            except Exception as err:
+                logger.error(
+                    "Failed to retrieve response",
+                    extra={
+                        "survey_id": self.survey_id,
+                        "response_id": response_id,
+                        "correlation_id": self.correlation_id,
+                    },
+                    exc_info=True,
+                )
+                return response_id, None, str(err)
+
+        responses = dict()
+        errors = dict()
+        unique_response_ids = list(dict.fromkeys(response_ids))
+        workers = max(1, min(max_workers, len(unique_response_ids)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for response_id, response, error in executor.map(
+                get_one, unique_response_ids
+            ):
+                if error is None:
+                    responses[response_id] = response
+                else:
+                    errors[response_id] = error
+        return responses, errors
+
+    def export_responses(self, export_tags=None, return_nulls=True, **export_options):
+        """
+        Retrieves all responses to the survey in a single Qualtrics export job. Responses are
+        decoded from the downloaded export one at a time, so memory use does not grow with
+        the number of responses.
+
+        Args:
+            export_tags (list): Same as get_response
+            return_nulls (bool): Same as get_response
+            **export_options: Additional parameters of the Qualtrics export request (e.g. startDate, filterId)
+
+        Yields:
+            (response_id, dictionary of export_tag, response_value pairs) tuples
+        """
+        export_client = qualtrics_clients.get_client(
+            ResponseExportClient, survey_id=self.survey_id
+        )
+        for response in export_client.export(
+            correlation_id=self.correlation_id, **export_options
+        ):
+            yield response["responseId"], self._to_export_tags(
+                values_dict_by_id=response["values"],
+                export_tags=export_tags,
+                return_nulls=return_nulls,
+            )
+
+
+class ResponseExportClient(PooledSessionMixin, ResponsesClient):
+    """
+    Client for the Qualtrics export-responses job API
+    https://api.qualtrics.com/api-reference/reference/responseImportsExports.json
+    """
+
+    def _export_endpoint(self, *path):
+        return "/".join(
+            [f"{self.base_url}surveys/{self.survey_id}/export-responses", *path]
+        )
+
+    def start_export(self, **export_options):
+        body = {"format": "ndjson", "compress": True, **export_options}
+        r = self.qualtrics_request("POST", self._export_endpoint(), data=body)
+        return r["result"]["progressId"]
+
+    def wait_for_export(
+        self,
+        progress_id,
+        poll_interval=const.RESPONSE_EXPORT_POLL_INTERVAL,
+        timeout=const.RESPONSE_EXPORT_TIMEOUT,
+        correlation_id=None,
+    ):
+        """
+        Polls an export job until it completes
+
+        Returns:
+            The fileId of the completed export
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            r = self.qualtrics_request("GET", self._export_endpoint(progress_id))
+            result = r["result"]
+            status = result["status"]
+            if status == "complete":
+                return result["fileId"]
+            if status == "failed":
+                raise utils.DetailedValueError(
+                    "Qualtrics response export failed",
+                    details={
+                        "survey_id": self.survey_id,
+                        "response": r,
+                        "correlation_id": correlation_id,
+                    },
+                )
+            if time.monotonic() > deadline:
+                raise utils.DetailedValueError(
+                    f"Qualtrics response export did not complete within {timeout} seconds",
+                    details={
+                        "survey_id": self.survey_id,
+                        "progress_id": progress_id,
+                        "percent_complete": result.get("percentComplete"),
+                        "correlation_id": correlation_id,
+                    },
+                )
+            time.sleep(poll_interval)
+
+    def download_export(self, file_id, fileobj):
+        with self.session.get(
+            self._export_endpoint(file_id, "file"),
+            headers={"X-API-TOKEN": self.api_key},
+            stream=True,
+        ) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, fileobj)
+        fileobj.seek(0)
+
+    @staticmethod
+    def iter_export_file(fileobj):
+        """
+        Decodes a compressed ndjson export one response at a time
+        """
+        with zipfile.ZipFile(fileobj) as zf:
+            for name in zf.namelist():
+                with io.TextIOWrapper(zf.open(name), encoding="utf-8") as f:
+                    for line in f:
+                        if line.strip():
+                            yield json.loads(line)
+
+    def export(self, correlation_id=None, **export_options):
+        """
+        Runs a complete export job
+
+        Yields:
+            Qualtrics response dictionaries, with question values keyed by question id
+        """
+        progress_id = self.start_export(**export_options)
+        file_id = self.wait_for_export(progress_id, correlation_id=correlation_id)
+        with tempfile.SpooledTemporaryFile(
+            max_size=const.RESPONSE_EXPORT_SPOOL_SIZE
+        ) as f:
+            self.download_export(file_id, f)
+            yield from self.iter_export_file(f)
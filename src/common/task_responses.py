@@ -16,11 +16,11 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import thiscovery_lib.utilities as utils
-from thiscovery_lib.dynamodb_utilities import Dynamodb
-from thiscovery_lib.core_api_utilities import CoreApiClient
 
 import common.constants as const
+from common.clients import thiscovery_clients
 from common.ddb_base_item import DdbBaseItem
+from common.project_resolver import project_resolver
 
 
 class TaskResponse(DdbBaseItem):
@@ -45,10 +45,7 @@ class TaskResponse(DdbBaseItem):
         self._detail_type = detail_type
         self._detail = detail
         self._correlation_id = correlation_id
-        self._core_client = CoreApiClient(correlation_id=correlation_id)
-        self._ddb_client = Dynamodb(
-            stack_name=const.STACK_NAME, correlation_id=correlation_id
-        )
+        self._ddb_client = thiscovery_clients.get_ddb_client()
         self.project_task_id = None
 
     @classmethod
@@ -79,10 +76,10 @@ class TaskResponse(DdbBaseItem):
         )
 
     def get_project_task_id(self):
-        user_task = self._core_client.get_user_task_from_anon_user_task_id(
-            anon_user_task_id=self.anon_user_task_id
+        self.project_task_id = project_resolver.get_project_task_id(
+            anon_user_task_id=self.anon_user_task_id,
+            correlation_id=self._correlation_id,
         )
-        self.project_task_id = user_task["project_task_id"]
 
     def ddb_dump(self, update_allowed=False, unpack_detail=False):
         item = self.as_dict()
@@ -98,4 +95,5 @@ class TaskResponse(DdbBaseItem):
             update_allowed=update_allowed,
             key_name=const.TASK_RESPONSES_TABLE["partition_key"],
             sort_key={const.TASK_RESPONSES_TABLE["sort_key"]: self._event_time},
+            correlation_id=self._correlation_id,
         )
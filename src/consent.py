@@ -15,22 +15,36 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import copy
+import datetime
 import json
+import threading
+import time
 import traceback
 import uuid
+import thiscovery_lib.eb_utilities as eb
 import thiscovery_lib.utilities as utils
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import parser
 from http import HTTPStatus
 from thiscovery_lib.core_api_utilities import CoreApiClient
-from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.qualtrics import qualtrics2thiscovery_timestamp
+from typing import Optional
 
 from common.constants import (
-    STACK_NAME,
     CONSENT_DATA_TABLE,
+    CONSENT_EMAIL_ASYNC,
+    CONSENT_EMAIL_CLAIM_TIMEOUT_SECONDS,
+    CONSENT_EMAIL_EVENT,
     DEFAULT_CONSENT_EMAIL_TEMPLATE,
     CONSENT_ROWS_IN_TEMPLATE,
 )
+from common.clients import thiscovery_clients
+from common.project_resolver import project_resolver
+
+CONSENT_ITEM_TYPE = "qualtrics-consent-data"
 
 
 class Consent:
@@ -52,10 +66,8 @@ class Consent:
         self.consent_statements = None
         self.modified = None  # flag used in ddb_load method to check if ddb data was already fetched
         self._correlation_id = correlation_id
-        self._ddb_client = Dynamodb(stack_name=STACK_NAME)
+        self._ddb_client = thiscovery_clients.get_ddb_client()
         self._core_api_client = core_api_client
-        if core_api_client is None:
-            self._core_api_client = CoreApiClient(correlation_id=correlation_id)
 
     def as_dict(self):
         return {
@@ -73,10 +85,11 @@ class Consent:
             table_name=CONSENT_DATA_TABLE,
             key=self.project_task_id,
             key_name="project_task_id",
-            item_type="qualtrics-consent-data",
+            item_type=CONSENT_ITEM_TYPE,
             item_details=dict(),
             item=self.as_dict(),
             update_allowed=update_allowed,
+            correlation_id=self._correlation_id,
         )["ResponseMetadata"]["HTTPStatusCode"]
         assert result == HTTPStatus.OK
         return result
@@ -104,26 +117,225 @@ class Consent:
             else:
                 return HTTPStatus.OK
 
+    def _key(self):
+        return {"project_task_id": self.project_task_id, "consent_id": self.consent_id}
+
+    def claim_notification(self) -> Optional[int]:
+        """
+        Records in Dynamodb that the participant is being e-mailed about this consent.
+        Call before sending the e-mail: only the caller whose claim succeeds may send
+        it, and must then call mark_notification_sent (or release_notification_claim
+        if sending fails). Claims left by invocations that ended before either call
+        expire after CONSENT_EMAIL_CLAIM_TIMEOUT_SECONDS and can be made again.
+
+        Returns:
+            The notification_claimed_at value written, or None if the participant
+            has already been e-mailed
+
+        Raises:
+            ObjectDoesNotExistError if the consent is not in Dynamodb
+            DetailedValueError if another delivery holds an unexpired claim
+        """
+        claimed_at = int(time.time())
+        table = self._ddb_client.get_table(table_name=CONSENT_DATA_TABLE)
+        try:
+            table.update_item(
+                Key=self._key(),
+                UpdateExpression="SET notification_claimed_at = :claimed_at",
+                ConditionExpression=Attr("consent_id").exists()
+                & Attr("notification_sent").not_exists()
+                & (
+                    Attr("notification_claimed_at").not_exists()
+                    | Attr("notification_claimed_at").lt(
+                        claimed_at - CONSENT_EMAIL_CLAIM_TIMEOUT_SECONDS
+                    )
+                ),
+                ExpressionAttributeValues={":claimed_at": claimed_at},
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            item = table.get_item(Key=self._key(), ConsistentRead=True).get("Item")
+            if item is None:
+                raise utils.ObjectDoesNotExistError(
+                    f"Consent item {self.project_task_id}, {self.consent_id} could not be found in Dynamodb",
+                    details={
+                        "consent_dict": self.as_dict(),
+                        "correlation_id": self._correlation_id,
+                    },
+                )
+            if "notification_sent" in item:
+                return None
+            raise utils.DetailedValueError(
+                "Consent e-mail is being sent by another delivery",
+                details={
+                    "consent_dict": self.as_dict(),
+                    "notification_claimed_at": item.get("notification_claimed_at"),
+                    "correlation_id": self._correlation_id,
+                },
+            )
+        return claimed_at
+
+    def mark_notification_sent(self) -> None:
+        """
+        Records in Dynamodb that the participant has been e-mailed about this consent
+        """
+        table = self._ddb_client.get_table(table_name=CONSENT_DATA_TABLE)
+        table.update_item(
+            Key=self._key(),
+            UpdateExpression="SET notification_sent = :notification_sent "
+            "REMOVE notification_claimed_at",
+            ExpressionAttributeValues={":notification_sent": str(utils.now_with_tz())},
+        )
+
+    def release_notification_claim(self, claimed_at: int) -> None:
+        """
+        Removes a claim made by claim_notification whose e-mail could not be sent,
+        so that a later delivery can send it
+        """
+        table = self._ddb_client.get_table(table_name=CONSENT_DATA_TABLE)
+        try:
+            table.update_item(
+                Key=self._key(),
+                UpdateExpression="REMOVE notification_claimed_at",
+                ConditionExpression=Attr("notification_claimed_at").eq(claimed_at),
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
     def _get_project_task_id(self):
         if self.project_task_id is None:
-            self.project_task_id = (
-                self._core_api_client.get_user_task_from_anon_user_task_id(
-                    anon_user_task_id=self.anon_user_task_id
-                )["project_task_id"]
+            self.project_task_id = project_resolver.get_project_task_id(
+                anon_user_task_id=self.anon_user_task_id,
+                core_api_client=self._core_api_client,
+                correlation_id=self._correlation_id,
             )
             assert self.project_task_id
 
     def _get_project(self):
         if self.project_id is None:
             self._get_project_task_id()
-            project = self._core_api_client.get_project_from_project_task_id(
-                project_task_id=self.project_task_id
+            project = project_resolver.get_project(
+                project_task_id=self.project_task_id,
+                core_api_client=self._core_api_client,
+                correlation_id=self._correlation_id,
             )
             self.project_id = project["id"]
             self.project_short_name = project["name"]
             self.project_name = project["name"]
 
 
+class ConsentEmailPropertyBuilder:
+    """
+    Builds the custom properties of consent e-mails. The padded table of
+    consent_row_NN and consent_value_NN properties of a template is computed once,
+    when its builder is created, so building the properties of a consent only
+    copies that table and fills in the rows the consent has.
+
+    Use for_template to get the (shared) builder of a template.
+    """
+
+    _builders = dict()
+    _builders_lock = threading.Lock()
+
+    def __init__(self, rows_in_template=CONSENT_ROWS_IN_TEMPLATE):
+        self.rows_in_template = rows_in_template
+        self.row_keys = tuple(
+            f"consent_row_{n:02}" for n in range(1, rows_in_template + 1)
+        )
+        self.value_keys = tuple(
+            f"consent_value_{n:02}" for n in range(1, rows_in_template + 1)
+        )
+        self.empty_rows = dict()
+        for row_key, value_key in zip(self.row_keys, self.value_keys):
+            self.empty_rows[row_key] = str()
+            self.empty_rows[value_key] = str()
+
+    @classmethod
+    def for_template(cls, template_name):
+        try:
+            return cls._builders[template_name]
+        except KeyError:
+            with cls._builders_lock:
+                builder = cls._builders.get(template_name)
+                if builder is None:
+                    builder = cls()
+                    cls._builders[template_name] = builder
+                return builder
+
+    def consent_rows(self, consent_statements, correlation_id=None) -> dict:
+        """
+        Args:
+            consent_statements (list): Dictionaries mapping each consent statement to the participant's answer
+            correlation_id:
+
+        Returns:
+            consent_row_NN and consent_value_NN properties, padded with empty strings
+            up to the number of rows in the template
+        """
+        if len(consent_statements) > self.rows_in_template:
+            raise utils.DetailedValueError(
+                "Number of consent statements exceeds maximum supported by template",
+                details={
+                    "len_consent_statements": len(consent_statements),
+                    "consent_statements": consent_statements,
+                    "rows_in_template": self.rows_in_template,
+                    "correlation_id": correlation_id,
+                },
+            )
+        properties = self.empty_rows.copy()
+        for row_key, value_key, statement_dict in zip(
+            self.row_keys, self.value_keys, consent_statements
+        ):
+            properties[row_key], properties[value_key] = next(
+                iter(statement_dict.items())
+            )
+        return properties
+
+    @staticmethod
+    def to_datetime(consent_datetime) -> datetime.datetime:
+        """
+        Args:
+            consent_datetime: datetime, or thiscovery timestamp (e.g. "2020-11-17 10:39:58+00:00")
+        """
+        if isinstance(consent_datetime, datetime.datetime):
+            return consent_datetime
+        try:
+            return datetime.datetime.fromisoformat(consent_datetime)
+        except ValueError:
+            return parser.parse(consent_datetime)
+
+    def date_and_time(self, consent_datetime) -> tuple:
+        consent_dt = self.to_datetime(consent_datetime)
+        return consent_dt.strftime("%e %B %Y"), consent_dt.strftime("%H:%M")
+
+    def email_dict(
+        self,
+        consent_statements,
+        consent_datetime,
+        user_first_name,
+        consent_info_url,
+        project_short_name,
+        correlation_id=None,
+    ) -> dict:
+        """
+        Returns:
+            E-mail dictionary (without recipient) to pass to send_transactional_email
+        """
+        properties = self.consent_rows(
+            consent_statements, correlation_id=correlation_id
+        )
+        properties["user_first_name"] = user_first_name
+        properties["consent_info_url"] = consent_info_url
+        properties["project_short_name"] = project_short_name
+        (
+            properties["current_date"],
+            properties["current_time"],
+        ) = self.date_and_time(consent_datetime)
+        return {"custom_properties": properties}
+
+
 class ConsentEvent:
     def __init__(self, survey_consent_event):
         self.logger = survey_consent_event["logger"]
@@ -143,59 +355,105 @@ class ConsentEvent:
             self.template_name = DEFAULT_CONSENT_EMAIL_TEMPLATE
         else:
             del consent_dict["template_name"]
+        self.async_notification = self._to_bool(
+            consent_dict.pop("async_notification", CONSENT_EMAIL_ASYNC),
+            attribute_name="async_notification",
+        )
+        # typed consent datetime, parsed once and passed to the e-mail as is
         try:
             consent_dict["consent_datetime"] = qualtrics2thiscovery_timestamp(
                 consent_dict["consent_datetime"]
             )
         except KeyError:
-            consent_dict["consent_datetime"] = str(utils.now_with_tz())
+            self.consent_dt = utils.now_with_tz()
+            consent_dict["consent_datetime"] = str(self.consent_dt)
+        else:
+            self.consent_dt = ConsentEmailPropertyBuilder.to_datetime(
+                consent_dict["consent_datetime"]
+            )
         self.core_api_client = CoreApiClient(correlation_id=self.correlation_id)
         self.consent = Consent(
             core_api_client=self.core_api_client, correlation_id=self.correlation_id
         )
         self.consent.from_dict(consent_dict=consent_dict)
 
+    def _to_bool(self, value, attribute_name) -> bool:
+        """
+        Parses a boolean attribute of the request body, which Qualtrics may send as
+        a JSON boolean or as a "true" or "false" string
+        """
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+            return value.strip().lower() == "true"
+        raise utils.DetailedValueError(
+            f"{attribute_name} must be true or false",
+            details={
+                attribute_name: value,
+                "correlation_id": self.correlation_id,
+            },
+        )
+
+    @classmethod
+    def from_email_request(cls, email_request, logger, correlation_id=None):
+        """
+        Rebuilds the ConsentEvent of a queued consent e-mail. The consent itself
+        is not fetched from Dynamodb; call consent.ddb_load for that, and then set
+        consent_dt from the loaded consent_datetime.
+
+        Args:
+            email_request (dict): Detail of a consent_email_requested event
+            logger:
+            correlation_id:
+        """
+        consent_event = cls.__new__(cls)
+        consent_event.logger = logger
+        consent_event.correlation_id = correlation_id
+        consent_event.participant_first_name = email_request["first_name"]
+        consent_event.consent_info_url = email_request["consent_info_url"]
+        consent_event.template_name = email_request["template_name"]
+        consent_event.async_notification = False
+        consent_event.consent_dt = None
+        consent_event.core_api_client = CoreApiClient(correlation_id=correlation_id)
+        consent_event.consent = Consent(
+            consent_id=email_request["consent_id"],
+            core_api_client=consent_event.core_api_client,
+            correlation_id=correlation_id,
+        )
+        consent_event.consent.project_task_id = email_request["project_task_id"]
+        return consent_event
+
+    def email_request(self):
+        """
+        Returns:
+            Detail of the consent_email_requested event of this consent
+        """
+        return {
+            "project_task_id": self.consent.project_task_id,
+            "consent_id": self.consent.consent_id,
+            "first_name": self.participant_first_name,
+            "consent_info_url": self.consent_info_url,
+            "template_name": self.template_name,
+        }
+
+    @property
+    def email_property_builder(self):
+        return ConsentEmailPropertyBuilder.for_template(self.template_name)
+
     def _format_consent_statements(self):
-        counter = 0
-        custom_properties_dict = dict()
-        for statement_dict in self.consent.consent_statements:
-            counter += 1
-            key = list(statement_dict.keys())[0]
-            custom_properties_dict[f"consent_row_{counter:02}"] = key
-            custom_properties_dict[f"consent_value_{counter:02}"] = statement_dict[key]
-        if counter > CONSENT_ROWS_IN_TEMPLATE:
-            raise utils.DetailedValueError(
-                "Number of consent statements exceeds maximum supported by template",
-                details={
-                    "len_consent_statements": len(self.consent.consent_statements),
-                    "consent_statements": self.consent.consent_statements,
-                    "rows_in_template": CONSENT_ROWS_IN_TEMPLATE,
-                    "correlation_id": self.correlation_id,
-                },
-            )
-        while counter < CONSENT_ROWS_IN_TEMPLATE:
-            counter += 1
-            custom_properties_dict[f"consent_row_{counter:02}"] = str()
-            custom_properties_dict[f"consent_value_{counter:02}"] = str()
-        return custom_properties_dict
-
-    def _split_consent_datetime(self):
-        consent_dt = parser.parse(self.consent.consent_datetime)
-        date = consent_dt.strftime("%e %B %Y")
-        time = consent_dt.strftime("%H:%M")
-        return date, time
+        return self.email_property_builder.consent_rows(
+            self.consent.consent_statements, correlation_id=self.correlation_id
+        )
 
     def _notify_participant(self):
-        custom_properties_dict = self._format_consent_statements()
-        custom_properties_dict["user_first_name"] = self.participant_first_name
-        custom_properties_dict["consent_info_url"] = self.consent_info_url
-        custom_properties_dict["project_short_name"] = self.consent.project_short_name
-        (
-            custom_properties_dict["current_date"],
-            custom_properties_dict["current_time"],
-        ) = self._split_consent_datetime()
-        email_dict = dict()
-        email_dict["custom_properties"] = custom_properties_dict
+        email_dict = self.email_property_builder.email_dict(
+            consent_statements=self.consent.consent_statements,
+            consent_datetime=self.consent_dt,
+            user_first_name=self.participant_first_name,
+            consent_info_url=self.consent_info_url,
+            project_short_name=self.consent.project_short_name,
+            correlation_id=self.correlation_id,
+        )
         self.logger.info(
             "API call",
             extra={
@@ -209,11 +467,28 @@ class ConsentEvent:
             template_name=template_name, **email_dict
         )
 
-    def parse(self):
-        dump_result = None
+    def _queue_notification(self):
+        eb_event = eb.ThiscoveryEvent(
+            {
+                "detail-type": CONSENT_EMAIL_EVENT,
+                "detail": self.email_request(),
+            }
+        )
+        eb_event.put_event()
+        return HTTPStatus.ACCEPTED
+
+    def _resolve_project(self) -> bool:
+        """
+        Fetches the project task and project of the consent, which both storage
+        and notification need. As when ddb_dump looks them up, failures are logged
+        as storage failures.
+
+        Returns:
+            True if the project was resolved; False (after logging the error) otherwise
+        """
         try:
-            dump_result = self.consent.ddb_dump()
-        except:
+            self.consent._get_project()
+        except Exception:
             self.logger.error(
                 "Failed to store consent data in Dynamodb",
                 extra={
@@ -222,6 +497,108 @@ class ConsentEvent:
                     "traceback": traceback.format_exc(),
                 },
             )
-        notification_result = self._notify_participant().get("statusCode")
+            return False
+        return True
+
+    def _store_consent(self, consent):
+        """
+        Args:
+            consent (Consent): Consent to store, with its project already resolved
+
+        Returns:
+            HTTPStatus.OK if the consent was stored in Dynamodb; None (after
+            logging the error) otherwise
+        """
+        try:
+            return consent.ddb_dump()
+        except Exception:
+            self.logger.error(
+                "Failed to store consent data in Dynamodb",
+                extra={
+                    "consent_as_dict": consent.as_dict(),
+                    "correlation_id": self.correlation_id,
+                    "traceback": traceback.format_exc(),
+                },
+            )
+
+    def parse(self):
+        """
+        Stores the consent in Dynamodb and notifies the participant. The project
+        is resolved first; then the ddb write (of a copy of the consent) runs
+        concurrently with the preparation and sending of the e-mail, unless the
+        e-mail is queued (queued e-mails are sent from the stored consent).
+        Storage failures, including failures to resolve the project, are logged
+        and the participant is still notified; notification failures raise.
+        """
+        if not self._resolve_project():
+            dump_result = None
+            notification_result = self._notify_participant().get("statusCode")
+        elif self.async_notification:
+            dump_result = self._store_consent(self.consent)
+            # consents that could not be stored (or queued) are notified in-request
+            if dump_result == HTTPStatus.OK:
+                try:
+                    return dump_result, self._queue_notification()
+                except Exception:
+                    self.logger.error(
+                        "Failed to queue consent e-mail; sending it synchronously",
+                        extra={
+                            "email_request": self.email_request(),
+                            "correlation_id": self.correlation_id,
+                            "traceback": traceback.format_exc(),
+                        },
+                    )
+            notification_result = self._notify_participant().get("statusCode")
+        else:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                storage = executor.submit(self._store_consent, copy.copy(self.consent))
+                notification = executor.submit(self._notify_participant)
+                dump_result = storage.result()
+                notification_result = notification.result().get("statusCode")
         assert notification_result == HTTPStatus.NO_CONTENT
         return dump_result, notification_result
+
+
+def send_queued_consent_email(email_request, logger, correlation_id=None):
+    """
+    Sends the participant e-mail of a consent_email_requested event. Safe to call
+    several times for the same consent: the e-mail is only sent by the call that
+    claims the consent's notification in Dynamodb, and the claim is released if
+    sending fails (or expires, if the invocation ends before sending) so that the
+    message can be retried. Messages whose claim is held by another delivery fail,
+    so that they are retried too.
+
+    Args:
+        email_request (dict): Detail of a consent_email_requested event
+        logger:
+        correlation_id:
+
+    Returns:
+        HTTPStatus.NO_CONTENT if the e-mail was sent, None if it had already been sent
+    """
+    consent_event = ConsentEvent.from_email_request(
+        email_request=email_request, logger=logger, correlation_id=correlation_id
+    )
+    consent = consent_event.consent
+    consent.ddb_load()
+    consent_event.consent_dt = ConsentEmailPropertyBuilder.to_datetime(
+        consent.consent_datetime
+    )
+    claimed_at = consent.claim_notification()
+    if claimed_at is None:
+        logger.info(
+            "Consent e-mail already sent; skipping",
+            extra={
+                "email_request": email_request,
+                "correlation_id": correlation_id,
+            },
+        )
+        return None
+    try:
+        notification_result = consent_event._notify_participant().get("statusCode")
+        assert notification_result == HTTPStatus.NO_CONTENT
+    except Exception:
+        consent.release_notification_claim(claimed_at)
+        raise
+    consent.mark_notification_sent()
+    return notification_result
@@ -0,0 +1,417 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Bulk ingestion of consents exported from Qualtrics (e.g. to backfill consents
+whose send-consent-email web-service calls failed).
+
+Exports are CSV or JSONL files uploaded to the consent imports bucket, with one
+consent per row and the same attributes as send-consent-email request bodies.
+Ingestion is started by an ingest_consents event; each invocation processes
+the file in chunks, checking after every row whether it nears its Lambda
+timeout, in which case it emits another ingest_consents event to carry on from
+the next row.
+"""
+
+import csv
+import io
+import json
+import os
+import traceback
+import uuid
+import thiscovery_lib.eb_utilities as eb
+import thiscovery_lib.utilities as utils
+
+import common.constants as const
+from common.clients import thiscovery_clients
+from common.ddb_utilities import batch_get_items, batch_write_items
+from consent import CONSENT_ITEM_TYPE, ConsentEvent
+
+# namespace of the consent_ids derived for rows that do not have one
+CONSENT_ID_NAMESPACE = uuid.UUID("0f5b7d0e-6e0a-4c1c-9b83-5a8f3c7ad9a1")
+
+
+class ConsentIngestionJob:
+    """
+    Writes the consents in an export file to ConsentData and, optionally,
+    queues their participant e-mails.
+
+    Rows without a consent_id are given one derived from their anon_user_task_id
+    and consent_datetime, so that re-running a job (or replaying a chunk) finds
+    the consents it has already written instead of duplicating them. Rows without
+    a consent_datetime are therefore rejected. Consents already in ConsentData are
+    neither overwritten (which would lose their notification_sent) nor e-mailed
+    again.
+    """
+
+    def __init__(
+        self,
+        key,
+        bucket=None,
+        job_id=None,
+        start_row=0,
+        queue_emails=False,
+        chunk_size=const.ConsentIngestion.CHUNK_SIZE,
+        correlation_id=None,
+    ):
+        """
+        Args:
+            key (str): S3 key of the export; files ending in .csv are read as CSV, others as JSONL
+            bucket (str): S3 bucket of the export; defaults to the consent imports bucket
+            job_id (str): Identifies the progress item of this job in the Cache table
+            start_row (int): Index of the first row to process (header excluded)
+            queue_emails (bool): If True, a consent_email_requested event is emitted for each consent stored
+            chunk_size (int): Number of rows processed together
+            correlation_id:
+        """
+        self.key = key
+        self.bucket = bucket or os.environ[const.ConsentIngestion.BUCKET_ENV_VAR]
+        self.job_id = job_id or str(uuid.uuid4())
+        self.start_row = start_row
+        self.queue_emails = queue_emails
+        self.chunk_size = chunk_size
+        self.correlation_id = correlation_id
+        self.logger = utils.get_logger()
+        self.ddb_client = thiscovery_clients.get_ddb_client()
+
+    @classmethod
+    def from_eb_event(cls, event):
+        detail = event["detail"]
+        try:
+            key = detail["key"]
+        except KeyError as exc:
+            raise utils.DetailedValueError(
+                f"Mandatory {exc} data not found in source event",
+                details={
+                    "event": event,
+                },
+            )
+        return cls(
+            key=key,
+            bucket=detail.get("bucket"),
+            job_id=detail.get("job_id"),
+            start_row=detail.get("start_row", 0),
+            queue_emails=detail.get("queue_emails", False),
+            chunk_size=detail.get("chunk_size", const.ConsentIngestion.CHUNK_SIZE),
+            correlation_id=event["id"],
+        )
+
+    def as_event_detail(self, start_row):
+        return {
+            "bucket": self.bucket,
+            "key": self.key,
+            "job_id": self.job_id,
+            "start_row": start_row,
+            "queue_emails": self.queue_emails,
+            "chunk_size": self.chunk_size,
+        }
+
+    def read_rows(self) -> list:
+        response = thiscovery_clients.get_s3_client().get_object(
+            Bucket=self.bucket, Key=self.key
+        )
+        text = response["Body"].read().decode("utf-8-sig")
+        if self.key.lower().endswith(".csv"):
+            # empty cells stand for missing optional attributes
+            return [
+                {k: v for k, v in row.items() if v not in (None, "")}
+                for row in csv.DictReader(io.StringIO(text))
+            ]
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    def _consent_event(self, row) -> ConsentEvent:
+        if not row.get("consent_datetime"):
+            # ConsentEvent would default it to now, giving the consent a new id on every run
+            raise utils.DetailedValueError(
+                "Row has no consent_datetime",
+                details={"anon_user_task_id": row.get("anon_user_task_id")},
+            )
+        body = dict(row)
+        if not isinstance(body.get("consent_statements"), str):
+            body["consent_statements"] = json.dumps(body.get("consent_statements"))
+        consent_event = ConsentEvent(
+            {
+                "body": json.dumps(body),
+                "logger": self.logger,
+                "correlation_id": self.correlation_id,
+            }
+        )
+        consent = consent_event.consent
+        if not row.get("consent_id"):
+            consent.consent_id = str(
+                uuid.uuid5(
+                    CONSENT_ID_NAMESPACE,
+                    f"{consent.anon_user_task_id}_{consent.consent_datetime}",
+                )
+            )
+        # project metadata is memoised by project_resolver, so it is fetched
+        # from the core API once per anon_user_task_id and project_task_id
+        consent._get_project()
+        if self.queue_emails:
+            consent_event._format_consent_statements()  # fails rows the e-mail template cannot take
+        return consent_event
+
+    @staticmethod
+    def _consent_item(consent, now) -> dict:
+        """
+        Returns the ConsentData item of consent, as written by Consent.ddb_dump
+        """
+        return {
+            **consent.as_dict(),
+            "type": CONSENT_ITEM_TYPE,
+            "details": dict(),
+            "created": now,
+            "modified": now,
+        }
+
+    @staticmethod
+    def _out_of_time(context) -> bool:
+        return (context is not None) and (
+            context.get_remaining_time_in_millis()
+            < const.ConsentIngestion.TIME_MARGIN_SECONDS * 1000
+        )
+
+    def ingest_chunk(self, rows, first_row, context=None) -> dict:
+        """
+        Args:
+            rows (list): Rows to ingest
+            first_row (int): Index of rows[0] in the export
+            context: Lambda context; if provided, rows after the first are only
+                resolved while the invocation is not near its timeout
+
+        Returns:
+            Summary of the chunk, including the errors of rows that could not be
+            ingested; rows is the number of rows processed, which is less than
+            len(rows) if the invocation ran out of time
+        """
+        errors = list()
+        consent_events = dict()
+        processed = 0
+        for row_index, row in enumerate(rows, start=first_row):
+            if processed and self._out_of_time(context):
+                break
+            processed += 1
+            try:
+                consent_event = self._consent_event(row)
+            except Exception as err:
+                errors.append({"row": row_index, "stage": "parse", "error": repr(err)})
+                continue
+            consent = consent_event.consent
+            # BatchWriteItem rejects requests writing the same key twice
+            consent_events[(consent.project_task_id, consent.consent_id)] = (
+                row_index,
+                consent_event,
+            )
+
+        table = self.ddb_client.get_table(table_name=const.CONSENT_DATA_TABLE)
+        stored = batch_get_items(
+            table,
+            keys=[
+                {"project_task_id": project_task_id, "consent_id": consent_id}
+                for project_task_id, consent_id in consent_events
+            ],
+            projection="project_task_id, consent_id",
+        )
+        for item in stored:
+            del consent_events[(item["project_task_id"], item["consent_id"])]
+
+        now = str(utils.now_with_tz())
+        written = batch_write_items(
+            table,
+            items=[
+                self._consent_item(ce.consent, now) for _, ce in consent_events.values()
+            ],
+        )
+
+        queued = 0
+        if self.queue_emails:
+            queue_errors = self._queue_emails(list(consent_events.values()))
+            queued = len(consent_events) - len(queue_errors)
+            errors.extend(queue_errors)
+
+        return {
+            "rows": processed,
+            "written": written,
+            # rows repeating an earlier row or a consent already in ConsentData
+            "duplicates": processed
+            - written
+            - sum(e["stage"] == "parse" for e in errors),
+            "queued_emails": queued,
+            "errors": errors,
+        }
+
+    @staticmethod
+    def _queue_emails(consent_events) -> list:
+        """
+        Emits the consent_email_requested events of consent_events in PutEvents
+        calls of up to EVENTS_PER_PUT entries
+
+        Args:
+            consent_events (list): (row index, ConsentEvent) tuples
+
+        Returns:
+            Errors of the rows whose events could not be emitted
+        """
+        errors = list()
+        eb_client = eb.EventbridgeClient()
+        batch_size = const.ConsentIngestion.EVENTS_PER_PUT
+        for i in range(0, len(consent_events), batch_size):
+            batch = consent_events[i : i + batch_size]
+            try:
+                entries = [
+                    eb.ThiscoveryEvent(
+                        {
+                            "detail-type": const.CONSENT_EMAIL_EVENT,
+                            "detail": consent_event.email_request(),
+                        }
+                    ).get_event_as_entry()
+                    for _, consent_event in batch
+                ]
+                results = eb_client.client.put_events(Entries=entries)["Entries"]
+            except Exception as err:
+                errors.extend(
+                    {"row": row_index, "stage": "queue_email", "error": repr(err)}
+                    for row_index, _ in batch
+                )
+                continue
+            # PutEvents results are in the same order as its entries
+            for (row_index, _), result in zip(batch, results):
+                if "ErrorCode" in result:
+                    errors.append(
+                        {
+                            "row": row_index,
+                            "stage": "queue_email",
+                            "error": f"{result['ErrorCode']}: {result.get('ErrorMessage')}",
+                        }
+                    )
+        return errors
+
+    def _record_progress(self, summary, next_row):
+        """
+        Adds the counts of this invocation to the progress item of the job in the
+        Cache table
+        """
+        table = self.ddb_client.get_table(table_name=const.CACHE_TABLE["name"])
+        table.update_item(
+            Key={
+                const.CACHE_TABLE["partition_key"]: f"consent_ingestion_{self.job_id}"
+            },
+            UpdateExpression="SET #type = :type, #key = :key, next_row = :next_row, "
+            "modified = :modified "
+            "ADD #rows :rows, written :written, duplicates :duplicates, "
+            "queued_emails :queued_emails, #errors :errors",
+            ExpressionAttributeNames={
+                "#type": "type",
+                "#key": "key",
+                "#rows": "rows",
+                "#errors": "errors",
+            },
+            ExpressionAttributeValues={
+                ":type": "consent_ingestion",
+                ":key": f"{self.bucket}/{self.key}",
+                ":next_row": next_row,
+                ":modified": str(utils.now_with_tz()),
+                ":rows": summary["rows"],
+                ":written": summary["written"],
+                ":duplicates": summary["duplicates"],
+                ":queued_emails": summary["queued_emails"],
+                ":errors": len(summary["errors"]),
+            },
+        )
+
+    def _put_continuation_event(self, start_row):
+        eb_event = eb.ThiscoveryEvent(
+            {
+                "detail-type": "ingest_consents",
+                "detail": self.as_event_detail(start_row=start_row),
+            }
+        )
+        return eb_event.put_event()
+
+    def run(self, context=None) -> dict:
+        """
+        Ingests rows from start_row onwards, chunk by chunk, until the end of the
+        export or until the Lambda invocation (if context is provided) nears its
+        timeout, in which case the rows resolved so far are written and a
+        continuation event is emitted. At least one row is processed per
+        invocation, so that every invocation makes progress.
+
+        Returns:
+            Summary of this invocation; next_row is None once the export has been
+            fully ingested
+        """
+        rows = self.read_rows()
+        summary = {
+            "job_id": self.job_id,
+            "key": self.key,
+            "total_rows": len(rows),
+            "start_row": self.start_row,
+            "next_row": None,
+            "rows": 0,
+            "written": 0,
+            "duplicates": 0,
+            "queued_emails": 0,
+            "errors": list(),
+        }
+        position = self.start_row
+        while position < len(rows):
+            chunk = rows[position : position + self.chunk_size]
+            chunk_summary = self.ingest_chunk(
+                chunk, first_row=position, context=context
+            )
+            for k in ["rows", "written", "duplicates", "queued_emails"]:
+                summary[k] += chunk_summary[k]
+            summary["errors"].extend(chunk_summary["errors"])
+            position += chunk_summary["rows"]
+            self.logger.info(
+                "Ingested chunk of consents",
+                extra={
+                    "job_id": self.job_id,
+                    "next_row": position,
+                    "total_rows": len(rows),
+                    "chunk_summary": chunk_summary,
+                    "correlation_id": self.correlation_id,
+                },
+            )
+            if self._out_of_time(context):
+                break
+
+        if position < len(rows):
+            summary["next_row"] = position
+            self._put_continuation_event(start_row=position)
+        self._record_progress(summary, next_row=summary["next_row"])
+        if summary["errors"]:
+            self.logger.error(
+                "Some consents could not be ingested",
+                extra={
+                    "job_id": self.job_id,
+                    "errors": summary["errors"],
+                    "correlation_id": self.correlation_id,
+                },
+            )
+        return summary
+
+
+@utils.lambda_wrapper
+def ingest_consents(event, context):
+    """
+    Processes ingest_consents events, whose detail contains the key of the
+    export to ingest and, optionally, bucket, queue_emails and chunk_size.
+    Continuation events also carry the job_id and start_row to carry on from.
+    """
+    job = ConsentIngestionJob.from_eb_event(event)
+    return job.run(context=context)
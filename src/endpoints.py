@@ -16,14 +16,16 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import json
+import traceback
 import thiscovery_lib.utilities as utils
 from http import HTTPStatus
 from thiscovery_lib.events_api_utilities import EventsApiClient
 
+import common.constants as const
 from common.survey_response import SurveyClient, SurveyResponse
 from common.survey_definition import SurveyDefinition
 from common.task_responses import TaskResponse
-from consent import ConsentEvent
+from consent import ConsentEvent, send_queued_consent_email
 from interview_tasks import InterviewTask, UserInterviewTask
 
 
@@ -42,13 +44,36 @@ def retrieve_responses_api(event, context):
     )
     survey_id = parameters.get("survey_id")
     response_id = parameters.get("response_id")
+    response_ids = parameters.get("response_ids")
     question_ids = parameters.get("question_ids")
     if question_ids:
         question_ids = json.loads(question_ids)
+    if response_ids:
+        response_ids = json.loads(response_ids)
+        if not isinstance(response_ids, list):
+            raise utils.DetailedValueError(
+                "response_ids must be a JSON list", details={"parameters": parameters}
+            )
+        if len(response_ids) > const.RESPONSE_BATCH_MAX_SIZE:
+            raise utils.DetailedValueError(
+                f"Number of response_ids exceeds maximum of {const.RESPONSE_BATCH_MAX_SIZE}",
+                details={"parameters": parameters},
+            )
     survey_client = SurveyClient(survey_id=survey_id, correlation_id=correlation_id)
-    response_body = survey_client.get_response(
-        response_id=response_id, export_tags=question_ids
-    )
+    if response_ids:
+        responses, errors = survey_client.get_responses(
+            response_ids=response_ids, export_tags=question_ids
+        )
+        response_body = {
+            "survey_id": survey_id,
+            "responses": responses,
+            "errors": errors,
+            "count": len(responses),
+        }
+    else:
+        response_body = survey_client.get_response(
+            response_id=response_id, export_tags=question_ids
+        )
     return {
         "statusCode": HTTPStatus.OK,
         "body": json.dumps(response_body),
@@ -103,6 +128,37 @@ def send_consent_email_api(event, context):
     }
 
 
+@utils.lambda_wrapper
+def send_queued_consent_emails(event, context):
+    """
+    Drains batches of consent_email_requested events from the ConsentEmails queue.
+    Failed messages are reported back to SQS, which redelivers them until they
+    are moved to the dead-letter queue
+    """
+    logger = event["logger"]
+    correlation_id = event["correlation_id"]
+    batch_item_failures = list()
+    for record in event["Records"]:
+        try:
+            email_request = json.loads(record["body"])["detail"]
+            send_queued_consent_email(
+                email_request=email_request,
+                logger=logger,
+                correlation_id=correlation_id,
+            )
+        except Exception:
+            logger.error(
+                "Failed to send queued consent e-mail",
+                extra={
+                    "message_id": record["messageId"],
+                    "correlation_id": correlation_id,
+                    "traceback": traceback.format_exc(),
+                },
+            )
+            batch_item_failures.append({"itemIdentifier": record["messageId"]})
+    return {"batchItemFailures": batch_item_failures}
+
+
 @utils.lambda_wrapper
 def put_task_response(event, context):
     pass
@@ -124,10 +180,28 @@ def put_interview_questions(event, context):
         raise utils.DetailedValueError(
             f"interview_questions_update event missing mandatory data {err}", details={}
         )
+    logger = event["logger"]
     sd = SurveyDefinition.from_eb_event(event=event)
+    if sd.is_synced():
+        logger.info(
+            "Survey definition unchanged since last sync; skipped interview questions update",
+            extra={
+                "survey_id": sd.survey_id,
+                "survey_modified": sd.modified,
+                "correlation_id": event["id"],
+            },
+        )
+        body = {
+            "survey_id": sd.survey_id,
+            "survey_modified": sd.modified,
+            "skipped": True,
+        }
+        return {"statusCode": HTTPStatus.OK, "body": json.dumps(body)}
     body = sd.ddb_update_interview_questions()
     eac = EventsApiClient()
     eac.post_event(event_for_interview_system)
+    sd.record_sync()
+    body["skipped"] = False
     return {"statusCode": HTTPStatus.OK, "body": json.dumps(body)}
 
 
@@ -219,6 +293,8 @@ def get_interview_questions_api(event, context):
             "event": event,
         },
     )
-    body = SurveyDefinition.get_interview_questions(survey_id)
+    body = SurveyDefinition.get_interview_questions(
+        survey_id, correlation_id=correlation_id
+    )
 
     return {"statusCode": HTTPStatus.OK, "body": json.dumps(body)}
@@ -21,11 +21,10 @@ import uuid
 import thiscovery_lib.utilities as utils
 from dateutil import parser
 from http import HTTPStatus
-from thiscovery_lib.core_api_utilities import CoreApiClient
-from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.qualtrics import qualtrics2thiscovery_timestamp
 
 import common.constants as const
+from common.clients import thiscovery_clients
 from common.ddb_base_item import DdbBaseItem
 from common.task_responses import TaskResponse
 
@@ -52,7 +51,7 @@ class InterviewTask(DdbBaseItem):
         ]
         for oa in optional_attributes:
             self.__dict__[oa] = kwargs.get(oa)
-        self._ddb_client = Dynamodb(stack_name=const.STACK_NAME)
+        self._ddb_client = thiscovery_clients.get_ddb_client()
 
     def as_dict(self):
         return {
@@ -16,17 +16,344 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 from __future__ import annotations
+import datetime
+import hashlib
 import json
+import math
+import time
 import thiscovery_lib.eb_utilities as eb
 import thiscovery_lib.qualtrics as qualtrics
 import thiscovery_lib.utilities as utils
 
-from boto3.dynamodb.conditions import Attr
+from collections import deque
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
+from dateutil import parser
 from http import HTTPStatus
-from thiscovery_lib.dynamodb_utilities import Dynamodb
+from typing import Iterator, Optional
 
 import common.constants as const
+from common.cache import TieredCache
+from common.clients import qualtrics_clients, thiscovery_clients
+from common.ddb_utilities import batch_write_items
+from common.lease import DdbLease
+
+
+class LinkPoolCounter:
+    """
+    Number of unassigned personal links of an account_survey_id, held in the
+    PersonalLinkCounters table so that buffer levels can be checked with a single
+    get_item. The counter is adjusted atomically when links are generated or
+    assigned, and recounted from the unassigned-links index by
+    reconcile_personal_link_counters.
+    """
+
+    def __init__(self, account_survey_id: str, ddb_client=None):
+        self.account_survey_id = account_survey_id
+        self.ddb_client = ddb_client
+        if ddb_client is None:
+            self.ddb_client = thiscovery_clients.get_ddb_client()
+
+    @property
+    def table(self):
+        return self.ddb_client.get_table(
+            table_name=const.PersonalLinkCountersTable.NAME
+        )
+
+    def _key(self):
+        return {const.PersonalLinkCountersTable.PARTITION: self.account_survey_id}
+
+    def add(self, n: int) -> None:
+        """
+        Adjusts an existing counter by n. Missing counters are left alone; they are
+        initialised by counting links the first time they are read.
+        """
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression="ADD #unassigned :n SET modified = :modified",
+                ConditionExpression=Attr(
+                    const.PersonalLinkCountersTable.PARTITION
+                ).exists(),
+                ExpressionAttributeNames={
+                    "#unassigned": const.PersonalLinkCountersTable.UNASSIGNED
+                },
+                ExpressionAttributeValues={
+                    ":n": n,
+                    ":modified": str(utils.now_with_tz()),
+                },
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def record_assignment(self, timestamp: float = None, conflicts: int = 0) -> None:
+        """
+        Decrements the counter after a link has been assigned and adds the assignment
+        to the per-minute bucket used by AdaptiveBuffer to measure demand
+
+        Args:
+            timestamp: Time of the assignment; defaults to now
+            conflicts: Number of links found to be already taken before this one
+                       was assigned; added to the assignment_conflicts counter
+        """
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression="ADD #unassigned :minus_one, #bucket :one, "
+                "#conflicts :conflicts "
+                "SET modified = :modified",
+                ConditionExpression=Attr(
+                    const.PersonalLinkCountersTable.PARTITION
+                ).exists(),
+                ExpressionAttributeNames={
+                    "#unassigned": const.PersonalLinkCountersTable.UNASSIGNED,
+                    "#bucket": assignment_bucket_name(timestamp),
+                    "#conflicts": const.PersonalLinkCountersTable.ASSIGNMENT_CONFLICTS,
+                },
+                ExpressionAttributeValues={
+                    ":minus_one": -1,
+                    ":one": 1,
+                    ":conflicts": conflicts,
+                    ":modified": str(utils.now_with_tz()),
+                },
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def record_conflicts(self, conflicts: int) -> None:
+        """
+        Adds to the assignment_conflicts counter the conflicts of an assignment
+        that did not succeed
+        """
+        if not conflicts:
+            return
+        try:
+            self.table.update_item(
+                Key=self._key(),
+                UpdateExpression="ADD #conflicts :conflicts SET modified = :modified",
+                ConditionExpression=Attr(
+                    const.PersonalLinkCountersTable.PARTITION
+                ).exists(),
+                ExpressionAttributeNames={
+                    "#conflicts": const.PersonalLinkCountersTable.ASSIGNMENT_CONFLICTS
+                },
+                ExpressionAttributeValues={
+                    ":conflicts": conflicts,
+                    ":modified": str(utils.now_with_tz()),
+                },
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def set(self, n: int, expired_buckets: list = None) -> None:
+        """
+        Args:
+            n: Number of unassigned links
+            expired_buckets: Names of assignment buckets to remove from the counter
+        """
+        update_expression = "SET #unassigned = :n, modified = :modified"
+        attribute_names = {"#unassigned": const.PersonalLinkCountersTable.UNASSIGNED}
+        if expired_buckets:
+            placeholders = list()
+            for i, bucket in enumerate(expired_buckets):
+                attribute_names[f"#b{i}"] = bucket
+                placeholders.append(f"#b{i}")
+            update_expression += f" REMOVE {', '.join(placeholders)}"
+        self.table.update_item(
+            Key=self._key(),
+            UpdateExpression=update_expression,
+            ExpressionAttributeNames=attribute_names,
+            ExpressionAttributeValues={
+                ":n": n,
+                ":modified": str(utils.now_with_tz()),
+            },
+        )
+
+    def recount(self, expired_buckets: list = None) -> int:
+        n = count_unassigned_links(
+            account_survey_id=self.account_survey_id, ddb_client=self.ddb_client
+        )
+        self.set(n, expired_buckets=expired_buckets)
+        return n
+
+    def get_item(self) -> dict:
+        """
+        Returns the counter item. If there is no counter for this account_survey_id
+        yet, links are counted and a counter is created.
+        """
+        item = self.table.get_item(Key=self._key()).get("Item")
+        if item is None:
+            return {
+                **self._key(),
+                const.PersonalLinkCountersTable.UNASSIGNED: self.recount(),
+            }
+        return item
+
+    def get(self) -> int:
+        """
+        Returns the number of unassigned links
+        """
+        return int(self.get_item()[const.PersonalLinkCountersTable.UNASSIGNED])
+
+
+class AdaptiveBuffer:
+    """
+    Sizes the buffer of unassigned links of a survey from its recent demand.
+
+    The assignment rate is measured over the last RATE_WINDOW_MINUTES using the
+    per-minute buckets of the survey's counter item. A refill is triggered when the
+    pool would last less than TRIGGER_COVERAGE_MINUTES at that rate, and tops the
+    pool up to cover TARGET_COVERAGE_MINUTES. Both numbers are kept between FLOOR
+    and CEILING, so quiet surveys keep a small buffer and mailouts cannot trigger
+    unbounded link generation.
+    """
+
+    def __init__(
+        self,
+        counter_item: dict,
+        now: float = None,
+        floor: int = const.PersonalLinksBuffer.FLOOR,
+        ceiling: int = const.PersonalLinksBuffer.CEILING,
+    ):
+        self.unassigned = int(counter_item[const.PersonalLinkCountersTable.UNASSIGNED])
+        self.floor = floor
+        self.ceiling = ceiling
+        window_start = assignment_window_start(now)
+        self.recent_assignments = 0
+        for name, value in counter_item.items():
+            bucket_start = parse_assignment_bucket_name(name)
+            if bucket_start is not None and bucket_start >= window_start:
+                self.recent_assignments += int(value)
+
+    @classmethod
+    def from_counter(cls, counter: LinkPoolCounter, **kwargs):
+        return cls(counter.get_item(), **kwargs)
+
+    @property
+    def assignment_rate(self) -> float:
+        """
+        Average number of links assigned per minute over the sliding window
+        """
+        return self.recent_assignments / const.PersonalLinksBuffer.RATE_WINDOW_MINUTES
+
+    def _links_for(self, minutes: int) -> int:
+        links = math.ceil(self.assignment_rate * minutes)
+        return min(max(links, self.floor), self.ceiling)
+
+    @property
+    def threshold(self) -> int:
+        return self._links_for(const.PersonalLinksBuffer.TRIGGER_COVERAGE_MINUTES)
+
+    @property
+    def target(self) -> int:
+        return self._links_for(const.PersonalLinksBuffer.TARGET_COVERAGE_MINUTES)
+
+    def is_low(self) -> bool:
+        return self.unassigned < self.threshold
+
+    def as_dict(self) -> dict:
+        return {
+            "unassigned": self.unassigned,
+            "assignment_rate": self.assignment_rate,
+            "threshold": self.threshold,
+            "target": self.target,
+        }
+
+
+class AssignedLinksCache:
+    """
+    Links already assigned to users, keyed by account_survey_id and
+    anon_project_specific_user_id. An assignment never changes once made, so
+    repeat requests by the same user (e.g. page reloads) are answered without
+    querying PersonalLinks.
+
+    As a guard against serving a link to the wrong participant, each entry
+    records the account_survey_id and user it was assigned to, and is only
+    returned to lookups for that same survey and user.
+    """
+
+    item_type = "assigned_personal_link"
+
+    def __init__(
+        self,
+        maxsize=const.ASSIGNED_LINKS_CACHE_SIZE,
+        ttl=const.ASSIGNED_LINKS_CACHE_TTL,
+        use_ddb_cache=const.ASSIGNED_LINKS_DDB_CACHE,
+    ):
+        self.tiers = TieredCache(
+            item_type=self.item_type,
+            maxsize=maxsize,
+            ttl=ttl,
+            persist=use_ddb_cache,
+        )
+
+    def clear(self):
+        self.tiers.clear()
+
+    @staticmethod
+    def _key(account_survey_id, anon_project_specific_user_id):
+        return f"{account_survey_id}_{anon_project_specific_user_id}"
+
+    @staticmethod
+    def _is_valid(entry, account_survey_id, anon_project_specific_user_id) -> bool:
+        return (
+            isinstance(entry, dict)
+            and entry.get("account_survey_id") == account_survey_id
+            and entry.get("anon_project_specific_user_id")
+            == anon_project_specific_user_id
+            and bool(entry.get("url"))
+        )
+
+    def get(
+        self,
+        account_survey_id: str,
+        anon_project_specific_user_id: str,
+        ddb_client=None,
+        correlation_id=None,
+    ):
+        """
+        Returns:
+            The url of the link assigned to the user, or None if not cached
+        """
+        entry = self.tiers.get(
+            self._key(account_survey_id, anon_project_specific_user_id),
+            is_valid=lambda x: self._is_valid(
+                x, account_survey_id, anon_project_specific_user_id
+            ),
+            ddb_client=ddb_client,
+            correlation_id=correlation_id,
+        )
+        if entry is None:
+            return None
+        return entry["url"]
+
+    def put(
+        self,
+        account_survey_id: str,
+        anon_project_specific_user_id: str,
+        url: str,
+        ddb_client=None,
+        correlation_id=None,
+    ) -> None:
+        """
+        Caches a link that is known to be assigned to the user in ddb
+        """
+        self.tiers.put(
+            self._key(account_survey_id, anon_project_specific_user_id),
+            {
+                "account_survey_id": account_survey_id,
+                "anon_project_specific_user_id": anon_project_specific_user_id,
+                "url": url,
+            },
+            ddb_client=ddb_client,
+            correlation_id=correlation_id,
+        )
+
+
+assigned_links_cache = AssignedLinksCache()
 
 
 class DistributionLinksGenerator:
@@ -41,11 +368,12 @@ class DistributionLinksGenerator:
         self.survey_id = survey_id
         self.account_survey_id = f"{account}_{survey_id}"
         self.contact_list_id = contact_list_id
-        self.dist_client = qualtrics.DistributionsClient(qualtrics_account_name=account)
-        self.correlation_id = correlation_id
-        self.ddb_client = Dynamodb(
-            stack_name=const.STACK_NAME, correlation_id=correlation_id
+        self.dist_client = qualtrics_clients.get_client(
+            qualtrics.DistributionsClient,
+            qualtrics_account_name=account,
         )
+        self.correlation_id = correlation_id
+        self.ddb_client = thiscovery_clients.get_ddb_client()
 
     @classmethod
     def from_eb_event(cls, event: dict):
@@ -68,47 +396,285 @@ class DistributionLinksGenerator:
                 },
             )
 
+    def get_buffer(self) -> AdaptiveBuffer:
+        return AdaptiveBuffer.from_counter(
+            LinkPoolCounter(
+                account_survey_id=self.account_survey_id, ddb_client=self.ddb_client
+            )
+        )
+
     def is_buffer_low(self) -> bool:
-        unassigned_links = get_unassigned_links(
-            account_survey_id=self.account_survey_id, ddb_client=self.ddb_client
+        return self.get_buffer().is_low()
+
+    def refill_if_buffer_low(self):
+        """
+        Refills the buffer of unassigned links if it is low and no one else is
+        already generating links for this survey
+
+        Returns:
+            Link items generated, or None if no links were generated
+        """
+        logger = utils.get_logger()
+        buffer = self.get_buffer()
+        if not buffer.is_low():
+            logger.info(
+                "Personal links buffer is not low; ignored this create_personal_links event",
+                extra={
+                    "account_survey_id": self.account_survey_id,
+                    "buffer": buffer.as_dict(),
+                    "correlation_id": self.correlation_id,
+                },
+            )
+            return None
+        lease = generation_lease(
+            account_survey_id=self.account_survey_id,
+            ddb_client=self.ddb_client,
+            correlation_id=self.correlation_id,
         )
-        if len(unassigned_links) < const.PersonalLinksTable.BUFFER:
-            return True
-        return False
+        if not lease.acquire():
+            logger.info(
+                "Personal links are already being generated; ignored this create_personal_links event",
+                extra={
+                    "account_survey_id": self.account_survey_id,
+                    "buffer": buffer.as_dict(),
+                    "correlation_id": self.correlation_id,
+                },
+            )
+            return None
+        try:
+            return self.refill(buffer, lease=lease)
+        finally:
+            lease.release()
 
-    def generate_links_and_upload_to_dynamodb(self) -> list[dict]:
+    def refill(
+        self, buffer: AdaptiveBuffer = None, lease: DdbLease = None
+    ) -> list[dict]:
+        """
+        Generates links until the pool reaches the target of the adaptive buffer.
+        Each round creates one distribution, and therefore as many links as there
+        are contacts in the contact list.
+
+        Args:
+            buffer: Buffer state; read from the counter if not provided
+            lease: Generation lease held by the caller, if any; it is renewed before
+                   each round and the refill stops if it has been lost
+
+        Returns:
+            All link items generated
+        """
+        if buffer is None:
+            buffer = self.get_buffer()
+        items = list()
+        unassigned = buffer.unassigned
+        rounds = 0
+        while (
+            unassigned < buffer.target
+            and rounds < const.PersonalLinksBuffer.MAX_REFILL_ROUNDS
+        ):
+            if rounds and lease is not None and not lease.renew():
+                break
+            new_items = self.generate_links_and_upload_to_dynamodb()
+            rounds += 1
+            new_links_n = len([x for x in new_items if x["status"] == "new"])
+            items.extend(new_items)
+            if not new_links_n:
+                break
+            unassigned += new_links_n
+        utils.get_logger().info(
+            "Refilled personal links buffer",
+            extra={
+                "account_survey_id": self.account_survey_id,
+                "buffer": buffer.as_dict(),
+                "rounds": rounds,
+                "unassigned": unassigned,
+                "correlation_id": self.correlation_id,
+            },
+        )
+        return items
+
+    def iter_distribution_links(self, distribution_id: str) -> Iterator[list[dict]]:
+        """
+        Pages through the links of a distribution, following Qualtrics' nextPage
+        urls, and yields the rows of each page as soon as it is received
+        """
+        r = self.dist_client.list_distribution_links(distribution_id, self.survey_id)
+        while True:
+            yield r["result"]["elements"]
+            next_page = r["result"].get("nextPage")
+            if not next_page:
+                return
+            r = self.dist_client.qualtrics_request("GET", next_page)
+
+    def _link_item(self, row: dict, assign_to: deque = None) -> dict:
+        """
+        Args:
+            row: Link returned by Qualtrics
+            assign_to: anon_project_specific_user_ids waiting for a link; if provided,
+                       links not already assigned via externalDataReference are
+                       assigned to the next user in the queue
+        """
+        item = {
+            const.PersonalLinksTable.PARTITION: self.account_survey_id,
+            "status": "new",
+            "url": row.pop("link"),
+            "expires": row.pop("linkExpiration"),
+            "details": row,
+            "type": "personal survey link",
+        }
+        if (
+            anon_project_specific_user_id := row["externalDataReference"]
+        ) :  # this link is already assigned to a user (e.g. delphi round 2)
+            item.update(
+                status="assigned",
+                anon_project_specific_user_id=anon_project_specific_user_id,
+            )
+        elif assign_to:
+            item.update(
+                status="assigned",
+                anon_project_specific_user_id=assign_to.popleft(),
+            )
+        item["status_expires"] = status_expires(item["status"], item["expires"])
+        if item["status"] == "new":  # expired unassigned links are deleted by ddb TTL
+            item[const.PersonalLinksTable.TTL_ATTRIBUTE] = expires_epoch(
+                item["expires"]
+            )
+        now = str(utils.now_with_tz())
+        item.update(created=now, modified=now)
+        return item
+
+    def stream_links_to_dynamodb(self, assign_to: deque = None) -> Iterator[dict]:
+        """
+        Creates a distribution and writes its links to ddb one page at a time, so
+        that the first links can be assigned while later pages are still being
+        fetched. The counter of unassigned links is updated after each page.
+
+        Args:
+            assign_to: Queue of anon_project_specific_user_ids to write links as
+                       assigned to (see preassign_links); users are removed from
+                       the queue as they get a link
+
+        Yields:
+            Progress of each page: page number, its items, and running totals of
+            links written and of new (unassigned) links
+        """
         r = self.dist_client.create_individual_links(
             survey_id=self.survey_id, contact_list_id=self.contact_list_id
         )
         distribution_id = r["result"]["id"]
-        r = self.dist_client.list_distribution_links(distribution_id, self.survey_id)
-        rows = r["result"]["elements"]
-        items = list()
-        partition_key_name = const.PersonalLinksTable.PARTITION
-        for row in rows:
-            item = {
-                partition_key_name: f"{self.account}_{self.survey_id}",
-                "status": "new",
-                "url": row.pop("link"),
-                "expires": row.pop("linkExpiration"),
-                "details": row,
-            }
-            if (
-                anon_project_specific_user_id := row["externalDataReference"]
-            ) :  # this link is already assigned to a user (e.g. delphi round 2)
-                item.update(
-                    status="assigned",
-                    anon_project_specific_user_id=anon_project_specific_user_id,
-                )
-            items.append(item)
-        self.ddb_client.batch_put_items(
-            table_name=const.PersonalLinksTable.NAME,
-            items=items,
-            partition_key_name=partition_key_name,
-            item_type="personal survey link",
+        table = self.ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+        counter = LinkPoolCounter(
+            account_survey_id=self.account_survey_id, ddb_client=self.ddb_client
         )
+        written = 0
+        new_links = 0
+        for page, rows in enumerate(
+            self.iter_distribution_links(distribution_id), start=1
+        ):
+            items = [self._link_item(row, assign_to=assign_to) for row in rows]
+            written += batch_write_items(table, items=items)
+            page_new_links = len([x for x in items if x["status"] == "new"])
+            if page_new_links:
+                counter.add(page_new_links)
+            new_links += page_new_links
+            yield {
+                "distribution_id": distribution_id,
+                "page": page,
+                "items": items,
+                "written": written,
+                "new_links": new_links,
+            }
+
+    def generate_links_and_upload_to_dynamodb(self) -> list[dict]:
+        items = list()
+        for progress in self.stream_links_to_dynamodb():
+            items.extend(progress["items"])
         return items
 
+    def get_users_with_links(self) -> set:
+        """
+        Returns:
+            anon_project_specific_user_ids that have been assigned a link for this survey
+        """
+        table = self.ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+        query_kwargs = {
+            "KeyConditionExpression": Key(const.PersonalLinksTable.PARTITION).eq(
+                self.account_survey_id
+            ),
+            "FilterExpression": Attr("anon_project_specific_user_id").exists(),
+            "ProjectionExpression": "anon_project_specific_user_id",
+        }
+        users = set()
+        while True:
+            result = table.query(**query_kwargs)
+            users.update(x["anon_project_specific_user_id"] for x in result["Items"])
+            last_evaluated_key = result.get("LastEvaluatedKey")
+            if not last_evaluated_key:
+                return users
+            query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+    def preassign_links(
+        self, anon_project_specific_user_ids: list, lease: DdbLease = None
+    ) -> dict:
+        """
+        Assigns links to known participants ahead of time (e.g. for Delphi round 2),
+        so that get_personal_link finds them with a single assigned-links lookup.
+
+        Links are taken from new distributions and written as assigned, as links
+        carrying an externalDataReference already are. As no one else has seen
+        these links, no conditional updates are needed. Users that already have a
+        link for this survey are skipped.
+
+        Args:
+            anon_project_specific_user_ids:
+            lease: Generation lease held by the caller, if any; it is renewed before
+                   each distribution and pre-assignment stops if it has been lost
+
+        Returns:
+            Summary of the operation; not_assigned lists users left without a link
+            if MAX_PREASSIGNMENT_ROUNDS was reached
+        """
+        users_with_links = self.get_users_with_links()
+        pending = deque(
+            x
+            for x in dict.fromkeys(anon_project_specific_user_ids)
+            if x not in users_with_links
+        )
+        to_assign = len(pending)
+        rounds = 0
+        new_links = 0
+        while (
+            pending and rounds < const.PersonalLinksGeneration.MAX_PREASSIGNMENT_ROUNDS
+        ):
+            if rounds and lease is not None and not lease.renew():
+                break
+            pending_before = len(pending)
+            round_new_links = 0
+            for progress in self.stream_links_to_dynamodb(assign_to=pending):
+                round_new_links = progress["new_links"]
+            rounds += 1
+            new_links += round_new_links
+            if len(pending) == pending_before:  # distribution returned no usable links
+                break
+        summary = {
+            "account_survey_id": self.account_survey_id,
+            "requested": len(anon_project_specific_user_ids),
+            "already_assigned": len(
+                users_with_links.intersection(anon_project_specific_user_ids)
+            ),
+            "preassigned": to_assign - len(pending),
+            "not_assigned": list(pending),
+            "new_links": new_links,
+            "rounds": rounds,
+        }
+        utils.get_logger().info(
+            "Pre-assigned personal links",
+            extra={
+                **{k: v for k, v in summary.items() if k != "not_assigned"},
+                "correlation_id": self.correlation_id,
+            },
+        )
+        return summary
+
 
 class PersonalLinkManager:
     def __init__(
@@ -122,9 +688,8 @@ class PersonalLinkManager:
         if correlation_id is None:
             self.correlation_id = utils.new_correlation_id()
 
-        self.ddb_client = Dynamodb(
-            stack_name=const.STACK_NAME, correlation_id=self.correlation_id
-        )
+        self.ddb_client = thiscovery_clients.get_ddb_client()
+        self.assignment_conflicts = 0
 
     def _query_user_link(self) -> list:
         """
@@ -141,39 +706,81 @@ class PersonalLinkManager:
             },
         )
 
-    def _assign_link_to_user(self, unassigned_links: list) -> str:
+    def _order_candidates(self, unassigned_links: list) -> list:
+        """
+        Orders unassigned links for assignment attempts.
+
+        Links are sorted by expiry date, but concurrent callers would then all compete for
+        the same first link. To spread them out, each user starts at a different position
+        (derived from a hash of their anon_project_specific_user_id) within the
+        ASSIGNMENT_WINDOW links that expire soonest, wrapping around the window before
+        moving on to later-expiring links.
+        """
+        candidates = sorted(unassigned_links, key=lambda x: x["expires"])
+        window = candidates[: const.PersonalLinksTable.ASSIGNMENT_WINDOW]
+        if not window:
+            return candidates
+        user_hash = hashlib.sha256(
+            self.anon_project_specific_user_id.encode("utf-8")
+        ).hexdigest()
+        offset = int(user_hash, 16) % len(window)
+        return (
+            window[offset:]
+            + window[:offset]
+            + candidates[const.PersonalLinksTable.ASSIGNMENT_WINDOW :]
+        )
+
+    def _claim_first_free_link(self, candidates: list) -> Optional[str]:
         """
-        Assigns to user the unassigned link with the soonest expiration date.
+        Tries to assign to user each of the first MAX_ASSIGNMENT_ATTEMPTS candidates in turn.
         An existing anon_project_specific_user_id is checked at assignment type to protect against
-        the unlikely but possible scenario where a concurrent invocation of the
+        the possible scenario where a concurrent invocation of the
         lambda has assigned the same link to a different user.
 
-        Args:
-            unassigned_links (list): All unassigned links for this account_survey_id in PersonalLinks table
-
         Returns:
-            A url representing the personal link assigned to this user
-
+            The url of the link assigned to user, or None if all candidates were taken
         """
-        # assign oldest link to user
-        unassigned_links.sort(key=lambda x: x["expires"])
         user_id_attr_name = "anon_project_specific_user_id"
+        ttl_attr_name = const.PersonalLinksTable.TTL_ATTRIBUTE
+        table = self.ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+        now = int(time.time())
         logger = utils.get_logger()
-        for unassigned_link in unassigned_links:
+        for unassigned_link in candidates[
+            : const.PersonalLinksTable.MAX_ASSIGNMENT_ATTEMPTS
+        ]:
             user_link = unassigned_link["url"]
             try:
-                self.ddb_client.update_item(
-                    table_name=const.PersonalLinksTable.NAME,
-                    key=self.account_survey_id,
-                    name_value_pairs={
-                        "status": "assigned",
-                        user_id_attr_name: self.anon_project_specific_user_id,
+                table.update_item(
+                    Key={
+                        const.PersonalLinksTable.PARTITION: self.account_survey_id,
+                        const.PersonalLinksTable.SORT: user_link,
+                    },
+                    UpdateExpression="SET #status = :status, "
+                    "status_expires = :status_expires, "
+                    f"{user_id_attr_name} = :user_id, "
+                    "modified = :modified "
+                    "REMOVE #ttl",  # assigned links must not be deleted by ddb TTL
+                    # the link must still exist, be unassigned and not have expired
+                    ConditionExpression=Attr(const.PersonalLinksTable.SORT).exists()
+                    & Attr(user_id_attr_name).not_exists()
+                    & (Attr(ttl_attr_name).not_exists() | Attr(ttl_attr_name).gt(now)),
+                    ExpressionAttributeNames={
+                        "#status": "status",
+                        "#ttl": ttl_attr_name,
+                    },
+                    ExpressionAttributeValues={
+                        ":status": "assigned",
+                        ":status_expires": status_expires(
+                            "assigned", unassigned_link["expires"]
+                        ),
+                        ":user_id": self.anon_project_specific_user_id,
+                        ":modified": str(utils.now_with_tz()),
                     },
-                    key_name="account_survey_id",
-                    sort_key={"url": user_link},
-                    ConditionExpression=Attr(user_id_attr_name).not_exists(),
                 )
-            except ClientError:
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                self.assignment_conflicts += 1
                 logger.info(
                     "Link assignment failed; link is already assigned to another user",
                     extra={
@@ -182,15 +789,91 @@ class PersonalLinkManager:
                 )
             else:
                 return user_link
+        return None
 
-        logger.info(
-            "Ran out of unassigned links; creating some more and retrying",
-            extra={
-                "unassigned_links": unassigned_links,
-            },
+    def _assign_link_to_user(self, unassigned_links: list) -> str:
+        """
+        Assigns to user one of the unassigned links with the soonest expiration date.
+
+        At most MAX_ASSIGNMENT_ATTEMPTS links are tried at a time. If they are all taken, the
+        list of unassigned links is fetched again once, as it is likely to be out of date;
+        if no unassigned links are left, more are created and assignment is retried. Links
+        are created at most MAX_CREATION_ROUNDS times, so that a survey whose new links keep
+        being taken does not create distributions indefinitely.
+
+        Conflicts (links found to be already taken) are added to the assignment_conflicts
+        attribute of the survey's PersonalLinkCounters item.
+
+        Args:
+            unassigned_links (list): Unassigned links for this account_survey_id in PersonalLinks table
+
+        Returns:
+            A url representing the personal link assigned to this user
+
+        """
+        logger = utils.get_logger()
+        counter = LinkPoolCounter(
+            account_survey_id=self.account_survey_id,
+            ddb_client=self.ddb_client,
         )
-        unassigned_links = self._create_personal_links()
-        return self._assign_link_to_user(unassigned_links)
+        refresh_candidates = True
+        creation_rounds = 0
+        while True:
+            candidates = self._order_candidates(unassigned_links)
+            user_link = self._claim_first_free_link(candidates)
+            if user_link is not None:
+                counter.record_assignment(conflicts=self.assignment_conflicts)
+                logger.info(
+                    "Personal link assigned",
+                    extra={
+                        "account_survey_id": self.account_survey_id,
+                        "assignment_conflicts": self.assignment_conflicts,
+                        "correlation_id": self.correlation_id,
+                    },
+                )
+                return user_link
+
+            if (
+                refresh_candidates
+                and len(candidates) > const.PersonalLinksTable.MAX_ASSIGNMENT_ATTEMPTS
+            ):
+                logger.info(
+                    "Reached maximum number of link assignment attempts; refreshing unassigned links and retrying",
+                    extra={
+                        "assignment_conflicts": self.assignment_conflicts,
+                    },
+                )
+                refresh_candidates = False
+                unassigned_links = get_unassigned_links(
+                    account_survey_id=self.account_survey_id,
+                    ddb_client=self.ddb_client,
+                    limit=const.PersonalLinksTable.CANDIDATES_PAGE_SIZE,
+                )
+                if unassigned_links:
+                    continue
+
+            if creation_rounds >= const.PersonalLinksTable.MAX_CREATION_ROUNDS:
+                counter.record_conflicts(self.assignment_conflicts)
+                raise utils.DetailedValueError(
+                    f"Could not assign a personal link after creating links {creation_rounds} times; "
+                    f"all links were taken by other users",
+                    details={
+                        "account_survey_id": self.account_survey_id,
+                        "anon_project_specific_user_id": self.anon_project_specific_user_id,
+                        "assignment_conflicts": self.assignment_conflicts,
+                        "correlation_id": self.correlation_id,
+                    },
+                )
+            logger.info(
+                "Ran out of unassigned links; creating some more and retrying",
+                extra={
+                    "unassigned_links": unassigned_links,
+                    "creation_round": creation_rounds + 1,
+                },
+            )
+            creation_rounds += 1
+            refresh_candidates = True
+            unassigned_links = self._create_personal_links_single_flight()
 
     def _put_create_personal_links_event(self):
         eb_event = eb.ThiscoveryEvent(
@@ -204,6 +887,20 @@ class PersonalLinkManager:
         )
         return eb_event.put_event()
 
+    def _request_refill(self) -> None:
+        """
+        Emits a create_personal_links event, unless another caller has done so
+        in the last EVENT_DEBOUNCE_SECONDS
+        """
+        debounce = DdbLease(
+            name=f"create_personal_links_event_{self.account_survey_id}",
+            duration=const.PersonalLinksGeneration.EVENT_DEBOUNCE_SECONDS,
+            ddb_client=self.ddb_client,
+            correlation_id=self.correlation_id,
+        )
+        if debounce.acquire():
+            self._put_create_personal_links_event()
+
     def _create_personal_links(self) -> list[dict]:
         dlg = DistributionLinksGenerator(
             account=self.account,
@@ -213,64 +910,582 @@ class PersonalLinkManager:
         )
         return dlg.generate_links_and_upload_to_dynamodb()
 
-    def get_personal_link(self) -> str:
-        try:
-            return self._query_user_link()[0]["url"]
-        except IndexError:  # user link not found; get unassigned links and assign one to user
+    def _create_personal_links_single_flight(self) -> list[dict]:
+        """
+        Creates links synchronously when none are available. Only the caller holding
+        the generation lease of this account_survey_id creates links; other callers
+        poll for the links it uploads, for up to WAIT_TIMEOUT seconds.
+
+        Returns:
+            Links that can be assigned
+        """
+        logger = utils.get_logger()
+        lease = generation_lease(
+            account_survey_id=self.account_survey_id,
+            ddb_client=self.ddb_client,
+            correlation_id=self.correlation_id,
+        )
+        deadline = time.monotonic() + const.PersonalLinksGeneration.WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            if lease.acquire():
+                try:
+                    # the previous holder may have just finished uploading links
+                    unassigned_links = get_unassigned_links(
+                        account_survey_id=self.account_survey_id,
+                        ddb_client=self.ddb_client,
+                        limit=const.PersonalLinksTable.CANDIDATES_PAGE_SIZE,
+                    )
+                    return unassigned_links or self._create_personal_links()
+                finally:
+                    lease.release()
+            time.sleep(const.PersonalLinksGeneration.POLL_INTERVAL)
             unassigned_links = get_unassigned_links(
+                account_survey_id=self.account_survey_id,
+                ddb_client=self.ddb_client,
+                limit=const.PersonalLinksTable.CANDIDATES_PAGE_SIZE,
+            )
+            if unassigned_links:
+                return unassigned_links
+        logger.warning(
+            "Timed out waiting for personal links generated by another caller; creating links",
+            extra={
+                "account_survey_id": self.account_survey_id,
+                "correlation_id": self.correlation_id,
+            },
+        )
+        return self._create_personal_links()
+
+    def _is_buffer_low(self, unassigned_links: list) -> bool:
+        # CANDIDATES_PAGE_SIZE >= FLOOR, so a short page means the buffer is low
+        # without having to read the counter
+        if len(unassigned_links) < const.PersonalLinksBuffer.FLOOR:
+            return True
+        buffer = AdaptiveBuffer.from_counter(
+            LinkPoolCounter(
                 account_survey_id=self.account_survey_id, ddb_client=self.ddb_client
             )
-            unassigned_links_len = len(unassigned_links)
-            if (
-                not unassigned_links
-            ):  # unassigned links not found; create some synchronously
-                unassigned_links = self._create_personal_links()
-            elif (
-                unassigned_links_len < const.PersonalLinksTable.BUFFER
-            ):  # create links asynchronously
-                self._put_create_personal_links_event()
+        )
+        return buffer.is_low()
+
+    def get_personal_link(self) -> str:
+        user_link = assigned_links_cache.get(
+            account_survey_id=self.account_survey_id,
+            anon_project_specific_user_id=self.anon_project_specific_user_id,
+            ddb_client=self.ddb_client,
+            correlation_id=self.correlation_id,
+        )
+        if user_link is None:
+            user_link = self._get_personal_link()
+        return user_link
+
+    def _cache_user_link(self, user_link: str) -> None:
+        assigned_links_cache.put(
+            account_survey_id=self.account_survey_id,
+            anon_project_specific_user_id=self.anon_project_specific_user_id,
+            url=user_link,
+            ddb_client=self.ddb_client,
+            correlation_id=self.correlation_id,
+        )
+
+    def _find_user_link(self) -> Optional[str]:
+        """
+        Looks up a link assigned to user by a concurrent request
+        """
+        user_link = assigned_links_cache.get(
+            account_survey_id=self.account_survey_id,
+            anon_project_specific_user_id=self.anon_project_specific_user_id,
+            ddb_client=self.ddb_client,
+            correlation_id=self.correlation_id,
+        )
+        if user_link is None:
+            if user_links := self._query_user_link():
+                user_link = user_links[0]["url"]
+                self._cache_user_link(user_link)
+        return user_link
+
+    def _get_personal_link(self) -> str:
+        try:
+            user_link = self._query_user_link()[0]["url"]
+        except IndexError:  # user link not found; get unassigned links and assign one to user
+            return self._assign_new_link_single_flight()
+        self._cache_user_link(user_link)
+        return user_link
+
+    def _assign_new_link_single_flight(self) -> str:
+        """
+        Assigns a link to user while holding a lease on this user's assignment, so that
+        concurrent requests by the same user (e.g. a page opened twice) are not given
+        different links. Requests that find the lease taken wait for the link assigned
+        by its holder, for up to WAIT_TIMEOUT seconds.
+
+        The holder caches the new link before releasing the lease, because the
+        assigned-links index may not reflect the assignment yet.
+        """
+        lease = DdbLease(
+            name=f"assign_personal_link_{self.account_survey_id}_{self.anon_project_specific_user_id}",
+            duration=const.PersonalLinksTable.USER_ASSIGNMENT_LEASE_SECONDS,
+            ddb_client=self.ddb_client,
+            correlation_id=self.correlation_id,
+        )
+        deadline = time.monotonic() + const.PersonalLinksGeneration.WAIT_TIMEOUT
+        while True:
+            if lease.acquire():
+                try:
+                    # the previous holder may have just assigned a link to user
+                    if user_link := self._find_user_link():
+                        return user_link
+                    user_link = self._assign_new_link()
+                    self._cache_user_link(user_link)
+                    return user_link
+                finally:
+                    lease.release()
+            if time.monotonic() > deadline:
+                raise utils.DetailedValueError(
+                    "Timed out waiting for a concurrent request to assign a personal link to user",
+                    details={
+                        "account_survey_id": self.account_survey_id,
+                        "anon_project_specific_user_id": self.anon_project_specific_user_id,
+                        "correlation_id": self.correlation_id,
+                    },
+                )
+            time.sleep(const.PersonalLinksGeneration.POLL_INTERVAL)
+            if user_link := self._find_user_link():
+                return user_link
 
-            user_link = self._assign_link_to_user(unassigned_links)
-            return user_link
+    def _assign_new_link(self) -> str:
+        unassigned_links = get_unassigned_links(
+            account_survey_id=self.account_survey_id,
+            ddb_client=self.ddb_client,
+            limit=const.PersonalLinksTable.CANDIDATES_PAGE_SIZE,
+        )
+        if (
+            not unassigned_links
+        ):  # unassigned links not found; create some synchronously
+            unassigned_links = self._create_personal_links_single_flight()
+        elif self._is_buffer_low(unassigned_links):  # create links asynchronously
+            self._request_refill()
+        return self._assign_link_to_user(unassigned_links)
 
 
-def get_unassigned_links(account_survey_id: str, ddb_client=None) -> list[dict]:
+def status_expires(status: str, expires: str) -> str:
     """
-    Retrieves existing personal links that have not yet been assigned to an user
+    Value of the sort key of the unassigned-links-by-expiry index
+    """
+    return f"{status}#{expires}"
+
+
+def expires_epoch(expires: str) -> int:
+    """
+    Converts the expiry date of a link into an epoch, as used by ddb TTL. Dates
+    without a timezone are taken to be in UTC.
+    """
+    expires_dt = parser.parse(expires)
+    if expires_dt.tzinfo is None:
+        expires_dt = expires_dt.replace(tzinfo=datetime.timezone.utc)
+    return int(expires_dt.timestamp())
+
+
+def is_live(link: dict, now: float = None) -> bool:
+    if now is None:
+        now = time.time()
+    return expires_epoch(link["expires"]) > now
+
+
+def utc_date(timestamp: float) -> str:
+    """
+    Date of timestamp in UTC, in the format expires values start with (YYYY-MM-DD)
+    """
+    return datetime.datetime.fromtimestamp(
+        timestamp, tz=datetime.timezone.utc
+    ).strftime("%Y-%m-%d")
+
+
+def delete_expired_links(account_survey_id: str, ddb_client=None) -> int:
+    """
+    Deletes unassigned links of account_survey_id that have expired, streaming
+    through the unassigned-links-by-expiry index from the oldest expiry date
+    until the first live link.
+
+    Links are deleted one by one, on condition that they are still unassigned,
+    because the index may not yet reflect assignments made just before a link
+    expired. The counter of unassigned links is then recounted.
+
+    Returns:
+        Number of links deleted
     """
     if ddb_client is None:
-        ddb_client = Dynamodb(stack_name=const.STACK_NAME)
-    return ddb_client.query(
-        table_name=const.PersonalLinksTable.NAME,
-        IndexName="unassigned-links",
-        KeyConditionExpression="account_survey_id = :account_survey_id "
-        "AND #status = :link_status",
-        ExpressionAttributeValues={
-            ":account_survey_id": account_survey_id,
-            ":link_status": "new",
-        },
-        ExpressionAttributeNames={
-            "#status": "status"
-        },  # needed because status is a reserved word in ddb
+        ddb_client = thiscovery_clients.get_ddb_client()
+    table = ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+    now = time.time()
+    query_kwargs = {
+        "IndexName": "unassigned-links-by-expiry",
+        "KeyConditionExpression": Key("account_survey_id").eq(account_survey_id)
+        & Key("status_expires").between(
+            status_expires("new", ""), status_expires("new", f"{utc_date(now)}~")
+        ),
+        "ScanIndexForward": True,
+    }
+    deleted = 0
+    reached_live_links = False
+    while not reached_live_links:
+        result = table.query(**query_kwargs)
+        for link in result["Items"]:
+            if is_live(link, now):
+                reached_live_links = True
+                break
+            try:
+                table.delete_item(
+                    Key={
+                        const.PersonalLinksTable.PARTITION: account_survey_id,
+                        const.PersonalLinksTable.SORT: link["url"],
+                    },
+                    ConditionExpression=Attr("status").eq("new")
+                    & Attr("anon_project_specific_user_id").not_exists(),
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+            else:
+                deleted += 1
+        last_evaluated_key = result.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            break
+        query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+    if deleted:
+        # expired links are not counted, so the counter may not include the deleted
+        # links; recount rather than subtract them
+        LinkPoolCounter(
+            account_survey_id=account_survey_id, ddb_client=ddb_client
+        ).recount()
+    return deleted
+
+
+def backfill_expiry_attributes(ddb_client=None) -> int:
+    """
+    Sets status_expires, and expires_at on unassigned links, on PersonalLinks items
+    created before those attributes were introduced. Without them, links are not in
+    the unassigned-links-by-expiry index (so they are never assigned, counted or
+    deleted once expired) and are not removed by ddb TTL. Counters of the surveys
+    whose unassigned links were updated are recounted.
+
+    One-off migration, run by admin_tasks/backfill_personal_links_expiry.py
+
+    Returns:
+        Number of links updated
+    """
+    if ddb_client is None:
+        ddb_client = thiscovery_clients.get_ddb_client()
+    table = ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+    ttl_attr_name = const.PersonalLinksTable.TTL_ATTRIBUTE
+    scan_kwargs = {"FilterExpression": Attr("status_expires").not_exists()}
+    updated = 0
+    account_survey_ids = set()
+    while True:
+        result = table.scan(**scan_kwargs)
+        for link in result["Items"]:
+            update_kwargs = {
+                "UpdateExpression": "SET status_expires = :status_expires",
+                "ExpressionAttributeValues": {
+                    ":status_expires": status_expires(link["status"], link["expires"])
+                },
+            }
+            if link["status"] == "new":
+                update_kwargs["UpdateExpression"] += ", #ttl = :ttl"
+                update_kwargs["ExpressionAttributeNames"] = {"#ttl": ttl_attr_name}
+                update_kwargs["ExpressionAttributeValues"][":ttl"] = expires_epoch(
+                    link["expires"]
+                )
+            try:
+                table.update_item(
+                    Key={
+                        const.PersonalLinksTable.PARTITION: link[
+                            const.PersonalLinksTable.PARTITION
+                        ],
+                        const.PersonalLinksTable.SORT: link["url"],
+                    },
+                    # links assigned since the scan already have status_expires
+                    ConditionExpression=Attr("status").eq(link["status"])
+                    & Attr("status_expires").not_exists(),
+                    **update_kwargs,
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+            else:
+                updated += 1
+                if link["status"] == "new":
+                    account_survey_ids.add(link[const.PersonalLinksTable.PARTITION])
+        last_evaluated_key = result.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            break
+        scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
+    for account_survey_id in account_survey_ids:
+        LinkPoolCounter(
+            account_survey_id=account_survey_id, ddb_client=ddb_client
+        ).recount()
+    return updated
+
+
+def generation_lease(
+    account_survey_id: str, ddb_client=None, correlation_id=None
+) -> DdbLease:
+    """
+    Lease that must be held to generate links for account_survey_id
+    """
+    return DdbLease(
+        name=f"personal_links_generation_{account_survey_id}",
+        duration=const.PersonalLinksGeneration.LEASE_SECONDS,
+        ddb_client=ddb_client,
+        correlation_id=correlation_id,
+    )
+
+
+def assignment_bucket_start(timestamp: float) -> int:
+    bucket_seconds = const.PersonalLinkCountersTable.ASSIGNED_BUCKET_SECONDS
+    return int(timestamp // bucket_seconds) * bucket_seconds
+
+
+def assignment_window_start(now: float = None) -> int:
+    """
+    Start epoch of the oldest assignment bucket within the sliding window of
+    AdaptiveBuffer; the window includes the current (partial) minute
+    """
+    if now is None:
+        now = time.time()
+    return (
+        assignment_bucket_start(now)
+        - (const.PersonalLinksBuffer.RATE_WINDOW_MINUTES - 1)
+        * const.PersonalLinkCountersTable.ASSIGNED_BUCKET_SECONDS
     )
 
 
+def assignment_bucket_name(timestamp: float = None) -> str:
+    """
+    Name of the PersonalLinkCounters attribute holding the number of links assigned
+    in the minute of timestamp (now by default)
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    return f"{const.PersonalLinkCountersTable.ASSIGNED_BUCKET_PREFIX}{assignment_bucket_start(timestamp)}"
+
+
+def parse_assignment_bucket_name(name: str):
+    """
+    Returns:
+        The start epoch of the bucket, or None if name is not an assignment bucket
+    """
+    prefix = const.PersonalLinkCountersTable.ASSIGNED_BUCKET_PREFIX
+    if not name.startswith(prefix):
+        return None
+    try:
+        return int(name[len(prefix) :])
+    except ValueError:
+        return None
+
+
+def expired_assignment_buckets(counter_item: dict, now: float = None) -> list:
+    """
+    Names of the assignment buckets of counter_item that are older than the
+    sliding window of AdaptiveBuffer
+    """
+    window_start = assignment_window_start(now)
+    expired = list()
+    for name in counter_item:
+        bucket_start = parse_assignment_bucket_name(name)
+        if bucket_start is not None and bucket_start < window_start:
+            expired.append(name)
+    return expired
+
+
+def _live_unassigned_links_query(account_survey_id: str, now: float) -> dict:
+    """
+    Arguments of a query of the unassigned-links-by-expiry index for the unassigned
+    links of account_survey_id that have not expired, soonest expiry first. Links that
+    expired earlier today are within the key range, so they are filtered out on
+    expires_at (links without expires_at are left for is_live to check).
+    """
+    ttl_attr_name = const.PersonalLinksTable.TTL_ATTRIBUTE
+    return {
+        "IndexName": "unassigned-links-by-expiry",
+        "KeyConditionExpression": Key("account_survey_id").eq(account_survey_id)
+        & Key("status_expires").between(
+            status_expires("new", utc_date(now)), status_expires("new", "~")
+        ),
+        "FilterExpression": Attr(ttl_attr_name).not_exists()
+        | Attr(ttl_attr_name).gt(int(now)),
+        "ScanIndexForward": True,
+    }
+
+
+def get_unassigned_links(
+    account_survey_id: str, ddb_client=None, limit: int = None
+) -> list[dict]:
+    """
+    Retrieves existing personal links that have not yet been assigned to an user
+    and have not expired
+
+    Args:
+        account_survey_id:
+        ddb_client:
+        limit: If specified, only the links with the soonest expiry dates among the
+               first limit links expiring today or later are retrieved, in a single
+               query of the unassigned-links-by-expiry index
+
+    Returns:
+        List of unassigned links, sorted by expiry date
+    """
+    if ddb_client is None:
+        ddb_client = thiscovery_clients.get_ddb_client()
+    now = time.time()
+    table = ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+    query_kwargs = _live_unassigned_links_query(account_survey_id, now)
+    if limit is not None:
+        query_kwargs["Limit"] = limit
+    links = list()
+    while True:
+        result = table.query(**query_kwargs)
+        links.extend(x for x in result["Items"] if is_live(x, now))
+        last_evaluated_key = result.get("LastEvaluatedKey")
+        if not last_evaluated_key or limit is not None:
+            return links
+        query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+
+def count_unassigned_links(
+    account_survey_id: str, ddb_client=None, up_to: int = None
+) -> int:
+    """
+    Counts existing personal links that have not yet been assigned to an user
+    and have not expired, without retrieving them
+
+    Args:
+        account_survey_id:
+        ddb_client:
+        up_to: If specified, counting stops once this number is reached
+    """
+    if ddb_client is None:
+        ddb_client = thiscovery_clients.get_ddb_client()
+    table = ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+    query_kwargs = {
+        **_live_unassigned_links_query(account_survey_id, time.time()),
+        "Select": "COUNT",
+    }
+    if up_to is not None:
+        query_kwargs["Limit"] = up_to
+    count = 0
+    while True:
+        result = table.query(**query_kwargs)
+        count += result["Count"]
+        last_evaluated_key = result.get("LastEvaluatedKey")
+        if up_to is not None and count >= up_to:
+            return up_to
+        if not last_evaluated_key:
+            return count
+        query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+
 @utils.lambda_wrapper
 def create_personal_links(event, context):
     """
     Processes create_personal_links events
     Creates new personal links in Qualtrics and stores them in ddb
     """
-    logger = event["logger"]
     dlg = DistributionLinksGenerator.from_eb_event(event)
-    if dlg.is_buffer_low():
-        return dlg.generate_links_and_upload_to_dynamodb()
+    return dlg.refill_if_buffer_low()
+
+
+@utils.lambda_wrapper
+def preassign_personal_links(event, context):
+    """
+    Processes preassign_personal_links events, whose detail contains the account,
+    survey_id and anon_project_specific_user_ids of participants to assign links to
+    """
+    dlg = DistributionLinksGenerator.from_eb_event(event)
+    try:
+        anon_project_specific_user_ids = [
+            str(utils.validate_uuid(x))
+            for x in event["detail"]["anon_project_specific_user_ids"]
+        ]
+    except KeyError as exc:
+        raise utils.DetailedValueError(
+            f"Mandatory {exc} data not found in source event",
+            details={
+                "event": event,
+            },
+        )
+    lease = generation_lease(
+        account_survey_id=dlg.account_survey_id,
+        ddb_client=dlg.ddb_client,
+        correlation_id=dlg.correlation_id,
+    )
+    if not lease.acquire():
+        raise utils.DetailedValueError(
+            "Personal links are already being generated for this survey; try again later",
+            details={
+                "account_survey_id": dlg.account_survey_id,
+            },
+        )
+    try:
+        return dlg.preassign_links(anon_project_specific_user_ids, lease=lease)
+    finally:
+        lease.release()
+
+
+@utils.lambda_wrapper
+def delete_expired_personal_links(event, context):
+    """
+    Scheduled job that deletes expired unassigned links of every account_survey_id
+    with a counter in PersonalLinkCounters. Ddb TTL eventually deletes any others,
+    but may take up to a few days to do so.
+    """
+    logger = event["logger"]
+    ddb_client = thiscovery_clients.get_ddb_client()
+    counters = ddb_client.scan(table_name=const.PersonalLinkCountersTable.NAME)
+    deleted = dict()
+    for c in counters:
+        account_survey_id = c[const.PersonalLinkCountersTable.PARTITION]
+        if n := delete_expired_links(
+            account_survey_id=account_survey_id, ddb_client=ddb_client
+        ):
+            deleted[account_survey_id] = n
+    logger.info(
+        "Deleted expired personal links",
+        extra={
+            "counters": len(counters),
+            "deleted": deleted,
+        },
+    )
+    return {"counters": len(counters), "deleted": deleted}
+
+
+@utils.lambda_wrapper
+def reconcile_personal_link_counters(event, context):
+    """
+    Scheduled job that recounts unassigned links for every account_survey_id with a
+    counter in PersonalLinkCounters, correcting any drift and removing assignment
+    buckets that have left the sliding window of AdaptiveBuffer
+    """
+    logger = event["logger"]
+    ddb_client = thiscovery_clients.get_ddb_client()
+    counters = ddb_client.scan(table_name=const.PersonalLinkCountersTable.NAME)
+    corrections = dict()
+    for c in counters:
+        account_survey_id = c[const.PersonalLinkCountersTable.PARTITION]
+        counter = LinkPoolCounter(
+            account_survey_id=account_survey_id, ddb_client=ddb_client
+        )
+        stored = int(c.get(const.PersonalLinkCountersTable.UNASSIGNED, 0))
+        actual = counter.recount(expired_buckets=expired_assignment_buckets(c))
+        if actual != stored:
+            corrections[account_survey_id] = {"stored": stored, "actual": actual}
     logger.info(
-        "Personal links buffer is not low; ignored this create_personal_links event",
+        "Reconciled personal link counters",
         extra={
-            "event": event,
+            "counters": len(counters),
+            "corrections": corrections,
         },
     )
+    return {"counters": len(counters), "corrections": corrections}
 
 
 @utils.lambda_wrapper
@@ -0,0 +1,113 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Micro-benchmark of the construction of consent e-mail properties:
+ConsentEmailPropertyBuilder against the implementation it replaced (f-string
+keys built per statement, padding loop and dateutil parsing of the consent
+timestamp on every call), which is reproduced below for reference.
+
+Usage:
+    python -m tests.load_tests.consent_email_benchmark --statements 9 --number 20000
+"""
+
+import argparse
+import datetime
+import timeit
+from dateutil import parser as dateutil_parser
+from pprint import pprint
+
+from src.common.constants import CONSENT_ROWS_IN_TEMPLATE
+from src.consent import ConsentEmailPropertyBuilder
+
+
+def legacy_email_dict(
+    consent_statements,
+    consent_datetime,
+    user_first_name,
+    consent_info_url,
+    project_short_name,
+):
+    counter = 0
+    custom_properties_dict = dict()
+    for statement_dict in consent_statements:
+        counter += 1
+        key = list(statement_dict.keys())[0]
+        custom_properties_dict[f"consent_row_{counter:02}"] = key
+        custom_properties_dict[f"consent_value_{counter:02}"] = statement_dict[key]
+    while counter < CONSENT_ROWS_IN_TEMPLATE:
+        counter += 1
+        custom_properties_dict[f"consent_row_{counter:02}"] = str()
+        custom_properties_dict[f"consent_value_{counter:02}"] = str()
+    custom_properties_dict["user_first_name"] = user_first_name
+    custom_properties_dict["consent_info_url"] = consent_info_url
+    custom_properties_dict["project_short_name"] = project_short_name
+    consent_dt = dateutil_parser.parse(consent_datetime)
+    custom_properties_dict["current_date"] = consent_dt.strftime("%e %B %Y")
+    custom_properties_dict["current_time"] = consent_dt.strftime("%H:%M")
+    return {"custom_properties": custom_properties_dict}
+
+
+def run(statements=9, number=20000) -> dict:
+    consent_statements = [
+        {f"Consent statement number {n}": "Yes" if n % 2 else "No"}
+        for n in range(statements)
+    ]
+    consent_dt = datetime.datetime(
+        2020, 11, 17, 10, 39, 58, tzinfo=datetime.timezone.utc
+    )
+    kwargs = {
+        "consent_statements": consent_statements,
+        "user_first_name": "Glenda",
+        "consent_info_url": "https://www.thiscovery.org/",
+        "project_short_name": "PSFU",
+    }
+    builder = ConsentEmailPropertyBuilder.for_template("participant_consent")
+    cases = {
+        "legacy": lambda: legacy_email_dict(consent_datetime=str(consent_dt), **kwargs),
+        "builder_timestamp": lambda: builder.email_dict(
+            consent_datetime=str(consent_dt), **kwargs
+        ),
+        "builder_datetime": lambda: builder.email_dict(
+            consent_datetime=consent_dt, **kwargs
+        ),
+    }
+    expected = cases["legacy"]()
+    for name, case in cases.items():
+        assert case() == expected, f"{name} output differs from legacy output"
+
+    report = {"statements": statements, "number": number}
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=number, repeat=3))
+        report[f"{name}_us_per_call"] = round(seconds / number * 1e6, 2)
+    for name in ["builder_timestamp", "builder_datetime"]:
+        report[f"{name}_speedup"] = round(
+            report["legacy_us_per_call"] / report[f"{name}_us_per_call"], 1
+        )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--statements", type=int, default=9)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+    pprint(run(**vars(args)), sort_dicts=False)
+
+
+if __name__ == "__main__":
+    main()
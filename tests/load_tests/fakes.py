@@ -0,0 +1,494 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+In-memory stand-ins for the thiscovery-lib Dynamodb wrapper (and the boto3 Table
+resources it hands out) and for the Qualtrics DistributionsClient, implementing
+just enough of their interfaces to exercise the personal links module locally.
+
+Conditional writes are evaluated atomically under a single lock, so the fakes
+preserve the guarantees the assignment path relies on.
+"""
+
+import copy
+import re
+import threading
+import time
+from boto3.dynamodb.conditions import Size
+from botocore.exceptions import ClientError
+from collections import Counter
+from decimal import Decimal
+from uuid import uuid4
+
+import src.common.constants as const
+
+# (partition key, sort key) of each table and index
+TABLE_KEYS = {
+    const.PersonalLinksTable.NAME: (
+        const.PersonalLinksTable.PARTITION,
+        const.PersonalLinksTable.SORT,
+    ),
+    const.PersonalLinkCountersTable.NAME: (
+        const.PersonalLinkCountersTable.PARTITION,
+        None,
+    ),
+    const.CACHE_TABLE["name"]: (const.CACHE_TABLE["partition_key"], None),
+}
+INDEX_KEYS = {
+    "unassigned-links": ("account_survey_id", "status"),
+    "assigned-links": ("anon_project_specific_user_id", "account_survey_id"),
+    "unassigned-links-by-expiry": ("account_survey_id", "status_expires"),
+}
+# non-key attributes projected into each index (see template.yaml)
+INDEX_PROJECTIONS = {
+    "unassigned-links": ("expires",),
+    "assigned-links": (),
+    "unassigned-links-by-expiry": ("expires", const.PersonalLinksTable.TTL_ATTRIBUTE),
+}
+
+
+def project_index_item(table, index_name, item):
+    """
+    Returns the copy of item held by index index_name of table: only the table and
+    index keys and the attributes the index projects
+    """
+    attributes = {
+        table.partition_key,
+        table.sort_key,
+        *INDEX_KEYS[index_name],
+        *INDEX_PROJECTIONS[index_name],
+    }
+    return {k: copy.deepcopy(v) for k, v in item.items() if k in attributes}
+
+
+def conditional_check_failed(operation_name):
+    return ClientError(
+        {
+            "Error": {
+                "Code": "ConditionalCheckFailedException",
+                "Message": "The conditional request failed",
+            }
+        },
+        operation_name,
+    )
+
+
+# predicates of the attribute_type condition, by Dynamodb type code
+ATTRIBUTE_TYPES = {
+    "S": lambda x: isinstance(x, str),
+    "N": lambda x: isinstance(x, (int, float, Decimal)) and not isinstance(x, bool),
+    "B": lambda x: isinstance(x, (bytes, bytearray)),
+    "BOOL": lambda x: isinstance(x, bool),
+    "NULL": lambda x: x is None,
+    "M": lambda x: isinstance(x, dict),
+    "L": lambda x: isinstance(x, list),
+    "SS": lambda x: isinstance(x, set) and all(isinstance(y, str) for y in x),
+    "NS": lambda x: isinstance(x, set)
+    and all(isinstance(y, (int, float, Decimal)) for y in x),
+    "BS": lambda x: isinstance(x, set) and all(isinstance(y, bytes) for y in x),
+}
+
+
+def evaluate_condition(condition, item):
+    """
+    Evaluates a boto3.dynamodb.conditions object against an item (None if the
+    item does not exist)
+    """
+    item = item or dict()
+    expression = condition.get_expression()
+    operator = expression["operator"]
+    values = expression["values"]
+    if operator == "AND":
+        return evaluate_condition(values[0], item) and evaluate_condition(
+            values[1], item
+        )
+    if operator == "OR":
+        return evaluate_condition(values[0], item) or evaluate_condition(
+            values[1], item
+        )
+    if operator == "NOT":
+        return not evaluate_condition(values[0], item)
+    name = values[0].name
+    if operator == "attribute_exists":
+        return name in item
+    if operator == "attribute_not_exists":
+        return name not in item
+    if name not in item:
+        return False
+    value = item[name]
+    if isinstance(values[0], Size):
+        value = len(value)
+    if operator == "=":
+        return value == values[1]
+    if operator == "<>":
+        return value != values[1]
+    if operator == "<":
+        return value < values[1]
+    if operator == "<=":
+        return value <= values[1]
+    if operator == ">":
+        return value > values[1]
+    if operator == ">=":
+        return value >= values[1]
+    if operator == "BETWEEN":
+        return values[1] <= value <= values[2]
+    if operator == "IN":
+        return value in values[1]
+    if operator == "begins_with":
+        return value.startswith(values[1])
+    if operator == "contains":
+        return values[1] in value
+    if operator == "attribute_type":
+        return ATTRIBUTE_TYPES[values[1]](value)
+    raise ValueError(f"Unknown condition operator {operator}")
+
+
+class FakeTableMeta:
+    def __init__(self, table):
+        self.client = table
+
+
+class FakeTable:
+    """
+    Subset of the boto3 Table resource interface
+    """
+
+    def __init__(self, ddb, name):
+        self.ddb = ddb
+        self.name = name
+        self.partition_key, self.sort_key = TABLE_KEYS[name]
+        self.items = dict()
+        self.meta = FakeTableMeta(self)
+
+    def _key(self, item):
+        return item[self.partition_key], item.get(self.sort_key)
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.ddb.simulate_latency()
+        with self.ddb.lock:
+            item = self.items.get(self._key(Key))
+            if item is None:
+                return dict()
+            return {"Item": copy.deepcopy(item)}
+
+    def put_item(self, Item, ConditionExpression=None):
+        self.ddb.simulate_latency()
+        with self.ddb.lock:
+            key = self._key(Item)
+            if ConditionExpression is not None and not evaluate_condition(
+                ConditionExpression, self.items.get(key)
+            ):
+                self.ddb.count_conditional_check_failure(self.name)
+                raise conditional_check_failed("PutItem")
+            self.items[key] = copy.deepcopy(Item)
+
+    def delete_item(self, Key, ConditionExpression=None):
+        self.ddb.simulate_latency()
+        with self.ddb.lock:
+            key = self._key(Key)
+            if ConditionExpression is not None and not evaluate_condition(
+                ConditionExpression, self.items.get(key)
+            ):
+                self.ddb.count_conditional_check_failure(self.name)
+                raise conditional_check_failed("DeleteItem")
+            self.items.pop(key, None)
+
+    def update_item(
+        self,
+        Key,
+        UpdateExpression,
+        ConditionExpression=None,
+        ExpressionAttributeNames=None,
+        ExpressionAttributeValues=None,
+    ):
+        self.ddb.simulate_latency()
+        names = ExpressionAttributeNames or dict()
+        values = ExpressionAttributeValues or dict()
+        with self.ddb.lock:
+            key = self._key(Key)
+            existing = self.items.get(key)
+            if ConditionExpression is not None and not evaluate_condition(
+                ConditionExpression, existing
+            ):
+                self.ddb.count_conditional_check_failure(self.name)
+                raise conditional_check_failed("UpdateItem")
+            item = copy.deepcopy(existing) if existing else copy.deepcopy(Key)
+            for clause, actions in re.findall(
+                r"(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)",
+                UpdateExpression.strip(),
+            ):
+                for action in [a.strip() for a in actions.split(",")]:
+                    if clause == "REMOVE":
+                        item.pop(names.get(action, action), None)
+                    elif clause == "SET":
+                        attribute, value = [x.strip() for x in action.split("=")]
+                        item[names.get(attribute, attribute)] = values[value]
+                    else:
+                        attribute, value = action.split()
+                        attribute = names.get(attribute, attribute)
+                        item[attribute] = item.get(attribute, 0) + values[value]
+            self.items[key] = item
+            return {"Attributes": copy.deepcopy(item)}
+
+    def query(
+        self,
+        KeyConditionExpression,
+        IndexName=None,
+        FilterExpression=None,
+        ProjectionExpression=None,
+        ScanIndexForward=True,
+        Limit=None,
+        Select=None,
+        ExclusiveStartKey=None,
+    ):
+        self.ddb.simulate_latency()
+        if IndexName is None:
+            partition_key, sort_key = self.partition_key, self.sort_key
+        else:
+            partition_key, sort_key = INDEX_KEYS[IndexName]
+        with self.ddb.lock:
+            matches = [
+                (
+                    copy.deepcopy(x)
+                    if IndexName is None
+                    else project_index_item(self, IndexName, x)
+                )
+                for x in self.items.values()
+                if partition_key in x
+                and (sort_key is None or sort_key in x)
+                and evaluate_condition(KeyConditionExpression, x)
+            ]
+        if sort_key is not None:
+            matches.sort(key=lambda x: x[sort_key], reverse=not ScanIndexForward)
+        start = ExclusiveStartKey["offset"] if ExclusiveStartKey else 0
+        end = len(matches) if Limit is None else start + Limit
+        page = matches[start:end]
+        if FilterExpression is not None:
+            page = [x for x in page if evaluate_condition(FilterExpression, x)]
+        if ProjectionExpression is not None:
+            attributes = [x.strip() for x in ProjectionExpression.split(",")]
+            page = [{k: v for k, v in x.items() if k in attributes} for x in page]
+        result = {"Items": page, "Count": len(page)}
+        if Select == "COUNT":
+            del result["Items"]
+        if end < len(matches):
+            result["LastEvaluatedKey"] = {"offset": end}
+        return result
+
+    def scan(self, FilterExpression=None, ExclusiveStartKey=None):
+        self.ddb.simulate_latency()
+        with self.ddb.lock:
+            items = [copy.deepcopy(x) for x in self.items.values()]
+        if FilterExpression is not None:
+            items = [x for x in items if evaluate_condition(FilterExpression, x)]
+        return {"Items": items, "Count": len(items)}
+
+    def batch_get_item(self, RequestItems):
+        request = RequestItems[self.name]
+        items = [self.get_item(Key=k).get("Item") for k in request["Keys"]]
+        items = [x for x in items if x is not None]
+        if "ProjectionExpression" in request:
+            attributes = [x.strip() for x in request["ProjectionExpression"].split(",")]
+            items = [{k: v for k, v in x.items() if k in attributes} for x in items]
+        return {"Responses": {self.name: items}, "UnprocessedKeys": dict()}
+
+    def batch_write_item(self, RequestItems):
+        for request in RequestItems[self.name]:
+            if "PutRequest" in request:
+                self.put_item(Item=request["PutRequest"]["Item"])
+            else:
+                self.delete_item(Key=request["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": dict()}
+
+
+class FakeDynamodb:
+    """
+    Subset of the thiscovery_lib.dynamodb_utilities.Dynamodb interface used by
+    this project, backed by in-memory tables
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        Args:
+            latency (float): Seconds each request to a table takes, to simulate
+                             network round trips
+        """
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.tables = {name: FakeTable(self, name) for name in TABLE_KEYS}
+        self.conditional_check_failures = Counter()
+
+    def simulate_latency(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count_conditional_check_failure(self, table_name):
+        with self.lock:
+            self.conditional_check_failures[table_name] += 1
+
+    def get_table(self, table_name):
+        return self.tables[table_name]
+
+    def get_item(
+        self, table_name, key, key_name="id", sort_key=None, correlation_id=None
+    ):
+        key_dict = {key_name: key, **(sort_key or dict())}
+        return self.get_table(table_name).get_item(Key=key_dict).get("Item")
+
+    def put_item(
+        self,
+        table_name,
+        key,
+        item_type,
+        item_details,
+        item=None,
+        update_allowed=False,
+        key_name="id",
+        sort_key=None,
+        correlation_id=None,
+    ):
+        now = time.time()
+        self.get_table(table_name).put_item(
+            Item={
+                key_name: key,
+                **(sort_key or dict()),
+                "type": item_type,
+                "details": item_details,
+                **(item or dict()),
+                "created": now,
+                "modified": now,
+            }
+        )
+
+    def batch_put_items(
+        self, table_name, items, partition_key_name, item_type=None, **kwargs
+    ):
+        for i in items:
+            self.get_table(table_name).put_item(Item={"type": item_type, **i})
+
+    def delete_item(
+        self, table_name, key, key_name="id", sort_key=None, correlation_id=None
+    ):
+        key_dict = {key_name: key, **(sort_key or dict())}
+        self.get_table(table_name).delete_item(Key=key_dict)
+
+    def scan(self, table_name, **kwargs):
+        table = self.get_table(table_name)
+        table.ddb.simulate_latency()
+        with self.lock:
+            return [copy.deepcopy(x) for x in table.items.values()]
+
+    def query(
+        self,
+        table_name,
+        KeyConditionExpression,
+        ExpressionAttributeValues,
+        IndexName=None,
+        ExpressionAttributeNames=None,
+        **kwargs,
+    ):
+        """
+        Supports key conditions of the form "a = :a AND #b = :b"
+        """
+        names = ExpressionAttributeNames or dict()
+        conditions = dict()
+        for condition in KeyConditionExpression.split(" AND "):
+            attribute, value = [x.strip() for x in condition.split("=")]
+            conditions[names.get(attribute, attribute)] = ExpressionAttributeValues[
+                value
+            ]
+        table = self.get_table(table_name)
+        table.ddb.simulate_latency()
+        if IndexName is None:
+            key_names = (table.partition_key, table.sort_key)
+        else:
+            key_names = INDEX_KEYS[IndexName]
+        with self.lock:
+            return [
+                (
+                    copy.deepcopy(x)
+                    if IndexName is None
+                    else project_index_item(table, IndexName, x)
+                )
+                for x in table.items.values()
+                if all(k in x for k in key_names if k is not None)
+                and all(x.get(k) == v for k, v in conditions.items())
+            ]
+
+
+class FakeDistributionsClient:
+    """
+    Subset of the thiscovery_lib.qualtrics.DistributionsClient interface. Each
+    distribution holds one link per contact in the contact list, returned in
+    pages of page_size links.
+    """
+
+    def __init__(self, contacts=50, page_size=50, latency=0.0):
+        """
+        Args:
+            contacts (int): Number of contacts in the contact list
+            page_size (int): Number of links per page of list_distribution_links
+            latency (float): Seconds each Qualtrics call takes
+        """
+        self.contacts = contacts
+        self.page_size = page_size
+        self.latency = latency
+        self.distributions = dict()
+        self.lock = threading.Lock()
+
+    def _page(self, distribution_id, offset):
+        links = self.distributions[distribution_id]
+        next_offset = offset + self.page_size
+        next_page = None
+        if next_offset < len(links):
+            next_page = (
+                f"https://fake.qualtrics.com/{distribution_id}?skipToken={next_offset}"
+            )
+        return {
+            "result": {
+                "elements": copy.deepcopy(links[offset:next_offset]),
+                "nextPage": next_page,
+            }
+        }
+
+    def create_individual_links(self, survey_id, contact_list_id):
+        time.sleep(self.latency)
+        distribution_id = f"EMD_{uuid4().hex[:15]}"
+        links = [
+            {
+                "contactId": f"CID_{uuid4().hex[:15]}",
+                "link": f"https://fake.qualtrics.com/jfe/form/{survey_id}?Q_DL={uuid4().hex}",
+                "linkExpiration": "2099-12-31 00:00:00",
+                "externalDataReference": "",
+                "status": "Email not sent",
+            }
+            for _ in range(self.contacts)
+        ]
+        with self.lock:
+            self.distributions[distribution_id] = links
+        return {"result": {"id": distribution_id}}
+
+    def list_distribution_links(self, distribution_id, survey_id):
+        time.sleep(self.latency)
+        return self._page(distribution_id, 0)
+
+    def qualtrics_request(self, method, url, **kwargs):
+        time.sleep(self.latency)
+        distribution_id, skip_token = re.search(
+            r"/(EMD_\w+)\?skipToken=(\d+)", url
+        ).groups()
+        return self._page(distribution_id, int(skip_token))
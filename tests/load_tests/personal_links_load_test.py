@@ -0,0 +1,243 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+"""
+Load test of the personal link assignment path (PersonalLinkManager.get_personal_link)
+against in-memory fakes of Dynamodb and DistributionsClient.
+
+Drives concurrent get_personal_link calls (including repeat calls by the same
+users) and reports throughput, latency percentiles, conditional-write conflicts,
+Qualtrics distributions created and any duplicate-assignment violations.
+create_personal_links events are processed inline, in a background thread.
+Exits with a non-zero status if any violation is found.
+
+Usage:
+    python -m tests.load_tests.personal_links_load_test --users 500 --concurrency 50
+"""
+
+import argparse
+import logging
+import math
+import random
+import statistics
+import sys
+import threading
+import time
+import thiscovery_lib.qualtrics as qualtrics
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pprint import pprint
+from unittest import mock
+from uuid import uuid4
+
+import src.personal_links as pl
+from tests.load_tests.fakes import FakeDistributionsClient, FakeDynamodb
+
+ACCOUNT = "cambridge"
+SURVEY_ID = "SV_loadtest"
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[max(index, 0)]
+
+
+class PersonalLinksLoadTest:
+    def __init__(
+        self,
+        users=500,
+        concurrency=50,
+        repeat_fraction=0.2,
+        initial_links=0,
+        contacts=50,
+        page_size=50,
+        ddb_latency=0.005,
+        qualtrics_latency=0.2,
+        seed=None,
+    ):
+        """
+        Args:
+            users (int): Number of distinct participants requesting a link
+            concurrency (int): Number of concurrent callers
+            repeat_fraction (float): Fraction of participants who request their link a second time
+            initial_links (int): Number of unassigned links in the pool when the test starts
+            contacts (int): Number of links in each distribution
+            page_size (int): Number of links per page of list_distribution_links
+            ddb_latency (float): Seconds each ddb request takes
+            qualtrics_latency (float): Seconds each Qualtrics request takes
+            seed: Seed of the random ordering of calls
+        """
+        self.users = users
+        self.concurrency = concurrency
+        self.repeat_fraction = repeat_fraction
+        self.initial_links = initial_links
+        self.ddb = FakeDynamodb(latency=ddb_latency)
+        self.dist_client = FakeDistributionsClient(
+            contacts=contacts, page_size=page_size, latency=qualtrics_latency
+        )
+        self.random = random.Random(seed)
+        self.events = 0
+        self.events_lock = threading.Lock()
+        self.event_executor = None
+
+    def _generator(self):
+        return pl.DistributionLinksGenerator(
+            account=ACCOUNT,
+            survey_id=SURVEY_ID,
+            contact_list_id=pl.const.DISTRIBUTION_LISTS[ACCOUNT]["id"],
+        )
+
+    def _put_create_personal_links_event(self):
+        """
+        Replaces the EventBridge event; the create_personal_links handler is run
+        in a background thread instead
+        """
+        with self.events_lock:
+            self.events += 1
+        self.event_executor.submit(self._generator().refill_if_buffer_low)
+
+    def _call(self, anon_project_specific_user_id):
+        plm = pl.PersonalLinkManager(
+            survey_id=SURVEY_ID,
+            anon_project_specific_user_id=anon_project_specific_user_id,
+            account=ACCOUNT,
+        )
+        start = time.perf_counter()
+        try:
+            link = plm.get_personal_link()
+            error = None
+        except Exception as err:
+            link = None
+            error = repr(err)
+        return {
+            "user": anon_project_specific_user_id,
+            "link": link,
+            "error": error,
+            "latency": time.perf_counter() - start,
+            "conflicts": plm.assignment_conflicts,
+        }
+
+    def _check_assignments(self, results):
+        users_by_link = defaultdict(set)
+        links_by_user = defaultdict(set)
+        for r in results:
+            if r["link"] is not None:
+                users_by_link[r["link"]].add(r["user"])
+                links_by_user[r["user"]].add(r["link"])
+        stored_links_by_user = defaultdict(set)
+        for item in self.ddb.scan(table_name=pl.const.PersonalLinksTable.NAME):
+            if user := item.get("anon_project_specific_user_id"):
+                stored_links_by_user[user].add(item["url"])
+        return {
+            "links_returned_to_several_users": sum(
+                1 for x in users_by_link.values() if len(x) > 1
+            ),
+            "users_given_different_links": sum(
+                1 for x in links_by_user.values() if len(x) > 1
+            ),
+            "users_assigned_several_links_in_ddb": sum(
+                1 for x in stored_links_by_user.values() if len(x) > 1
+            ),
+            "returned_links_not_assigned_in_ddb": sum(
+                1
+                for user, links in links_by_user.items()
+                if not links.issubset(stored_links_by_user[user])
+            ),
+        }
+
+    def run(self) -> dict:
+        pl.thiscovery_clients.set_ddb_client(self.ddb)
+        pl.qualtrics_clients.set_client(
+            qualtrics.DistributionsClient,
+            self.dist_client,
+            qualtrics_account_name=ACCOUNT,
+        )
+        pl.assigned_links_cache.clear()
+        logging.disable(logging.INFO)
+        try:
+            for _ in range(math.ceil(self.initial_links / self.dist_client.contacts)):
+                self._generator().generate_links_and_upload_to_dynamodb()
+            initial_distributions = len(self.dist_client.distributions)
+
+            users = [str(uuid4()) for _ in range(self.users)]
+            calls = users + self.random.sample(
+                users, int(self.users * self.repeat_fraction)
+            )
+            self.random.shuffle(calls)
+            with ThreadPoolExecutor(max_workers=4) as self.event_executor:
+                with mock.patch.object(
+                    pl.PersonalLinkManager,
+                    "_put_create_personal_links_event",
+                    self._put_create_personal_links_event,
+                ):
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                        results = list(executor.map(self._call, calls))
+                    elapsed = time.perf_counter() - start
+        finally:
+            logging.disable(logging.NOTSET)
+            pl.thiscovery_clients.clear()
+            pl.qualtrics_clients.clear()
+            pl.assigned_links_cache.clear()
+
+        latencies = sorted(r["latency"] for r in results)
+        errors = [r["error"] for r in results if r["error"] is not None]
+        return {
+            "calls": len(calls),
+            "users": self.users,
+            "concurrency": self.concurrency,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_per_second": round(len(calls) / elapsed, 1),
+            "latency_ms": {
+                "mean": round(statistics.mean(latencies) * 1000, 1),
+                "p50": round(percentile(latencies, 50) * 1000, 1),
+                "p99": round(percentile(latencies, 99) * 1000, 1),
+                "max": round(latencies[-1] * 1000, 1),
+            },
+            "errors": len(errors),
+            "error_examples": errors[:5],
+            "assignment_conflicts": sum(r["conflicts"] for r in results),
+            "conditional_check_failures": dict(self.ddb.conditional_check_failures),
+            "create_personal_links_events": self.events,
+            "distributions_created": len(self.dist_client.distributions)
+            - initial_distributions,
+            "violations": self._check_assignments(results),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--repeat-fraction", type=float, default=0.2)
+    parser.add_argument("--initial-links", type=int, default=0)
+    parser.add_argument("--contacts", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--ddb-latency", type=float, default=0.005)
+    parser.add_argument("--qualtrics-latency", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    report = PersonalLinksLoadTest(**vars(args)).run()
+    pprint(report, sort_dicts=False)
+    if violations := {k: v for k, v in report["violations"].items() if v}:
+        sys.exit(f"Personal link assignment violations found: {violations}")
+
+
+if __name__ == "__main__":
+    main()
@@ -19,6 +19,7 @@ import local.dev_config  # set env variables
 import local.secrets  # set env variables
 import os
 import src.common.constants as const
+import src.personal_links as pl
 import thiscovery_dev_tools.test_data.survey_personal_links as td
 from thiscovery_lib.dynamodb_utilities import Dynamodb
 from uuid import uuid4
@@ -49,16 +50,25 @@ class DdbMixin:
             key_name=const.PersonalLinksTable.PARTITION,
             sort_key_name=const.PersonalLinksTable.SORT,
         )
+        cls.ddb_client.delete_all(
+            table_name=const.PersonalLinkCountersTable.NAME,
+            key_name=const.PersonalLinkCountersTable.PARTITION,
+        )
 
     @classmethod
     def add_unassigned_links_to_personal_links_table(cls, n: int) -> None:
         cls.get_ddb_client()
+        expires = "2099-12-31 00:00:00"
         cls.ddb_client.batch_put_items(
             table_name=const.PersonalLinksTable.NAME,
             items=[
                 {
                     **td.TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM,
                     "url": f"https://www.thiscovery.org?random_id={str(uuid4())}",
+                    # expired links are never assigned
+                    "expires": expires,
+                    "status_expires": pl.status_expires("new", expires),
+                    const.PersonalLinksTable.TTL_ATTRIBUTE: pl.expires_epoch(expires),
                 }
                 for _ in range(abs(n))
             ],
@@ -18,15 +18,26 @@
 import local.dev_config  # sets env variables TEST_ON_AWS and AWS_TEST_API
 import local.secrets  # sets env variables THISCOVERY_AFS25_PROFILE and THISCOVERY_AMP205_PROFILE
 import copy
+import datetime
 import json
+import threading
+import time
 from http import HTTPStatus
 from pprint import pprint
+from unittest import mock
 
 import thiscovery_lib.utilities as utils
 import src.endpoints as ep
 import thiscovery_dev_tools.testing_tools as test_utils
-from src.consent import Consent, ConsentEvent
+from src.consent import (
+    Consent,
+    ConsentEmailPropertyBuilder,
+    ConsentEvent,
+    send_queued_consent_email,
+)
 from src.common.constants import (
+    CONSENT_DATA_TABLE,
+    CONSENT_EMAIL_CLAIM_TIMEOUT_SECONDS,
     CONSENT_ROWS_IN_TEMPLATE,
     DEFAULT_CONSENT_EMAIL_TEMPLATE,
 )
@@ -254,3 +265,216 @@ class ConsentEventTestCase(test_utils.BaseTestCase):
             }
         )
         self.assertEqual(expected_body, result["body"])
+
+    def test_11_parse_async_queues_notification(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        ce.async_notification = True
+        with mock.patch(
+            "src.consent.eb.ThiscoveryEvent"
+        ) as mock_event, mock.patch.object(
+            ConsentEvent, "_notify_participant"
+        ) as mock_notify:
+            dump_result, notification_result = ce.parse()
+        self.assertEqual(HTTPStatus.OK, dump_result)
+        self.assertEqual(HTTPStatus.ACCEPTED, notification_result)
+        mock_notify.assert_not_called()
+        (eb_event,), _ = mock_event.call_args
+        self.assertEqual("consent_email_requested", eb_event["detail-type"])
+        self.assertEqual(ce.email_request(), eb_event["detail"])
+
+    def test_12_send_queued_consent_email_is_idempotent(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        ce.consent.ddb_dump()
+        email_request = ce.email_request()
+        logger = utils.get_logger()
+        self.assertEqual(
+            HTTPStatus.NO_CONTENT,
+            send_queued_consent_email(email_request=email_request, logger=logger),
+        )
+        self.assertIsNone(
+            send_queued_consent_email(email_request=email_request, logger=logger)
+        )
+        ce.consent.modified = None
+        ce.consent.ddb_load()
+        self.now_datetime_test_and_remove(
+            entity_dict=ce.consent.__dict__,
+            datetime_attribute_name="notification_sent",
+        )
+
+    def test_13_send_queued_consent_emails_reports_failures(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        ce.consent.ddb_dump()
+        missing_consent_request = {
+            **ce.email_request(),
+            "consent_id": "5ae2ebdd-4bbd-4ec9-a1e9-4c6c0b5e3ca2",
+        }
+        event = {
+            "Records": [
+                {
+                    "messageId": "message-1",
+                    "body": json.dumps({"detail": ce.email_request()}),
+                },
+                {
+                    "messageId": "message-2",
+                    "body": json.dumps({"detail": missing_consent_request}),
+                },
+            ]
+        }
+        result = ep.send_queued_consent_emails(event, None)
+        self.assertEqual(
+            {"batchItemFailures": [{"itemIdentifier": "message-2"}]}, result
+        )
+
+    def test_14_parse_stores_and_notifies_concurrently(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        barrier = threading.Barrier(2, timeout=5)
+
+        def ddb_dump(*args, **kwargs):
+            barrier.wait()
+            return HTTPStatus.OK
+
+        def notify_participant(*args, **kwargs):
+            barrier.wait()
+            return {"statusCode": HTTPStatus.NO_CONTENT}
+
+        with mock.patch.object(
+            Consent, "ddb_dump", side_effect=ddb_dump
+        ), mock.patch.object(
+            ConsentEvent, "_notify_participant", side_effect=notify_participant
+        ):
+            dump_result, notification_result = ce.parse()
+        self.assertEqual(HTTPStatus.OK, dump_result)
+        self.assertEqual(HTTPStatus.NO_CONTENT, notification_result)
+
+    def test_15_parse_storage_failure_is_logged(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        with mock.patch.object(
+            Consent, "ddb_dump", side_effect=RuntimeError("ddb unavailable")
+        ), mock.patch.object(
+            ConsentEvent,
+            "_notify_participant",
+            return_value={"statusCode": HTTPStatus.NO_CONTENT},
+        ):
+            dump_result, notification_result = ce.parse()
+        self.assertIsNone(dump_result)
+        self.assertEqual(HTTPStatus.NO_CONTENT, notification_result)
+
+    def test_16_parse_notification_failure_raises(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        with mock.patch.object(
+            Consent, "ddb_dump", return_value=HTTPStatus.OK
+        ) as mock_dump, mock.patch.object(
+            ConsentEvent,
+            "_notify_participant",
+            side_effect=RuntimeError("core API unavailable"),
+        ):
+            with self.assertRaises(RuntimeError):
+                ce.parse()
+        mock_dump.assert_called_once()
+
+    def test_17_email_property_builder_shared_per_template(self):
+        builder = ConsentEmailPropertyBuilder.for_template(
+            DEFAULT_CONSENT_EMAIL_TEMPLATE
+        )
+        self.assertIs(builder, self.ce.email_property_builder)
+        self.assertEqual(CONSENT_ROWS_IN_TEMPLATE, builder.rows_in_template)
+        self.assertEqual(2 * CONSENT_ROWS_IN_TEMPLATE, len(builder.empty_rows))
+
+    def test_18_email_dict_accepts_datetimes_and_timestamps(self):
+        builder = ConsentEmailPropertyBuilder.for_template(
+            DEFAULT_CONSENT_EMAIL_TEMPLATE
+        )
+        kwargs = {
+            "consent_statements": [{"I agree to take part": "Yes"}],
+            "user_first_name": "Glenda",
+            "consent_info_url": "https://www.thiscovery.org/",
+            "project_short_name": "PSFU",
+        }
+        consent_dt = datetime.datetime(
+            2020, 11, 17, 10, 39, 58, tzinfo=datetime.timezone.utc
+        )
+        email_dict = builder.email_dict(consent_datetime=consent_dt, **kwargs)
+        self.assertEqual(
+            email_dict,
+            builder.email_dict(consent_datetime=str(consent_dt), **kwargs),
+        )
+        properties = email_dict["custom_properties"]
+        self.assertEqual("17 November 2020", properties["current_date"])
+        self.assertEqual("10:39", properties["current_time"])
+        self.assertEqual("I agree to take part", properties["consent_row_01"])
+        self.assertEqual("Yes", properties["consent_value_01"])
+        self.assertEqual("", properties["consent_row_02"])
+
+    def test_19_send_queued_consent_email_releases_claim_on_failure(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        ce.consent.ddb_dump()
+        email_request = ce.email_request()
+        logger = utils.get_logger()
+        with mock.patch.object(
+            ConsentEvent,
+            "_notify_participant",
+            side_effect=RuntimeError("core API unavailable"),
+        ):
+            with self.assertRaises(RuntimeError):
+                send_queued_consent_email(email_request=email_request, logger=logger)
+        ce.consent.modified = None
+        ce.consent.ddb_load()
+        self.assertNotIn("notification_sent", ce.consent.__dict__)
+        self.assertNotIn("notification_claimed_at", ce.consent.__dict__)
+        self.assertEqual(
+            HTTPStatus.NO_CONTENT,
+            send_queued_consent_email(email_request=email_request, logger=logger),
+        )
+
+    def test_20_parse_project_lookup_failure_is_logged(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        with mock.patch.object(
+            Consent, "_get_project", side_effect=RuntimeError("core API unavailable")
+        ), mock.patch.object(Consent, "ddb_dump") as mock_dump, mock.patch.object(
+            ConsentEvent,
+            "_notify_participant",
+            return_value={"statusCode": HTTPStatus.NO_CONTENT},
+        ) as mock_notify:
+            dump_result, notification_result = ce.parse()
+        self.assertIsNone(dump_result)
+        self.assertEqual(HTTPStatus.NO_CONTENT, notification_result)
+        mock_dump.assert_not_called()
+        mock_notify.assert_called_once()
+
+    def test_21_send_queued_consent_email_takes_over_expired_claims(self):
+        ce = ConsentEvent(TEST_CONSENT_EVENT)
+        ce.consent.ddb_dump()
+        email_request = ce.email_request()
+        logger = utils.get_logger()
+        table = ce.consent._ddb_client.get_table(table_name=CONSENT_DATA_TABLE)
+        claimed_at = int(time.time())
+
+        def set_claim(timestamp):
+            table.update_item(
+                Key=ce.consent._key(),
+                UpdateExpression="SET notification_claimed_at = :claimed_at",
+                ExpressionAttributeValues={":claimed_at": timestamp},
+            )
+
+        set_claim(claimed_at)  # e.g. left by an invocation that timed out
+        with self.assertRaises(utils.DetailedValueError):
+            send_queued_consent_email(email_request=email_request, logger=logger)
+        set_claim(claimed_at - CONSENT_EMAIL_CLAIM_TIMEOUT_SECONDS - 1)
+        self.assertEqual(
+            HTTPStatus.NO_CONTENT,
+            send_queued_consent_email(email_request=email_request, logger=logger),
+        )
+        ce.consent.modified = None
+        ce.consent.ddb_load()
+        self.assertNotIn("notification_claimed_at", ce.consent.__dict__)
+        self.assertIn("notification_sent", ce.consent.__dict__)
+
+    def test_22_async_notification_parsed_as_boolean(self):
+        for value, expected in [("false", False), ("True", True), (True, True)]:
+            body = json.loads(TEST_CONSENT_EVENT["body"])
+            body["async_notification"] = value
+            ce = ConsentEvent({**TEST_CONSENT_EVENT, "body": json.dumps(body)})
+            self.assertIs(expected, ce.async_notification)
+        body["async_notification"] = "yes"
+        with self.assertRaises(utils.DetailedValueError):
+            ConsentEvent({**TEST_CONSENT_EVENT, "body": json.dumps(body)})
@@ -0,0 +1,156 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import local.dev_config  # sets env variables TEST_ON_AWS and AWS_TEST_API
+import local.secrets  # sets env variables THISCOVERY_AFS25_PROFILE and THISCOVERY_AMP205_PROFILE
+import csv
+import io
+import json
+import thiscovery_dev_tools.testing_tools as test_utils
+from unittest import mock
+
+import src.consent_ingestion as ci
+from src.common.constants import CONSENT_DATA_TABLE
+from tests.test_data import TEST_CONSENT_EVENT
+
+
+class TestConsentIngestion(test_utils.BaseTestCase):
+    row = json.loads(TEST_CONSENT_EVENT["body"])
+
+    def setUp(self):
+        self.files = dict()
+        s3_client = mock.MagicMock()
+        s3_client.get_object.side_effect = lambda Bucket, Key: {
+            "Body": io.BytesIO(self.files[Key].encode("utf-8"))
+        }
+        ci.thiscovery_clients.set_s3_client(s3_client)
+        self.ddb_client = ci.thiscovery_clients.get_ddb_client()
+        self.ddb_client.delete_all(
+            table_name=CONSENT_DATA_TABLE,
+            key_name="project_task_id",
+            sort_key_name="consent_id",
+        )
+
+    def tearDown(self):
+        ci.thiscovery_clients.set_s3_client(None)
+
+    def test_01_ingest_jsonl_ok(self):
+        row_without_first_name = {
+            k: v for k, v in self.row.items() if k != "first_name"
+        }
+        self.files["consents.jsonl"] = "\n".join(
+            json.dumps(x) for x in [self.row, self.row, row_without_first_name]
+        )
+        job = ci.ConsentIngestionJob(key="consents.jsonl", bucket="test-bucket")
+        summary = job.run()
+        self.assertEqual(3, summary["rows"])
+        self.assertEqual(1, summary["written"])
+        self.assertEqual(1, summary["duplicates"])
+        self.assertIsNone(summary["next_row"])
+        self.assertEqual(
+            [{"row": 2, "stage": "parse", "error": "KeyError('first_name')"}],
+            summary["errors"],
+        )
+        self.assertEqual(1, len(self.ddb_client.scan(table_name=CONSENT_DATA_TABLE)))
+
+    def test_02_ingest_csv_hands_over_to_continuation_event(self):
+        other_user_task_row = {
+            **self.row,
+            "anon_user_task_id": "8d0b7a9e-1a55-4b6e-a3b4-0c4a1e8b8f8a",
+        }
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=list(self.row))
+        writer.writeheader()
+        writer.writerows([self.row, other_user_task_row])
+        self.files["consents.csv"] = output.getvalue()
+        context = mock.MagicMock()
+        context.get_remaining_time_in_millis.return_value = 0
+        job = ci.ConsentIngestionJob(
+            key="consents.csv", bucket="test-bucket", chunk_size=1
+        )
+        with mock.patch.object(ci.eb, "ThiscoveryEvent") as mock_event:
+            summary = job.run(context=context)
+        self.assertEqual(1, summary["written"])
+        self.assertEqual(1, summary["next_row"])
+        (eb_event,), _ = mock_event.call_args
+        self.assertEqual("ingest_consents", eb_event["detail-type"])
+        self.assertEqual(job.as_event_detail(start_row=1), eb_event["detail"])
+
+    def test_03_rows_without_consent_datetime_rejected(self):
+        row_without_datetime = {
+            k: v for k, v in self.row.items() if k != "consent_datetime"
+        }
+        self.files["consents.jsonl"] = json.dumps(row_without_datetime)
+        job = ci.ConsentIngestionJob(key="consents.jsonl", bucket="test-bucket")
+        summary = job.run()
+        self.assertEqual(0, summary["written"])
+        self.assertEqual(
+            [
+                {
+                    "row": 0,
+                    "stage": "parse",
+                    "error": "DetailedValueError('Row has no consent_datetime')",
+                }
+            ],
+            summary["errors"],
+        )
+
+    def test_04_consent_emails_queued_in_batches(self):
+        rows = [
+            {**self.row, "consent_datetime": f"2020-11-17T10:{m:02d}:58+00:00"}
+            for m in range(12)
+        ]
+        self.files["consents.jsonl"] = "\n".join(json.dumps(x) for x in rows)
+        job = ci.ConsentIngestionJob(
+            key="consents.jsonl", bucket="test-bucket", queue_emails=True
+        )
+        with mock.patch.object(ci.eb, "EventbridgeClient") as mock_client:
+            put_events = mock_client.return_value.client.put_events
+            put_events.side_effect = lambda Entries: {
+                "Entries": [{"EventId": "event-id"} for _ in Entries]
+            }
+            summary = job.run()
+        self.assertEqual(12, summary["written"])
+        self.assertEqual(12, summary["queued_emails"])
+        self.assertEqual(
+            [10, 2], [len(c.kwargs["Entries"]) for c in put_events.call_args_list]
+        )
+
+    def test_05_rerun_skips_consents_already_stored(self):
+        self.files["consents.jsonl"] = json.dumps(self.row)
+        ci.ConsentIngestionJob(key="consents.jsonl", bucket="test-bucket").run()
+        table = self.ddb_client.get_table(table_name=CONSENT_DATA_TABLE)
+        (item,) = self.ddb_client.scan(table_name=CONSENT_DATA_TABLE)
+        key = {k: item[k] for k in ["project_task_id", "consent_id"]}
+        table.update_item(
+            Key=key,
+            UpdateExpression="SET notification_sent = :notification_sent",
+            ExpressionAttributeValues={":notification_sent": "2020-11-17 10:45:00"},
+        )
+        job = ci.ConsentIngestionJob(
+            key="consents.jsonl", bucket="test-bucket", queue_emails=True
+        )
+        with mock.patch.object(ci.eb, "EventbridgeClient") as mock_client:
+            summary = job.run()
+        self.assertEqual(0, summary["written"])
+        self.assertEqual(1, summary["duplicates"])
+        self.assertEqual(0, summary["queued_emails"])
+        mock_client.return_value.client.put_events.assert_not_called()
+        self.assertEqual(
+            "2020-11-17 10:45:00",
+            table.get_item(Key=key)["Item"]["notification_sent"],
+        )
@@ -23,10 +23,12 @@ import thiscovery_dev_tools.testing_tools as test_utils
 import thiscovery_lib.utilities as utils
 from http import HTTPStatus
 from pprint import pprint
+from unittest import mock
 from thiscovery_lib.dynamodb_utilities import Dynamodb
 
 import src.common.constants as const
 import src.endpoints as ep
+from src.common.survey_definition import SurveyDefinition
 import tests.test_data as td
 
 
@@ -125,12 +127,32 @@ class TestGetInterviewQuestions(test_utils.BaseTestCase):
 
 
 class TestPutInterviewQuestions(test_utils.BaseTestCase):
+    @staticmethod
+    def clear_sync_state(survey_id):
+        ddb_client = Dynamodb(stack_name=const.STACK_NAME)
+        ddb_client.delete_item(
+            table_name=const.CACHE_TABLE["name"],
+            key=f"interview_questions_sync_{survey_id}",
+            key_name=const.CACHE_TABLE["partition_key"],
+        )
+
+    def setUp(self):
+        super().setUp()
+        for event in [
+            td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT,
+            td.TEST_INTERVIEW_QUESTIONS_UPDATED_ON_THIS_ACCOUNT_EB_EVENT,
+        ]:
+            self.clear_sync_state(event["detail"]["survey_id"])
+
     def test_put_interview_questions_ok(self):
         test_event = copy.deepcopy(td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT)
         result = ep.put_interview_questions(test_event, None)
         self.assertEqual(HTTPStatus.OK, result["statusCode"])
-        updated_question_ids, deleted_question_ids = json.loads(result["body"])
-        self.assertEqual(4, len(updated_question_ids))
+        summary = json.loads(result["body"])
+        self.assertEqual(
+            4,
+            len(summary["added"] + summary["updated"] + summary["unchanged"]),
+        )
 
     def test_put_interview_questions_from_THIS_account_ok(self):
         test_event = copy.deepcopy(
@@ -138,8 +160,11 @@ class TestPutInterviewQuestions(test_utils.BaseTestCase):
         )
         result = ep.put_interview_questions(test_event, None)
         self.assertEqual(HTTPStatus.OK, result["statusCode"])
-        updated_question_ids, deleted_question_ids = json.loads(result["body"])
-        self.assertEqual(4, len(updated_question_ids))
+        summary = json.loads(result["body"])
+        self.assertEqual(
+            4,
+            len(summary["added"] + summary["updated"] + summary["unchanged"]),
+        )
 
     def test_put_interview_missing_account_info(self):
         test_event = copy.deepcopy(td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT)
@@ -189,6 +214,59 @@ class TestPutInterviewQuestions(test_utils.BaseTestCase):
         test_event = copy.deepcopy(td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT)
         result = ep.put_interview_questions(test_event, None)
         self.assertEqual(HTTPStatus.OK, result["statusCode"])
-        updated_question_ids, deleted_question_ids = json.loads(result["body"])
-        self.assertEqual(4, len(updated_question_ids))
-        self.assertEqual([mock_deleted_question["question_id"]], deleted_question_ids)
+        summary = json.loads(result["body"])
+        self.assertEqual(
+            4,
+            len(summary["added"] + summary["updated"] + summary["unchanged"]),
+        )
+        self.assertEqual([mock_deleted_question["question_id"]], summary["deleted"])
+
+    def test_put_interview_questions_unchanged_questions_not_rewritten(self):
+        test_event = copy.deepcopy(td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT)
+        ep.put_interview_questions(copy.deepcopy(test_event), None)
+        self.clear_sync_state(test_event["detail"]["survey_id"])
+        result = ep.put_interview_questions(test_event, None)
+        self.assertEqual(HTTPStatus.OK, result["statusCode"])
+        summary = json.loads(result["body"])
+        self.assertEqual(4, len(summary["unchanged"]))
+        self.assertEqual([], summary["added"] + summary["updated"] + summary["deleted"])
+
+    def test_put_interview_questions_duplicate_event_skipped(self):
+        test_event = copy.deepcopy(td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT)
+        first_result = ep.put_interview_questions(copy.deepcopy(test_event), None)
+        self.assertFalse(json.loads(first_result["body"])["skipped"])
+        result = ep.put_interview_questions(test_event, None)
+        self.assertEqual(HTTPStatus.OK, result["statusCode"])
+        self.assertTrue(json.loads(result["body"])["skipped"])
+
+    def test_put_interview_questions_stores_document(self):
+        test_event = copy.deepcopy(td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT)
+        survey_id = test_event["detail"]["survey_id"]
+        ep.put_interview_questions(test_event, None)
+        document = SurveyDefinition.ddb_load_interview_questions_document(survey_id)
+        self.assertEqual(survey_id, document["survey_id"])
+        self.assertEqual(4, document["count"])
+        sequence_nos = [
+            q["sequence_no"] for b in document["blocks"] for q in b["questions"]
+        ]
+        self.assertEqual(["1", "2", "3", "4"], sequence_nos)
+
+    def test_put_interview_questions_no_questions_removes_document(self):
+        test_event = copy.deepcopy(td.TEST_INTERVIEW_QUESTIONS_UPDATED_EB_EVENT)
+        survey_id = test_event["detail"]["survey_id"]
+        ep.put_interview_questions(copy.deepcopy(test_event), None)
+        ep.SurveyDefinition.get_interview_questions(survey_id)  # warm memory cache
+        self.clear_sync_state(survey_id)
+        with mock.patch.object(
+            ep.SurveyDefinition,
+            "get_interview_question_list_from_Qualtrics",
+            return_value=list(),
+        ):
+            result = ep.put_interview_questions(test_event, None)
+        self.assertEqual(HTTPStatus.OK, result["statusCode"])
+        self.assertEqual(4, len(json.loads(result["body"])["deleted"]))
+        self.assertIsNone(
+            SurveyDefinition.ddb_load_interview_questions_document(survey_id)
+        )
+        with self.assertRaises(utils.ObjectDoesNotExistError):
+            ep.SurveyDefinition.get_interview_questions(survey_id)
@@ -17,10 +17,14 @@
 #
 import local.dev_config  # sets env variables TEST_ON_AWS and AWS_TEST_API
 import local.secrets  # sets env variables THISCOVERY_AFS25_PROFILE and THISCOVERY_AMP205_PROFILE
+import datetime
 import json
 import thiscovery_dev_tools.testing_tools as test_utils
+import thiscovery_lib.utilities as utils
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
 from pprint import pprint
+from unittest import mock
 
 import src.personal_links as pl
 import src.common.constants as const
@@ -30,7 +34,10 @@ from thiscovery_dev_tools.test_data.survey_personal_links import (
     TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM,
     TEST_CREATE_PERSONAL_LINKS_EB_EVENT,
 )
+from src.common.ddb_utilities import batch_write_items
+from src.common.lease import DdbLease
 from tests.testing_utilities import DdbMixin
+from uuid import uuid4
 
 
 class TestPersonalLinksBaseClass(test_utils.BaseTestCase, DdbMixin):
@@ -41,6 +48,23 @@ class TestPersonalLinksBaseClass(test_utils.BaseTestCase, DdbMixin):
     )
     default_account = "cambridge"
 
+    def setUp(self):
+        super().setUp()
+        self.clear_assigned_links_cache()
+
+    def clear_assigned_links_cache(self):
+        """
+        Assigned links of the default user are cached across tests and test runs
+        """
+        self.get_ddb_client()
+        pl.assigned_links_cache.clear()
+        self.ddb_client.delete_item(
+            table_name=const.CACHE_TABLE["name"],
+            key=f"{pl.AssignedLinksCache.item_type}_{self.default_account}_"
+            f"{self.default_survey_id}_{self.default_anon_project_specific_user_id}",
+            key_name=const.CACHE_TABLE["partition_key"],
+        )
+
     def check_number_of_links_in_ddb_matches_distribution_list(
         self, additional_links=0
     ):
@@ -95,6 +119,324 @@ class TestPersonalLinkManager(TestPersonalLinksBaseClass):
         ]
         self.assertCountEqual(expected_users, assigned_link_users)
 
+    def test_assign_link_to_user_stops_creating_links_after_max_rounds(self):
+        plm = pl.PersonalLinkManager(
+            survey_id=self.default_survey_id,
+            anon_project_specific_user_id=self.default_anon_project_specific_user_id,
+            account=self.default_account,
+        )
+        taken_links = [TEST_ASSIGNED_PERSONAL_LINK_DDB_ITEM]
+        with mock.patch.object(
+            plm, "_claim_first_free_link", return_value=None
+        ), mock.patch.object(
+            plm, "_create_personal_links_single_flight", return_value=taken_links
+        ) as create_links:
+            with self.assertRaises(utils.DetailedValueError) as context:
+                plm._assign_link_to_user(taken_links)
+        self.assertEqual(
+            const.PersonalLinksTable.MAX_CREATION_ROUNDS, create_links.call_count
+        )
+        err_msg = context.exception.args[0]
+        self.assertIn("Could not assign a personal link", err_msg)
+
+    def test_concurrent_requests_by_same_user_get_same_link(self):
+        def get_link(_):
+            return pl.PersonalLinkManager(
+                survey_id=self.default_survey_id,
+                anon_project_specific_user_id=self.default_anon_project_specific_user_id,
+                account=self.default_account,
+            ).get_personal_link()
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            links = set(executor.map(get_link, range(5)))
+        self.assertEqual(1, len(links))
+
+    def test_order_candidates_spreads_users_within_expiry_window(self):
+        window = const.PersonalLinksTable.ASSIGNMENT_WINDOW
+        links = [
+            {"url": f"https://www.thiscovery.org?id={i}", "expires": f"2021-05-{i:02}"}
+            for i in range(1, window + 6)
+        ]
+        first_choices = set()
+        for user_id in [
+            "e132c198-06d3-4200-a6c0-cc3bc7991828",
+            "87b8f9a8-2400-4259-a8d9-a2f0b16d9ea1",
+            "d1070e81-557e-40eb-a7ba-b951ddb7ebdd",
+            "1cbe9aad-b29f-46b5-920e-b4c496d42515",
+        ]:
+            plm = pl.PersonalLinkManager(
+                survey_id=self.default_survey_id,
+                anon_project_specific_user_id=user_id,
+                account=self.default_account,
+            )
+            candidates = plm._order_candidates(links)
+            self.assertCountEqual(links[:window], candidates[:window])
+            self.assertEqual(links[window:], candidates[window:])
+            first_choices.add(candidates[0]["url"])
+        self.assertGreater(len(first_choices), 1)
+
+
+class TestUnassignedLinksQueries(TestPersonalLinksBaseClass):
+    def setUp(self):
+        super().setUp()
+        self.clear_personal_links_table()
+        self.account_survey_id = TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM[
+            "account_survey_id"
+        ]
+        self.ddb_client.batch_put_items(
+            table_name=const.PersonalLinksTable.NAME,
+            items=[
+                {
+                    **TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM,
+                    "url": f"https://www.thiscovery.org?id={i}",
+                    "expires": f"2099-05-{i:02} 12:00:00",
+                    "status_expires": pl.status_expires(
+                        "new", f"2099-05-{i:02} 12:00:00"
+                    ),
+                }
+                for i in range(30, 0, -1)
+            ],
+            partition_key_name=const.PersonalLinksTable.PARTITION,
+        )
+
+    def test_get_unassigned_links_bounded(self):
+        links = pl.get_unassigned_links(
+            account_survey_id=self.account_survey_id, limit=5
+        )
+        self.assertEqual(
+            [f"2099-05-{i:02} 12:00:00" for i in range(1, 6)],
+            [x["expires"] for x in links],
+        )
+
+    def test_count_unassigned_links(self):
+        self.assertEqual(
+            30, pl.count_unassigned_links(account_survey_id=self.account_survey_id)
+        )
+        self.assertEqual(
+            10,
+            pl.count_unassigned_links(
+                account_survey_id=self.account_survey_id, up_to=10
+            ),
+        )
+
+    def test_link_pool_counter(self):
+        counter = pl.LinkPoolCounter(account_survey_id=self.account_survey_id)
+        self.assertEqual(30, counter.get())  # initialised by counting links
+        counter.add(-1)
+        self.assertEqual(29, counter.get())
+        self.assertEqual(30, counter.recount())
+
+    def test_link_pool_counter_records_assignments(self):
+        counter = pl.LinkPoolCounter(account_survey_id=self.account_survey_id)
+        counter.get()
+        counter.record_assignment()
+        counter.record_assignment()
+        item = counter.get_item()
+        self.assertEqual(28, item[const.PersonalLinkCountersTable.UNASSIGNED])
+        self.assertEqual(2, item[pl.assignment_bucket_name()])
+        buffer = pl.AdaptiveBuffer(item)
+        self.assertEqual(2, buffer.recent_assignments)
+
+
+class TestExpiredLinks(TestPersonalLinksBaseClass):
+    def setUp(self):
+        super().setUp()
+        self.clear_personal_links_table()
+        self.account_survey_id = TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM[
+            "account_survey_id"
+        ]
+        expiry_dates = [f"2021-05-{i:02} 12:00:00" for i in range(1, 6)] + [
+            f"2099-05-{i:02} 12:00:00" for i in range(1, 4)
+        ]
+        self.ddb_client.batch_put_items(
+            table_name=const.PersonalLinksTable.NAME,
+            items=[
+                {
+                    **TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM,
+                    "url": f"https://www.thiscovery.org?expires={expires}",
+                    "expires": expires,
+                    "status_expires": pl.status_expires("new", expires),
+                    const.PersonalLinksTable.TTL_ATTRIBUTE: pl.expires_epoch(expires),
+                }
+                for expires in expiry_dates
+            ],
+            partition_key_name=const.PersonalLinksTable.PARTITION,
+        )
+
+    def test_expires_epoch(self):
+        self.assertEqual(1621512000, pl.expires_epoch("2021-05-20 12:00:00"))
+        self.assertEqual(1621512000, pl.expires_epoch("2021-05-20T12:00:00Z"))
+        self.assertEqual(1621508400, pl.expires_epoch("2021-05-20T12:00:00+01:00"))
+
+    def test_get_unassigned_links_skips_expired_links(self):
+        for limit in [None, 10]:
+            links = pl.get_unassigned_links(
+                account_survey_id=self.account_survey_id, limit=limit
+            )
+            self.assertCountEqual(
+                [f"2099-05-{i:02} 12:00:00" for i in range(1, 4)],
+                [x["expires"] for x in links],
+            )
+
+    def test_unassigned_links_queries_skip_links_expired_today(self):
+        expires = (
+            datetime.datetime.now(datetime.timezone.utc)
+            - datetime.timedelta(seconds=60)
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        table = self.ddb_client.get_table(table_name=const.PersonalLinksTable.NAME)
+        table.put_item(
+            Item={
+                **TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM,
+                "url": "https://www.thiscovery.org?expired=today",
+                "expires": expires,
+                "status_expires": pl.status_expires("new", expires),
+                const.PersonalLinksTable.TTL_ATTRIBUTE: pl.expires_epoch(expires),
+            }
+        )
+        self.assertEqual(
+            3, pl.count_unassigned_links(account_survey_id=self.account_survey_id)
+        )
+        self.assertEqual(
+            3,
+            len(
+                pl.get_unassigned_links(
+                    account_survey_id=self.account_survey_id, limit=10
+                )
+            ),
+        )
+
+    def test_backfill_expiry_attributes(self):
+        legacy_links = [
+            {
+                **TEST_UNASSIGNED_PERSONAL_LINK_DDB_ITEM,
+                "url": f"https://www.thiscovery.org?legacy={i}",
+                "expires": "2099-06-01 12:00:00",
+            }
+            for i in range(2)
+        ]
+        self.ddb_client.batch_put_items(
+            table_name=const.PersonalLinksTable.NAME,
+            items=legacy_links,
+            partition_key_name=const.PersonalLinksTable.PARTITION,
+        )
+        self.assertEqual(
+            3, pl.count_unassigned_links(account_survey_id=self.account_survey_id)
+        )
+        self.assertEqual(2, pl.backfill_expiry_attributes())
+        self.assertEqual(
+            5, pl.count_unassigned_links(account_survey_id=self.account_survey_id)
+        )
+        counter = pl.LinkPoolCounter(account_survey_id=self.account_survey_id)
+        self.assertEqual(5, counter.get())
+        self.assertEqual(0, pl.backfill_expiry_attributes())
+
+    def test_delete_expired_links(self):
+        counter = pl.LinkPoolCounter(account_survey_id=self.account_survey_id)
+        self.assertEqual(3, counter.get())  # expired links are not counted
+        self.assertEqual(
+            5, pl.delete_expired_links(account_survey_id=self.account_survey_id)
+        )
+        self.assertEqual(3, counter.get())
+        links = self.ddb_client.scan(table_name=const.PersonalLinksTable.NAME)
+        self.assertCountEqual(
+            [f"2099-05-{i:02} 12:00:00" for i in range(1, 4)],
+            [x["expires"] for x in links],
+        )
+
+
+class TestAdaptiveBuffer(TestPersonalLinksBaseClass):
+    now = 1621512030  # 2021-05-20 12:00:30 UTC
+
+    def counter_item(self, unassigned, assignments_per_minute, minutes):
+        item = {
+            const.PersonalLinkCountersTable.PARTITION: "cambridge_SV_test",
+            const.PersonalLinkCountersTable.UNASSIGNED: unassigned,
+        }
+        for m in range(minutes):
+            item[pl.assignment_bucket_name(self.now - m * 60)] = assignments_per_minute
+        return item
+
+    def test_quiet_survey_uses_floor(self):
+        buffer = pl.AdaptiveBuffer(self.counter_item(15, 0, 0), now=self.now)
+        self.assertEqual(0, buffer.assignment_rate)
+        self.assertEqual(const.PersonalLinksBuffer.FLOOR, buffer.threshold)
+        self.assertEqual(const.PersonalLinksBuffer.FLOOR, buffer.target)
+        self.assertTrue(buffer.is_low())
+
+    def test_busy_survey_covers_demand(self):
+        buffer = pl.AdaptiveBuffer(self.counter_item(100, 40, 15), now=self.now)
+        self.assertEqual(40, buffer.assignment_rate)
+        self.assertEqual(
+            40 * const.PersonalLinksBuffer.TRIGGER_COVERAGE_MINUTES, buffer.threshold
+        )
+        self.assertEqual(
+            min(
+                40 * const.PersonalLinksBuffer.TARGET_COVERAGE_MINUTES,
+                const.PersonalLinksBuffer.CEILING,
+            ),
+            buffer.target,
+        )
+        self.assertTrue(buffer.is_low())
+
+    def test_ceiling(self):
+        buffer = pl.AdaptiveBuffer(
+            self.counter_item(0, 1000, 15), now=self.now, ceiling=500
+        )
+        self.assertEqual(500, buffer.threshold)
+        self.assertEqual(500, buffer.target)
+
+    def test_buckets_outside_window_are_ignored_and_expired(self):
+        window = const.PersonalLinksBuffer.RATE_WINDOW_MINUTES
+        item = self.counter_item(100, 3, window + 5)
+        buffer = pl.AdaptiveBuffer(item, now=self.now)
+        self.assertEqual(3 * window, buffer.recent_assignments)
+        expired = pl.expired_assignment_buckets(item, now=self.now)
+        self.assertEqual(5, len(expired))
+        self.assertNotIn(pl.assignment_bucket_name(self.now), expired)
+
+
+class TestGenerationLease(TestPersonalLinksBaseClass):
+    def setUp(self):
+        super().setUp()
+        self.lease_name = f"unittest_{uuid4()}"
+
+    def test_lease_is_single_flight(self):
+        lease_1 = DdbLease(name=self.lease_name, duration=60)
+        lease_2 = DdbLease(name=self.lease_name, duration=60)
+        self.assertTrue(lease_1.acquire())
+        self.assertFalse(lease_2.acquire())
+        self.assertTrue(lease_1.renew())
+        self.assertFalse(lease_2.renew())
+        lease_2.release()  # not held; must not release lease_1
+        self.assertFalse(lease_2.acquire())
+        lease_1.release()
+        self.assertTrue(lease_2.acquire())
+        lease_2.release()
+
+    def test_expired_lease_can_be_taken_over(self):
+        crashed_holder = DdbLease(name=self.lease_name, duration=-5)
+        self.assertTrue(crashed_holder.acquire())
+        lease = DdbLease(name=self.lease_name, duration=60)
+        self.assertTrue(lease.acquire())
+        self.assertFalse(crashed_holder.renew())
+        crashed_holder.release()
+        self.assertFalse(DdbLease(name=self.lease_name, duration=60).acquire())
+        lease.release()
+
+    def test_create_personal_links_ignored_while_lease_held(self):
+        self.clear_personal_links_table()
+        event = TEST_CREATE_PERSONAL_LINKS_EB_EVENT
+        lease = pl.generation_lease(
+            account_survey_id=f"{event['detail']['account']}_{event['detail']['survey_id']}"
+        )
+        self.assertTrue(lease.acquire())
+        try:
+            pl.create_personal_links(event, None)
+        finally:
+            lease.release()
+        links = self.ddb_client.scan(table_name=const.PersonalLinksTable.NAME)
+        self.assertEqual(0, len(links))
+
 
 class TestCreatePersonalLinksEventHandler(TestPersonalLinksBaseClass):
     def test_create_personal_links_ok(self):
@@ -102,6 +444,165 @@ class TestCreatePersonalLinksEventHandler(TestPersonalLinksBaseClass):
         pl.create_personal_links(TEST_CREATE_PERSONAL_LINKS_EB_EVENT, None)
         self.check_number_of_links_in_ddb_matches_distribution_list()
 
+    def test_stream_links_to_dynamodb_yields_progress(self):
+        self.clear_personal_links_table()
+        dlg = pl.DistributionLinksGenerator(
+            account=self.default_account,
+            survey_id=self.default_survey_id,
+            contact_list_id=const.DISTRIBUTION_LISTS[self.default_account]["id"],
+        )
+        progress = list(dlg.stream_links_to_dynamodb())
+        self.assertEqual(
+            list(range(1, len(progress) + 1)), [p["page"] for p in progress]
+        )
+        self.assertEqual(
+            const.DISTRIBUTION_LISTS[self.default_account]["length"],
+            progress[-1]["written"],
+        )
+        self.assertEqual(
+            sum(len(p["items"]) for p in progress), progress[-1]["written"]
+        )
+        self.check_number_of_links_in_ddb_matches_distribution_list()
+
+
+class TestPreassignPersonalLinks(TestPersonalLinksBaseClass):
+    def test_preassign_links_ok(self):
+        self.clear_personal_links_table()
+        users = [str(uuid4()) for _ in range(3)]
+        dlg = pl.DistributionLinksGenerator(
+            account=self.default_account,
+            survey_id=self.default_survey_id,
+            contact_list_id=const.DISTRIBUTION_LISTS[self.default_account]["id"],
+        )
+        summary = dlg.preassign_links(users + users[:1])
+        self.assertEqual(4, summary["requested"])
+        self.assertEqual(3, summary["preassigned"])
+        self.assertEqual([], summary["not_assigned"])
+        self.assertEqual(1, summary["rounds"])
+        self.assertEqual(
+            const.DISTRIBUTION_LISTS[self.default_account]["length"] - 3,
+            summary["new_links"],
+        )
+        links = self.check_number_of_links_in_ddb_matches_distribution_list()
+        self.assertCountEqual(
+            users,
+            [
+                x["anon_project_specific_user_id"]
+                for x in links
+                if x["status"] == "assigned"
+            ],
+        )
+
+        # pre-assigned links are returned by the hot path
+        plm = pl.PersonalLinkManager(
+            survey_id=self.default_survey_id,
+            anon_project_specific_user_id=users[0],
+            account=self.default_account,
+        )
+        self.assertIn(
+            plm.get_personal_link(),
+            [
+                x["url"]
+                for x in links
+                if x.get("anon_project_specific_user_id") == users[0]
+            ],
+        )
+
+        # users with links are skipped
+        summary = dlg.preassign_links(users)
+        self.assertEqual(3, summary["already_assigned"])
+        self.assertEqual(0, summary["preassigned"])
+        self.assertEqual(0, summary["rounds"])
+
+
+class TestAssignedLinksCache(TestPersonalLinksBaseClass):
+    def test_cache_never_returns_another_users_link(self):
+        cache = pl.AssignedLinksCache(use_ddb_cache=False)
+        user_1, user_2 = str(uuid4()), str(uuid4())
+        cache.put("cambridge_SV_1", user_1, "https://www.thiscovery.org?id=1")
+        self.assertEqual(
+            "https://www.thiscovery.org?id=1", cache.get("cambridge_SV_1", user_1)
+        )
+        self.assertIsNone(cache.get("cambridge_SV_1", user_2))
+        self.assertIsNone(cache.get("cambridge_SV_2", user_1))
+        # entries are checked against the lookup, not just the key
+        cache.tiers.lru.put(
+            f"cambridge_SV_1_{user_2}",
+            {
+                "account_survey_id": "cambridge_SV_1",
+                "anon_project_specific_user_id": user_1,
+                "url": "https://www.thiscovery.org?id=1",
+            },
+        )
+        self.assertIsNone(cache.get("cambridge_SV_1", user_2))
+
+    def test_ddb_tier_shared_across_containers(self):
+        user = str(uuid4())
+        pl.AssignedLinksCache().put(
+            "cambridge_SV_1", user, "https://www.thiscovery.org?id=1"
+        )
+        other_container_cache = pl.AssignedLinksCache()
+        self.assertEqual(0, len(other_container_cache.tiers.lru))
+        self.assertEqual(
+            "https://www.thiscovery.org?id=1",
+            other_container_cache.get("cambridge_SV_1", user),
+        )
+        self.assertEqual(1, len(other_container_cache.tiers.lru))
+
+    def test_repeat_lookups_skip_personal_links_table(self):
+        self.clear_personal_links_table()
+        self.add_unassigned_links_to_personal_links_table(
+            const.PersonalLinksTable.BUFFER
+        )
+        plm = pl.PersonalLinkManager(
+            survey_id=self.default_survey_id,
+            anon_project_specific_user_id=self.default_anon_project_specific_user_id,
+            account=self.default_account,
+        )
+        user_link = plm.get_personal_link()
+        self.clear_personal_links_table()
+        self.assertEqual(user_link, plm.get_personal_link())
+
+
+class TestBatchWriteItems(test_utils.BaseTestCase):
+    class FakeTable:
+        """
+        Table whose client leaves the last item of each call unprocessed the first
+        unprocessed_calls times it is called
+        """
+
+        name = "unittest-table"
+
+        def __init__(self, unprocessed_calls):
+            self.unprocessed_calls = unprocessed_calls
+            self.written = list()
+            self.calls = 0
+            self.meta = self
+            self.client = self
+
+        def batch_write_item(self, RequestItems):
+            self.calls += 1
+            requests = RequestItems[self.name]
+            if self.calls <= self.unprocessed_calls:
+                self.written.extend(requests[:-1])
+                return {"UnprocessedItems": {self.name: requests[-1:]}}
+            self.written.extend(requests)
+            return {"UnprocessedItems": {}}
+
+    def test_batch_write_items_retries_unprocessed_items(self):
+        table = self.FakeTable(unprocessed_calls=2)
+        items = [{"id": i} for i in range(30)]
+        self.assertEqual(30, batch_write_items(table, items=items))
+        self.assertEqual(
+            items, [r["PutRequest"]["Item"] for r in table.written]
+        )  # no item lost or duplicated
+        self.assertEqual(4, table.calls)  # two chunks, one with two retries
+
+    def test_batch_write_items_gives_up(self):
+        table = self.FakeTable(unprocessed_calls=const.DDB_BATCH_WRITE_MAX_ATTEMPTS)
+        with self.assertRaises(pl.utils.DetailedValueError):
+            batch_write_items(table, items=[{"id": 1}])
+
 
 class TestPersonalLinkApi(TestPersonalLinksBaseClass):
     def default_call_and_assertions(self, expected_base_url: str) -> tuple:
@@ -23,8 +23,16 @@ import thiscovery_dev_tools.testing_tools as test_utils
 import thiscovery_lib.utilities as utils
 from http import HTTPStatus
 from pprint import pprint
+from thiscovery_lib.qualtrics import ResponsesClient
+from unittest import mock
 
 import src.endpoints as ep
+from src.common.clients import QualtricsClientRegistry
+from src.common.survey_response import (
+    ExportTagProjection,
+    ProjectTaskIndex,
+    SurveySchemaCache,
+)
 from tests.test_data import QUALTRICS_TEST_OBJECTS, TEST_RESPONSE_DICT, ARBITRARY_UUID
 
 
@@ -85,6 +93,111 @@ class TestSurveyClient(BaseSurveyTestCase):
         ]
         self.assertCountEqual(expected_keys, list(response.keys()))
 
+    def test_sc_03_export_responses_ok(self):
+        responses = dict(
+            self.survey_client.export_responses(export_tags=self.test_question_ids)
+        )
+        self.assertIn(self.test_response_id, responses.keys())
+        self.assertEqual(
+            self.survey_client.get_response(
+                self.test_response_id, export_tags=self.test_question_ids
+            ),
+            responses[self.test_response_id],
+        )
+
+
+class TestExportTagProjection(test_utils.BaseTestCase):
+    question_ids_to_export_tags = {
+        "QID1": "Q1",
+        "QID2": "Q2",
+        "QID3": "Q3",
+    }
+    values_dict_by_id = {"QID1": 1, "QID3": "Yes"}
+
+    def test_etp_01_all_tags_with_nulls(self):
+        projection = ExportTagProjection(self.question_ids_to_export_tags)
+        self.assertDictEqual(
+            {"Q1": 1, "Q2": None, "Q3": "Yes"}, projection(self.values_dict_by_id)
+        )
+
+    def test_etp_02_selected_tags_without_nulls(self):
+        projection = ExportTagProjection(
+            self.question_ids_to_export_tags,
+            export_tags=["Q2", "Q3"],
+            return_nulls=False,
+        )
+        self.assertDictEqual({"Q3": "Yes"}, projection(self.values_dict_by_id))
+
+
+class TestQualtricsClientRegistry(BaseSurveyTestCase):
+    def test_qcr_01_get_client_reuses_instances(self):
+        registry = QualtricsClientRegistry()
+        client = registry.get_client(ResponsesClient, survey_id=self.test_survey_id)
+        self.assertIs(
+            client, registry.get_client(ResponsesClient, survey_id=self.test_survey_id)
+        )
+        self.assertIsNone(client.correlation_id)
+        self.assertIsInstance(client, ResponsesClient)
+        self.assertDictEqual(
+            {
+                "client_hits": 1,
+                "client_misses": 1,
+                "clients": 1,
+                "session_hits": 0,
+                "session_misses": 0,
+                "sessions": 0,
+            },
+            registry.stats(),
+        )
+
+    def test_qcr_02_sessions_are_per_account_and_clients_bounded(self):
+        registry = QualtricsClientRegistry(max_clients=2)
+        for survey_id in ["SV_1", "SV_2", "SV_3"]:
+            registry.get_client(ResponsesClient, survey_id=survey_id)
+        self.assertEqual(2, registry.stats()["clients"])
+        client = registry.get_client(
+            ResponsesClient, qualtrics_account_name="this", survey_id="SV_3"
+        )
+        self.assertIs(registry.get_session("this"), client.session)
+        self.assertIsNot(registry.get_session(), client.session)
+        self.assertEqual(2, registry.stats()["sessions"])
+
+
+class TestSurveySchemaCache(BaseSurveyTestCase):
+    def test_ssc_01_get_question_ids_to_export_tags_ok_cached(self):
+        cache = SurveySchemaCache(persist=False)
+        responses_client = ResponsesClient(survey_id=self.test_survey_id)
+        mapping = cache.get_question_ids_to_export_tags(
+            survey_id=self.test_survey_id, responses_client=responses_client
+        )
+        self.assertCountEqual(
+            QUALTRICS_TEST_OBJECTS["unittest-survey-1"]["export_tags"],
+            list(mapping.values()),
+        )
+        self.assertIs(
+            mapping,
+            cache.get_question_ids_to_export_tags(
+                survey_id=self.test_survey_id, responses_client=responses_client
+            ),
+        )
+
+    def test_ssc_02_schema_downloaded_again_once_ttl_expires(self):
+        cache = SurveySchemaCache(ttl=0, persist=False)
+        responses_client = mock.MagicMock()
+        responses_client.retrieve_survey_response_schema.return_value = {
+            "result": {
+                "properties": {"values": {"properties": {"QID1": {"exportTag": "Q1"}}}}
+            }
+        }
+        for _ in range(2):
+            self.assertEqual(
+                {"QID1": "Q1"},
+                cache.get_question_ids_to_export_tags(
+                    survey_id=self.test_survey_id, responses_client=responses_client
+                ),
+            )
+        self.assertEqual(2, responses_client.retrieve_survey_response_schema.call_count)
+
 
 class TestSurveyResponse(BaseSurveyTestCase):
     def test_sr_01_init_ok(self):
@@ -180,6 +293,31 @@ class TestSurveyResponse(BaseSurveyTestCase):
         self.assertEqual(expected_status, result_status)
 
 
+class TestProjectTaskIndex(BaseSurveyTestCase):
+    def test_pti_01_contains_ok_index_reused(self):
+        index = ProjectTaskIndex()
+        project_task_id = TEST_RESPONSE_DICT["project_task_id"]
+        self.assertTrue(index.contains(project_task_id))
+        loaded_at = index._loaded_at
+        self.assertTrue(index.contains(project_task_id))
+        self.assertEqual(loaded_at, index._loaded_at)
+
+    def test_pti_02_contains_missing_id_forces_refresh(self):
+        index = ProjectTaskIndex(min_refresh_interval=0)
+        index.refresh()
+        loaded_at = index._loaded_at
+        self.assertFalse(index.contains(ARBITRARY_UUID))
+        self.assertGreater(index._loaded_at, loaded_at)
+
+    def test_pti_03_missing_ids_do_not_refresh_recent_index(self):
+        index = ProjectTaskIndex()
+        index.refresh()
+        loaded_at = index._loaded_at
+        self.assertFalse(index.contains(ARBITRARY_UUID))
+        self.assertFalse(index.contains(ARBITRARY_UUID))
+        self.assertEqual(loaded_at, index._loaded_at)
+
+
 class TestResponseEndpoint(BaseSurveyTestCase):
     retrieve_responses_endpoint = "v1/response"
 
@@ -231,3 +369,30 @@ class TestResponseEndpoint(BaseSurveyTestCase):
         self.assertCountEqual(
             expected_result_body_keys, json.loads(result["body"]).keys()
         )
+
+    def test_ep_03_retrieve_response_api_ok_batch(self):
+        unknown_response_id = "R_0000000000000000"
+        params = {
+            "survey_id": self.test_survey_id,
+            "response_ids": json.dumps(
+                [
+                    QUALTRICS_TEST_OBJECTS["unittest-survey-1"]["response_1_id"],
+                    self.test_response_id,
+                    unknown_response_id,
+                ]
+            ),
+            "question_ids": json.dumps(self.test_question_ids),
+        }
+        result = test_utils.test_get(
+            local_method=ep.retrieve_responses_api,
+            aws_url=self.retrieve_responses_endpoint,
+            querystring_parameters=params,
+        )
+        self.assertEqual(HTTPStatus.OK, result["statusCode"])
+        result_body = json.loads(result["body"])
+        self.assertEqual(2, result_body["count"])
+        self.assertCountEqual(
+            self.test_question_ids,
+            result_body["responses"][self.test_response_id].keys(),
+        )
+        self.assertEqual([unknown_response_id], list(result_body["errors"].keys()))
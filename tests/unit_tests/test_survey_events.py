@@ -22,9 +22,11 @@ import thiscovery_dev_tools.testing_tools as test_tools
 import thiscovery_lib.utilities as utils
 from http import HTTPStatus
 from pprint import pprint
+from unittest import mock
 
 import src.endpoints as ep
 import src.common.constants as const
+from src.common.project_resolver import ProjectResolver
 import tests.test_data as td
 import tests.testing_utilities as test_utils
 
@@ -59,3 +61,34 @@ class TestUserAgent(test_tools.BaseTestCase, test_utils.DdbMixin):
         del item["created"]
         del item["modified"]
         self.assertDictEqual(expected_item, item)
+
+
+class TestProjectResolver(test_tools.BaseTestCase):
+    anon_user_task_id = td.TEST_USER_INTERVIEW_TASK["anon_user_task_id"]
+    project_task_id = "b335c46a-bc1b-4f3d-ad0f-0b8d0826a908"
+
+    def test_get_project_task_id_ok_cached_in_memory(self):
+        resolver = ProjectResolver(persist=False)
+        self.assertEqual(
+            self.project_task_id, resolver.get_project_task_id(self.anon_user_task_id)
+        )
+        core_api_client = mock.MagicMock()
+        self.assertEqual(
+            self.project_task_id,
+            resolver.get_project_task_id(
+                self.anon_user_task_id, core_api_client=core_api_client
+            ),
+        )
+        core_api_client.get_user_task_from_anon_user_task_id.assert_not_called()
+
+    def test_get_project_ok_cached_in_ddb(self):
+        project = ProjectResolver().get_project(self.project_task_id)
+        self.assertCountEqual(["id", "name"], project.keys())
+        core_api_client = mock.MagicMock()
+        self.assertEqual(
+            project,
+            ProjectResolver().get_project(
+                self.project_task_id, core_api_client=core_api_client
+            ),
+        )
+        core_api_client.get_project_from_project_task_id.assert_not_called()